@@ -13,6 +13,7 @@ window.djdt = (function(window, document, jQuery) {
 
 			if(typeof(localStorage) != 'undefined' && localStorage['djDebugToolbarShowPanel']){
 			    var className = localStorage['djDebugToolbarShowPanel'];
+				djdt.load_panel($('#djDebug #' + className));
 				$('#djDebug #' + className).show();
 				$('#djDebugToolbar li').removeClass('active');
 				$('#djDebugPanelList li a.' + className).parent().addClass('active');
@@ -31,18 +32,19 @@ window.djdt = (function(window, document, jQuery) {
 				} else {
 					$('.panelContent').hide(); // Hide any that are already open
 					if(typeof(localStorage) != 'undefined')localStorage['djDebugToolbarShowPanel'] = this.className;
+					djdt.load_panel(current);
 					current.show();
 					$('#djDebugToolbar li').removeClass('active');
 					$(this).parent().addClass('active');
 				}
 				return false;
 			});
-			$('#djDebug a.djDebugClose').click(function() {
+			$('#djDebug a.djDebugClose').live('click', function() {
 				$(document).trigger('close.djDebug');
 				$('#djDebugToolbar li').removeClass('active');
 				return false;
 			});
-			$('#djDebug a.remoteCall').click(function() {
+			$('#djDebug a.remoteCall').live('click', function() {
 				$('#djDebugWindow').load(this.href, function(response, status, xhr) {
 					if (status == "error") {
 						var message = '<div class="djDebugPanelTitle"><a class="djDebugClose djDebugBack" href="">Back</a><h3>'+xhr.status+': '+xhr.statusText+'</h3></div>';
@@ -56,17 +58,17 @@ window.djdt = (function(window, document, jQuery) {
 				$('#djDebugWindow').show();
 				return false;
 			});
-			$('#djDebugTemplatePanel a.djTemplateShowContext').click(function() {
+			$('#djDebugTemplatePanel a.djTemplateShowContext').live('click', function() {
 				djdt.toggle_arrow($(this).children('.toggleArrow'));
 				djdt.toggle_content($(this).parent().next());
 				return false;
 			});
-            $('#djDebug a.djDebugToggle').click(function(e) {
+            $('#djDebug a.djDebugToggle').live('click', function(e) {
                 e.preventDefault();
                 $(this).parent().find('.djDebugCollapsed').toggle();
                 $(this).parent().find('.djDebugUncollapsed').toggle()
             });
-			$('#djDebug a.djToggleSwitch').click(function(e) {
+			$('#djDebug a.djToggleSwitch').live('click', function(e) {
 				e.preventDefault();
 				var btn = $(this);
 				var panel = btn.parents('.djDebugPanelContent');
@@ -94,6 +96,74 @@ window.djdt = (function(window, document, jQuery) {
 				});
 				return;
 			});
+			$('#djDebug th.djSortable').live('click', function() {
+				var th = $(this);
+				var key = 'data-' + th.attr('data-sort');
+				var descending = th.attr('data-sort-order') != 'desc';
+				th.attr('data-sort-order', descending ? 'desc' : 'asc');
+				var tbody = th.closest('table').children('tbody');
+				var rows = tbody.children('tr[' + key + ']').get();
+				rows.sort(function(a, b) {
+					var x = parseFloat($(a).attr(key)) || 0;
+					var y = parseFloat($(b).attr(key)) || 0;
+					return descending ? y - x : x - y;
+				});
+				// Each row is followed by the row of its details
+				$.each(rows, function(i, row) {
+					var details = $('#' + row.id.replace('Main_', 'Details_'));
+					tbody.append(row).append(details);
+				});
+			});
+			// Shows the spans of the timeline between from and to (in ms)
+			function zoomWaterfall(table, from, to) {
+				var total = parseFloat(table.attr('data-total'));
+				from = Math.max(from, 0);
+				to = Math.min(to, total);
+				var range = to - from;
+				if (range <= 0) {
+					return;
+				}
+				table.attr('data-from', from).attr('data-to', to);
+				table.find('.djDebugWaterfallBar').each(function() {
+					var bar = $(this);
+					var start = parseFloat(bar.attr('data-start'));
+					var stop = start + parseFloat(bar.attr('data-duration'));
+					if (stop < from || start > to) {
+						bar.hide();
+						return;
+					}
+					var left = Math.max(start, from);
+					bar.css({
+						left: (100 * (left - from) / range) + '%',
+						width: (100 * (Math.min(stop, to) - left) / range) + '%'
+					}).show();
+				});
+				table.find('.djDebugWaterfallRange').text(from.toFixed(2) + ' - ' + to.toFixed(2) + 'ms');
+			}
+			$('#djDebug .djDebugWaterfallControls a').live('click', function() {
+				var link = $(this);
+				var table = link.closest('table');
+				var from = parseFloat(table.attr('data-from'));
+				var to = parseFloat(table.attr('data-to'));
+				var middle = (from + to) / 2, half = (to - from) / 2;
+				if (link.hasClass('djZoomIn')) {
+					zoomWaterfall(table, middle - half / 2, middle + half / 2);
+				} else if (link.hasClass('djZoomOut')) {
+					zoomWaterfall(table, middle - half * 2, middle + half * 2);
+				} else {
+					zoomWaterfall(table, 0, parseFloat(table.attr('data-total')));
+				}
+				return false;
+			});
+			// Clicking on a span zooms in on it
+			$('#djDebug .djDebugWaterfallBar').live('click', function() {
+				var bar = $(this);
+				var start = parseFloat(bar.attr('data-start'));
+				var duration = parseFloat(bar.attr('data-duration'));
+				var margin = Math.max(duration, 0.1);
+				zoomWaterfall(bar.closest('table'), start - margin, start + duration + margin);
+				return false;
+			});
 			function getSubcalls(row) {
 			  id = row.attr('id');
 			  return $('.djDebugProfileRow[id^="'+id+'_"]');
@@ -103,7 +173,7 @@ window.djdt = (function(window, document, jQuery) {
 			  depth = parseInt(row.attr('depth')) + 1;
 			  return subcalls.filter('[depth='+depth+']');
 			}
-			$('.djDebugProfileRow .djDebugProfileToggle').click(function(){
+			$('.djDebugProfileRow .djDebugProfileToggle').live('click', function(){
 			  row = $(this).closest('.djDebugProfileRow')
 			  subcalls = getSubcalls(row);
 			  if (subcalls.css('display')=='none') {
@@ -142,26 +212,26 @@ window.djdt = (function(window, document, jQuery) {
 			} else {
 				djdt.show_toolbar(false);
 			}
-			$('#djDebug .djDebugHoverable').hover(function(){
+			$('#djDebug .djDebugHoverable').live('mouseenter', function(){
 				$(this).addClass('djDebugHover');
-			}, function(){
+			}).live('mouseleave', function(){
 			    $(this).removeClass('djDebugHover');
 			});
 			
 			/* allow <input class="filter"> to toggle the display of items
 			* with `value` as the jQuery selector */
-			$('input.filter').change(function(){
+			$('input.filter').live('change', function(){
 			    var objects = $(this.value);
 			    objects.toggle(this.checked);
 			});
-			$('input.filter_all').change(function(){
+			$('input.filter_all').live('change', function(){
 			    var objects = $(this.value);
 			    objects.attr('checked', this.checked);
 			    objects.change();
 			});
-			$('input.filter, input.filter_all').attr('checked', true);
+			djdt.init_content($('#djDebug'));
 
-			$('input.search').keydown(function(){
+			$('input.search').live('keydown', function(){
 			    if(this.value){
 			        $(this.name).closest('tr').hide();
 			        $(this.name + ':contains(' + this.value + ')').closest('tr').show();
@@ -176,6 +246,30 @@ window.djdt = (function(window, document, jQuery) {
 			    callback(djdt);
 			});
 		},
+		init_content: function(elem) {
+			elem.find('input.filter, input.filter_all').attr('checked', true);
+		},
+		load_panel: function(panel) {
+			// Fetch the content of panels that weren't rendered with the page
+			var content = panel.find('.djDebugPanelContent .djDebugLazy');
+			var store_id = $('#djDebug').attr('data-store-id');
+			if (!content.length || !store_id) {
+				return;
+			}
+			content.removeClass('djDebugLazy');
+			var url = $('#djDebug').attr('data-render-panel-url') + '?' + $.param({
+				store_id: store_id,
+				panel_id: panel.attr('id')
+			});
+			content.load(url, function(response, status, xhr) {
+				if (status == "error") {
+					content.addClass('djDebugLazy');
+					content.html('<p>' + xhr.status + ': ' + xhr.statusText + '</p>');
+					return;
+				}
+				djdt.init_content(content);
+			});
+		},
 		toggle_content: function(elem) {
 			if (elem.is(':visible')) {
 				elem.hide();
@@ -2,42 +2,176 @@
 Debug Toolbar middleware
 """
 import imp
+import logging
+import random
 import thread
+import threading
+import time
 
 from django.conf import settings
 from django.conf.urls.defaults import include, patterns
+from django.core.signals import request_finished
 from django.http import HttpResponseRedirect
-from django.utils.encoding import smart_unicode
 from django.utils.importlib import import_module
 
 import debug_toolbar.urls
-from debug_toolbar.toolbar.loader import DebugToolbar
+from debug_toolbar.toolbar.loader import DebugToolbar, load_panel_classes
 
 _HTML_TYPES = ('text/html', 'application/xhtml+xml')
 
+# A request carrying this header or cookie is always sampled
+SAMPLE_HEADER = 'HTTP_X_DEBUG_TOOLBAR_SAMPLE'
+SAMPLE_COOKIE = 'djdt_sample'
+# With CAPTURE_HEADLESS, a request carrying this header is captured without
+# inserting the toolbar into the response, like AJAX requests are
+HEADLESS_HEADER = 'HTTP_X_DEBUG_TOOLBAR_HEADLESS'
+
+logger = logging.getLogger('debug_toolbar')
+
+# Size of the blocks the end of a response is searched in for the tag the
+# toolbar is inserted before
+_SEARCH_WINDOW = 8192
+
+def find_insensitive(string, target):
+    """
+    Similar to string.rfind() but is case insensitive. ``string`` is
+    searched backwards one window at a time, so only small lowercased copies
+    of its tail are made rather than one of the whole string.
+    """
+    target = target.lower()
+    end = len(string)
+    while end > 0:
+        start = max(0, end - _SEARCH_WINDOW)
+        index = string[start:end].lower().rfind(target)
+        if index >= 0:
+            return start + index
+        if start == 0:
+            break
+        # Overlap the windows so a target spanning two of them is found
+        end = start + len(target) - 1
+    return -1
+
+def insert_before_insensitive(string, target, insertion):
+    """
+    Inserts ``insertion`` before the last occurrence of ``target`` in
+    ``string``, ignoring case. Returns None if ``target`` isn't found.
+    """
+    index = find_insensitive(string, target)
+    if index < 0:
+        return None
+    return string[:index] + insertion + string[index:]
+
 def replace_insensitive(string, target, replacement):
     """
-    Similar to string.replace() but is case insensitive
-    Code borrowed from: http://forums.devshed.com/python-programming-11/case-insensitive-string-replace-490921.html
+    Similar to string.replace() but is case insensitive and only replaces
+    the last occurrence of ``target``.
     """
-    no_case = string.lower()
-    index = no_case.rfind(target.lower())
+    index = find_insensitive(string, target)
     if index >= 0:
         return string[:index] + replacement + string[index + len(target):]
     else: # no results so return the original string
         return string
 
+class InsertingIterator(object):
+    """
+    Wraps the content iterator of a streamed response and inserts
+    ``insertion`` before the last occurrence of ``target`` in it.
+
+    Chunks are passed through as they come, except for the last few which are
+    held back until the iterator is exhausted so the target can be looked for
+    in them. At least ``_SEARCH_WINDOW`` bytes are held back, so the target is
+    found as long as it is in that tail of the response.
+    """
+    def __init__(self, iterable, target, insertion, charset):
+        self.iterable = iterable
+        self.target = target
+        self.insertion = insertion
+        self.charset = charset
+
+    def __iter__(self):
+        pending = []
+        pending_size = 0
+        for chunk in self.iterable:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(self.charset)
+            pending.append(chunk)
+            pending_size += len(chunk)
+            while len(pending) > 1 and \
+                    pending_size - len(pending[0]) >= _SEARCH_WINDOW:
+                chunk = pending.pop(0)
+                pending_size -= len(chunk)
+                yield chunk
+        tail = ''.join(pending)
+        content = insert_before_insensitive(tail, self.target, self.insertion)
+        if content is None:
+            yield tail
+        else:
+            yield content
+
+    def close(self):
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+class SamplingStats(object):
+    """
+    Counts the requests the toolbar was shown for, how many of them were
+    sampled and how much time the toolbar spent on the sampled ones.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.sampled = 0
+        self.overhead = 0.0 # ms
+
+    def add_request(self, sampled):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            if sampled:
+                self.sampled += 1
+        finally:
+            self.lock.release()
+
+    def add_overhead(self, overhead):
+        self.lock.acquire()
+        try:
+            self.overhead += overhead
+        finally:
+            self.lock.release()
+
+    def sampled_fraction(self):
+        if not self.requests:
+            return 0.0
+        return float(self.sampled) / self.requests
+
+    def mean_overhead(self):
+        if not self.sampled:
+            return 0.0
+        return self.overhead / self.sampled
+
+def _request_finished(sender, **kwargs):
+    DebugToolbarMiddleware.remove_toolbar()
+
+
 class DebugToolbarMiddleware(object):
     """
     Middleware to set up Debug Toolbar on incoming request and render toolbar
     on outgoing response.
     """
     debug_toolbars = {}
+    sampling_stats = SamplingStats()
 
     @classmethod
     def get_current(cls):
         return cls.debug_toolbars.get(thread.get_ident())
 
+    @classmethod
+    def remove_toolbar(cls):
+        """
+        Forgets the toolbar of the current thread's request.
+        """
+        cls.debug_toolbars.pop(thread.get_ident(), None)
+
     def __init__(self):
         self._urlconfs = {}
 
@@ -47,6 +181,12 @@ class DebugToolbarMiddleware(object):
         # The tag to attach the toolbar to
         self.tag= u'</body>'
 
+        # Fraction of the requests the toolbar is shown for that get
+        # instrumented, optionally per url prefix
+        self.sample_rate = 1.0
+        self.sample_rate_prefixes = []
+        self.sample_report_interval = 1000
+
         if hasattr(settings, 'DEBUG_TOOLBAR_CONFIG'):
             show_toolbar_callback = settings.DEBUG_TOOLBAR_CONFIG.get(
                 'SHOW_TOOLBAR_CALLBACK', None)
@@ -57,6 +197,20 @@ class DebugToolbarMiddleware(object):
             if tag:
                 self.tag = u'</' + tag + u'>'
 
+            self.sample_rate = float(settings.DEBUG_TOOLBAR_CONFIG.get(
+                'SAMPLE_RATE', self.sample_rate))
+            prefixes = dict(settings.DEBUG_TOOLBAR_CONFIG.get(
+                'SAMPLE_RATE_PREFIXES', ()))
+            # Longest prefix first, so the most specific one wins
+            self.sample_rate_prefixes = sorted(
+                [(prefix, float(rate)) for prefix, rate in prefixes.items()],
+                key=lambda x: -len(x[0]))
+            self.sample_report_interval = settings.DEBUG_TOOLBAR_CONFIG.get(
+                'SAMPLE_REPORT_INTERVAL', self.sample_report_interval)
+
+        # Resolve the panels once rather than on every request
+        load_panel_classes()
+
     def _show_toolbar(self, request):
         if getattr(settings, 'TEST', False):
             return False
@@ -70,8 +224,37 @@ class DebugToolbarMiddleware(object):
         # if not internal ip, and not DEBUG
         return remote_addr in settings.INTERNAL_IPS and bool(settings.DEBUG)
 
+    def get_sample_rate(self, request):
+        for prefix, rate in self.sample_rate_prefixes:
+            if request.path_info.startswith(prefix):
+                return rate
+        return self.sample_rate
+
+    def should_sample(self, request):
+        """
+        Decides whether the toolbar collects data for this request. Requests
+        that aren't sampled skip the toolbar entirely.
+        """
+        if request.META.get(SAMPLE_HEADER) or request.COOKIES.get(SAMPLE_COOKIE):
+            return True
+        rate = self.get_sample_rate(request)
+        return rate >= 1 or random.random() < rate
+
+    def report_sampling(self, toolbar):
+        stats = self.__class__.sampling_stats
+        stats.add_overhead(toolbar.overhead)
+        if self.sample_report_interval and stats.sampled and \
+                stats.sampled % self.sample_report_interval == 0:
+            logger.info('Debug toolbar sampled %d of %d requests (%.1f%%), '
+                'mean overhead %.2fms, %d toolbars alive', stats.sampled,
+                stats.requests, stats.sampled_fraction() * 100,
+                stats.mean_overhead(), DebugToolbar.live_count())
+
     def process_request(self, request):
         __traceback_hide__ = True
+        # Don't let a toolbar left behind by a previous request of this thread
+        # record this one
+        self.remove_toolbar()
         if self.show_toolbar(request):
             urlconf = getattr(request, 'urlconf', settings.ROOT_URLCONF)
             if isinstance(urlconf, basestring):
@@ -91,26 +274,70 @@ class DebugToolbarMiddleware(object):
 
             request.urlconf = self._urlconfs[urlconf]
 
+            # Don't instrument the toolbar's own views
+            if request.path_info.startswith('/%s/' % debug_toolbar.urls._PREFIX):
+                return
+
+            sampled = self.should_sample(request)
+            self.__class__.sampling_stats.add_request(sampled)
+            if not sampled:
+                return
+
+            start = time.time()
             toolbar = DebugToolbar(request)
-            for panel in toolbar.panels:
-                panel.process_request(request)
+            toolbar.run_hook('process_request', request)
             self.__class__.debug_toolbars[thread.get_ident()] = toolbar
+            toolbar.overhead += (time.time() - start) * 1000
 
     def process_view(self, request, view_func, view_args, view_kwargs):
         __traceback_hide__ = True
         toolbar = self.__class__.debug_toolbars.get(thread.get_ident())
         if not toolbar:
             return
-        for panel in toolbar.panels:
-            panel.process_view(request, view_func, view_args, view_kwargs)
+        start = time.time()
+        toolbar.run_hook('process_view', request, view_func, view_args, view_kwargs)
+        toolbar.overhead += (time.time() - start) * 1000
+
+    def capture(self, toolbar, response):
+        """
+        Stores the toolbar without touching the response body. The id to
+        retrieve it with is sent in the ``X-Debug-Toolbar-Id`` header, and the
+        number of N+1 query patterns found, if any, in the
+        ``X-Debug-Toolbar-N-Plus-One`` header.
+        """
+        toolbar.store()
+        response['X-Debug-Toolbar-Id'] = toolbar.store_id
+        n_plus_one = toolbar.stats.get('sql', {}).get('n_plus_one')
+        if n_plus_one:
+            response['X-Debug-Toolbar-N-Plus-One'] = str(len(n_plus_one))
+
+    def process_exception(self, request, exception):
+        __traceback_hide__ = True
+        # The response middleware isn't run when exceptions are propagated
+        if getattr(settings, 'DEBUG_PROPAGATE_EXCEPTIONS', False):
+            self.remove_toolbar()
 
     def process_response(self, request, response):
         __traceback_hide__ = True
-        ident = thread.get_ident()
-        toolbar = self.__class__.debug_toolbars.get(ident)
+        toolbar = self.__class__.get_current()
         if not toolbar:
             return response
-        if isinstance(response, HttpResponseRedirect):
+        start = time.time()
+        try:
+            response = self.render(toolbar, request, response)
+        finally:
+            self.remove_toolbar()
+        toolbar.overhead += (time.time() - start) * 1000
+        self.report_sampling(toolbar)
+        return response
+
+    def render(self, toolbar, request, response):
+        """
+        Inserts the toolbar into ``response`` or captures it headlessly.
+        """
+        headless = toolbar.config['CAPTURE_HEADLESS'] and \
+            (request.is_ajax() or bool(request.META.get(HEADLESS_HEADER)))
+        if isinstance(response, HttpResponseRedirect) and not headless:
             if not toolbar.config['INTERCEPT_REDIRECTS']:
                 return response
             redirect_to = response.get('Location', None)
@@ -124,7 +351,7 @@ class DebugToolbarMiddleware(object):
                 response.cookies = cookies
 
         html_type = response.get('Content-Type', '').split(';')[0] in _HTML_TYPES
-        if 'gzip' not in response.get('Content-Encoding', '') and \
+        if not headless and 'gzip' not in response.get('Content-Encoding', '') and \
            (html_type or request.GET.get('debug')):
             if not html_type:
                 response.content = '''
@@ -141,13 +368,34 @@ class DebugToolbarMiddleware(object):
                 )
                 response['content-type'] = 'text/html'
 
-            for panel in toolbar.panels:
-                panel.process_response(request, response)
-            response.content = replace_insensitive(
-                smart_unicode(response.content),
-                self.tag,
-                smart_unicode(toolbar.render_toolbar() + self.tag))
-            if response.get('Content-Length', None):
-                response['Content-Length'] = len(response.content)
-        del self.__class__.debug_toolbars[ident]
+            toolbar.run_hook('process_response', request, response)
+
+            # Work on the encoded content to avoid decoding the whole response
+            charset = getattr(response, '_charset', settings.DEFAULT_CHARSET)
+            tag = self.tag.encode(charset)
+            if getattr(response, '_is_string', True):
+                content = response.content
+                index = find_insensitive(content, tag)
+                if index >= 0:
+                    toolbar.store()
+                    response.content = content[:index] + \
+                        toolbar.render_toolbar().encode(charset) + content[index:]
+                    if response.get('Content-Length', None):
+                        response['Content-Length'] = len(response.content)
+                elif toolbar.config['CAPTURE_HEADLESS']:
+                    # Nowhere to insert the toolbar, e.g. an HTML fragment
+                    self.capture(toolbar, response)
+            else:
+                toolbar.store()
+                response._container = InsertingIterator(response._container,
+                    tag, toolbar.render_toolbar().encode(charset), charset)
+                del response['Content-Length']
+        elif toolbar.config['CAPTURE_HEADLESS']:
+            toolbar.run_hook('process_response', request, response)
+            self.capture(toolbar, response)
         return response
+
+# Whatever happened to the response, the toolbar of a request is gone once it
+# has been handled
+request_finished.connect(_request_finished,
+    dispatch_uid='debug_toolbar.middleware.request_finished')
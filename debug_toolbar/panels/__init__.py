@@ -1,3 +1,6 @@
+import time
+import weakref
+
 from django.template.defaultfilters import slugify
 from django.template.loader import render_to_string
 
@@ -15,7 +18,10 @@ class DebugPanel(object):
     context = {}
 
     # Panel methods
-    def __init__(self, context={}):
+    def __init__(self, toolbar, context={}):
+        # A weak reference, so that toolbars aren't kept alive by reference
+        # cycles with their panels and are freed as soon as they're dropped
+        self.toolbar = weakref.proxy(toolbar)
         self.context.update(context)
         self.slug = slugify(self.name)
 
@@ -49,21 +55,33 @@ class DebugPanel(object):
                     self.template, e, e)
                 raise
 
+    def render_content(self):
+        """
+        Returns ``content()``, keeping track of how long it took.
+        """
+        start = time.time()
+        try:
+            return self.content()
+        finally:
+            self.toolbar.record_timing(self.__class__, 'content',
+                (time.time() - start) * 1000)
+
+    def add_tracking_time(self, duration):
+        """
+        Adds ``duration`` (in ms) to the time the panel spent collecting data
+        outside of its own hooks, e.g. in a wrapped cursor.
+        """
+        self.toolbar.record_timing(self.__class__, 'tracking', duration)
+
     def record_stats(self, stats):
-        # import locally to work around recursive imports
-        from debug_toolbar.middleware import DebugToolbarMiddleware
-        toolbar = DebugToolbarMiddleware.get_current()
-        panel_stats = toolbar.stats.get(self.slug)
+        panel_stats = self.toolbar.stats.get(self.slug)
         if panel_stats:
             panel_stats.update(stats)
         else:
-            toolbar.stats[self.slug] = stats
+            self.toolbar.stats[self.slug] = stats
 
     def get_stats(self):
-        # import locally to work around recursive imports
-        from debug_toolbar.middleware import DebugToolbarMiddleware
-        toolbar = DebugToolbarMiddleware.get_current()
-        return toolbar.stats.get(self.slug, {})
+        return self.toolbar.stats.get(self.slug, {})
 
     # Standard middleware methods
     def process_request(self, request):
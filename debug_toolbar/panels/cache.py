@@ -4,11 +4,17 @@ import inspect
 from django.core import cache
 from django.core.cache.backends.base import BaseCache
 from django.utils.translation import ugettext_lazy as _, ungettext_lazy as __
+from debug_toolbar.middleware import DebugToolbarMiddleware
 from debug_toolbar.panels import DebugPanel
+from debug_toolbar.utils import timer
 
 
 class CacheStatTracker(BaseCache):
-    '''A small class used to track cache calls.'''
+    '''
+    A small class used to track cache calls. Each call is recorded as
+    ``(duration, name, arguments, caller, start, stop)``, where ``start`` and
+    ``stop`` are ``timer()`` readings.
+    '''
 
     def __init__(self, cache):
         self.cache = cache
@@ -29,6 +35,14 @@ class CacheStatTracker(BaseCache):
     def track(self, key, value):
         self.stats[key] += value
 
+    def track_overhead(self, toolbar, start):
+        """
+        Adds the time since ``start`` to the time the cache panel spent
+        collecting data.
+        """
+        toolbar.record_timing(CacheDebugPanel, 'tracking',
+            (time.time() - start) * 1000)
+
     def _get_func_info(self):
         ''' Some attempts to get stack info fail, so try/except so we can set
             a message if this happens.
@@ -41,40 +55,65 @@ class CacheStatTracker(BaseCache):
             return (stack[1], stack[2], stack[3], stack[4])
 
     def get(self, key, default=None):
-        t = time.time()
+        # Requests the toolbar isn't active for aren't tracked
+        toolbar = DebugToolbarMiddleware.get_current()
+        if toolbar is None:
+            return self.cache.get(key, default)
+        t = timer()
         value = self.cache.get(key, default)
-        this_time = time.time() - t
+        stop = timer()
+        this_time = stop - t
+        tracking_start = time.time()
         self.track('total_time', this_time * 1000)
         if value is None:
             self.track('misses', 1)
         else:
             self.track('hits', 1)
         self.track('gets', 1)
-        self.track('calls', [(this_time, 'get', (key,), self._get_func_info())])
+        self.track('calls', [(this_time, 'get', (key,), self._get_func_info(),
+            t, stop)])
+        self.track_overhead(toolbar, tracking_start)
         return value
 
     def set(self, key, value, timeout=None):
-        t = time.time()
+        toolbar = DebugToolbarMiddleware.get_current()
+        if toolbar is None:
+            return self.cache.set(key, value, timeout)
+        t = timer()
         self.cache.set(key, value, timeout)
-        this_time = time.time() - t
+        stop = timer()
+        this_time = stop - t
+        tracking_start = time.time()
         self.track('total_time', this_time * 1000)
         self.track('sets', 1)
         self.track('calls', [(this_time, 'set', (key, value, timeout),
-            self._get_func_info())])
+            self._get_func_info(), t, stop)])
+        self.track_overhead(toolbar, tracking_start)
 
     def delete(self, key):
-        t = time.time()
+        toolbar = DebugToolbarMiddleware.get_current()
+        if toolbar is None:
+            return self.cache.delete(key)
+        t = timer()
         self.cache.delete(key)
-        this_time = time.time() - t
+        stop = timer()
+        this_time = stop - t
+        tracking_start = time.time()
         self.track('total_time', this_time * 1000)
         self.track('deletes', 1)
         self.track('calls', [(this_time, 'delete', (key,),
-            self._get_func_info())])
+            self._get_func_info(), t, stop)])
+        self.track_overhead(toolbar, tracking_start)
 
     def get_many(self, keys):
-        t = time.time()
+        toolbar = DebugToolbarMiddleware.get_current()
+        if toolbar is None:
+            return self.cache.get_many(keys)
+        t = timer()
         results = self.cache.get_many(keys)
-        this_time = time.time() - t
+        stop = timer()
+        this_time = stop - t
+        tracking_start = time.time()
         self.track('total_time', this_time * 1000)
         self.track('get_many', 1)
         for key, value in results.iteritems():
@@ -83,7 +122,8 @@ class CacheStatTracker(BaseCache):
             else:
                 self.track('hits', 1)
         self.track('calls', [(this_time, 'get_many', (keys,),
-            self._get_func_info())])
+            self._get_func_info(), t, stop)])
+        self.track_overhead(toolbar, tracking_start)
         return results
 
 
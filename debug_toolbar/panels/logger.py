@@ -1,10 +1,12 @@
 import datetime
 import logging
+import time
 try:
     import threading
 except ImportError:
     threading = None
 from django.utils.translation import ugettext_lazy as _, ungettext
+from debug_toolbar.middleware import DebugToolbarMiddleware
 from debug_toolbar.panels import DebugPanel
 from debug_toolbar import utils
 
@@ -51,6 +53,11 @@ class ThreadTrackingHandler(logging.Handler):
         self.collector = collector
 
     def emit(self, record):
+        # Only collect records for requests the toolbar is active for
+        toolbar = DebugToolbarMiddleware.get_current()
+        if toolbar is None:
+            return
+        start = time.time()
         record = {
             'message': record.getMessage(),
             'time': datetime.datetime.fromtimestamp(record.created),
@@ -58,8 +65,11 @@ class ThreadTrackingHandler(logging.Handler):
             'file': record.pathname,
             'line': record.lineno,
             'channel': record.name,
+            # On the clock of the other panels, see TimelineDebugPanel
+            'timer': utils.timer(),
         }
         self.collector.add_record(record)
+        toolbar.record_timing(LoggingPanel, 'tracking', (time.time() - start) * 1000)
 
 
 collector = LogCollector()
@@ -84,6 +94,10 @@ if logbook_supported:
             self.collector = collector
 
         def emit(self, record):
+            toolbar = DebugToolbarMiddleware.get_current()
+            if toolbar is None:
+                return
+            start = time.time()
             record = {
                 'message': record.message,
                 'time': record.time,
@@ -91,8 +105,11 @@ if logbook_supported:
                 'file': record.filename,
                 'line': record.lineno,
                 'channel': record.channel,
+                'timer': utils.timer(),
             }
             self.collector.add_record(record)
+            toolbar.record_timing(LoggingPanel, 'tracking',
+                (time.time() - start) * 1000)
 
     logbook_handler = LogbookThreadTrackingHandler(collector)
     logbook_handler.push_application()  # register with logbook
@@ -0,0 +1,79 @@
+from django.template.loader import render_to_string
+from django.utils.translation import ugettext_lazy as _
+from debug_toolbar.middleware import DebugToolbarMiddleware
+from debug_toolbar.panels import DebugPanel
+from debug_toolbar.utils import approximate_size
+
+HOOKS = ('process_request', 'process_view', 'process_response', 'content',
+    'tracking')
+
+# Panel attributes that aren't data collected by the panel
+IGNORED_ATTRIBUTES = ('toolbar', 'context')
+
+
+class OverheadDebugPanel(DebugPanel):
+    """
+    Panel that displays how much time and memory the toolbar itself takes up,
+    per panel. It should be the last panel so it can see the others' work.
+    """
+    name = 'Overhead'
+    template = 'debug_toolbar/panels/overhead.html'
+    has_content = True
+
+    def nav_title(self):
+        return _('Overhead')
+
+    def nav_subtitle(self):
+        return '%0.2fms' % self.get_total_time()
+
+    def title(self):
+        return _('Toolbar Overhead')
+
+    def url(self):
+        return ''
+
+    def get_total_time(self):
+        return sum([sum(timings.values())
+            for timings in self.toolbar.timings.itervalues()])
+
+    def get_memory(self, panel):
+        """
+        Returns the approximate number of bytes the data ``panel`` collected
+        takes up.
+        """
+        state = dict([(k, v) for k, v in panel.__dict__.iteritems()
+            if k not in IGNORED_ATTRIBUTES])
+        return approximate_size((state, self.toolbar.stats.get(panel.slug)))
+
+    def get_rows(self):
+        rows = []
+        for panel in self.toolbar.panels:
+            timings = self.toolbar.timings.get(panel.__class__, {})
+            rows.append({
+                'name': panel.name,
+                'timings': [timings.get(hook, 0) for hook in HOOKS],
+                'total': sum(timings.values()),
+                'memory': panel is not self and self.get_memory(panel) or 0,
+            })
+        return rows
+
+    def process_response(self, request, response):
+        stats = DebugToolbarMiddleware.sampling_stats
+        # Memory is only walked once the content is rendered, where it's
+        # timed as the content of this panel
+        self.record_stats({
+            'sampled_fraction': stats.sampled_fraction(),
+            'mean_overhead': stats.mean_overhead(),
+        })
+
+    def content(self):
+        rows = self.get_rows()
+        context = self.context.copy()
+        context.update(self.get_stats())
+        context.update({
+            'rows': rows,
+            'total_time': sum([row['total'] for row in rows]),
+            'total_memory': sum([row['memory'] for row in rows]),
+            'middleware_overhead': self.toolbar.overhead,
+        })
+        return render_to_string(self.template, context)
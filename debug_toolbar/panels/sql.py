@@ -1,7 +1,12 @@
+import heapq
+import random
 import re
+import threading
 import uuid
+from decimal import Decimal
 
 from django.db.backends import BaseDatabaseWrapper
+from django.utils.encoding import force_unicode
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _, ungettext_lazy as __
@@ -11,6 +16,11 @@ from debug_toolbar.utils.compat.db import connections
 from debug_toolbar.middleware import DebugToolbarMiddleware
 from debug_toolbar.panels import DebugPanel
 from debug_toolbar.utils import sqlparse
+from debug_toolbar.utils.explain import get_cached_plan, get_explain_pool
+from debug_toolbar.utils.indexes import advise
+from debug_toolbar.utils.nplusone import describe_relation, find_n_plus_one, \
+    get_source_lines
+from debug_toolbar.utils.stacks import StackTable
 from debug_toolbar.utils.tracking.db import CursorWrapper
 from debug_toolbar.utils.tracking import replace_call
 
@@ -20,12 +30,8 @@ COLLAPSED_FIELDS_HTML = '''
 <span class="djDebugCollapsed">%s</span>
 '''.strip()
 
-ANONYMIZE_QUERY_REPLACEMENTS = (
-    (re.compile('\s+'), ' '),
-    (re.compile('(\s+LIMIT|OFFSET)\s+\d+', re.IGNORECASE), r'\g<1> %d'),
-    (re.compile('(\s+IN\s*)\([^)]+\)', re.IGNORECASE), r'\g<1>(%s)'),
-    (re.compile('(SELECT )(.+?)( FROM)', re.IGNORECASE), r'\g<1>...\g<3>'),
-)
+_format_cache = None
+_format_cache_lock = threading.Lock()
 
 
 def _get_setting(key, default=None):
@@ -105,7 +111,19 @@ class SQLDebugPanel(DebugPanel):
         self._transaction_status = {}
         self._transaction_ids = {}
         self._seen = {}
-
+        # The stack traces of the queries
+        self.stacks = StackTable()
+        # Beyond the first queries, only the slowest are kept in detail, see
+        # ``_record_overflow``
+        self._max_queries = _get_setting('SQL_MAX_QUERIES', 1000)
+        self._max_params_bytes = _get_setting('SQL_MAX_PARAMS_BYTES', 4096)
+        self._slow_queries = []
+        self._overflow_count = 0
+        self._aggregates = {}
+        # The duplicates of queries folded into the aggregates are only
+        # counted by hash when they're grouped by parameters
+        self._aggregate_hashes = bool(_get_setting('SQL_DUPLICATES') and
+            _get_setting('SQL_DUPE_PARAMS'))
 
     def get_transaction_id(self, alias):
         conn = connections[alias].connection
@@ -133,19 +151,50 @@ class SQLDebugPanel(DebugPanel):
 
         return self._transaction_ids[alias]
 
-    def record(self, alias, **kwargs):
-        self._queries.append((alias, kwargs))
+    def record(self, query):
+        '''
+        Records ``query``, a ``QueryRecord``.
+        '''
+        alias = query.alias
+        duration = query.duration
+        query.limit_params(self._max_params_bytes)
+        if self._max_queries is None or len(self._queries) < self._max_queries:
+            self._queries.append((alias, query))
+        else:
+            self._record_overflow(query)
         if alias not in self._databases:
             self._databases[alias] = {
-                'time_spent': kwargs['duration'],
+                'time_spent': duration,
                 'num_queries': 1,
             }
         else:
-            self._databases[alias]['time_spent'] += kwargs['duration']
+            self._databases[alias]['time_spent'] += duration
             self._databases[alias]['num_queries'] += 1
-        self._sql_time += kwargs['duration']
+        self._sql_time += duration
         self._num_queries += 1
 
+    def _record_overflow(self, query):
+        '''
+        Records a query beyond the first ``SQL_MAX_QUERIES``. Only the slowest
+        ``SQL_MAX_QUERIES`` of those are kept in detail, the others are folded
+        into the aggregates of their fingerprint, by call site (and by hash
+        with ``SQL_DUPE_PARAMS``) for the N+1 patterns and the duplicates.
+        '''
+        self._overflow_count += 1
+        item = (query.duration, self._overflow_count, query)
+        if len(self._slow_queries) < self._max_queries:
+            heapq.heappush(self._slow_queries, item)
+            return
+        duration, n, query = heapq.heappushpop(self._slow_queries, item)
+        aggregate = self._aggregates.get(query.fingerprint)
+        if aggregate is None:
+            aggregate = self._aggregates[query.fingerprint] = \
+                QueryAggregate(query.alias, query.fingerprint, query.raw_sql)
+        stack = query.stacktrace
+        aggregate.add(duration, stack and stack.call_site() or None,
+            query.template_info,
+            self._aggregate_hashes and query['hash'] or None)
+
     def nav_title(self):
         from balancer.mixins import PinningMixin
         pinned = PinningMixin.is_pinned()
@@ -179,7 +228,16 @@ class SQLDebugPanel(DebugPanel):
         return ''
 
     def process_response(self, request, response):
-        tables = set()
+        if self._slow_queries:
+            # In the order they were run, after the first queries
+            self._slow_queries.sort(key=lambda item: item[1])
+            self._queries.extend([(query.alias, query)
+                for d, n, query in self._slow_queries])
+            self._slow_queries = []
+        aggregates = [a.get_stats() for a in self._aggregates.itervalues()]
+        aggregates.sort(key=lambda a: -a['time'])
+
+        n_plus_one = self._get_n_plus_one()
         if self._queries:
             width_ratio_tally = 0
             factor = int(256.0/(len(self._databases)*2.5))
@@ -222,9 +280,6 @@ class SQLDebugPanel(DebugPanel):
                 if 'trans_status' in query:
                     query['trans_status'] = get_transaction_status_display(
                         query['engine'], query['trans_status'])
-                query['tables'] = set()
-                query['sql'] = reformat_sql(query['sql'], query['tables'])
-                tables |= query['tables']
                 query['rgb_color'] = self._databases[alias]['rgb_color']
                 try:
                     query['width_ratio'] = (query['duration'] /
@@ -238,36 +293,13 @@ class SQLDebugPanel(DebugPanel):
                 query['end_offset'] = (query['width_ratio']
                     + query['start_offset'])
                 width_ratio_tally += query['width_ratio']
-
-                stacktrace = []
-                for frame in query['stacktrace']:
-                    params = map(
-                        escape,
-                        frame[0].rsplit('/', 1) + list(frame[1:]))
-                    try:
-                        stacktrace.append(u'<span class="path">{0}/</span>'
-                            '<span class="file">{1}</span> in '
-                            '<span class="func">{3}</span>('
-                            '<span class="lineno">{2}</span>)\n  '
-                            '<span class="code">{4}</span>'.format(*params)
-                        )
-                    except IndexError:
-                        stacktrace.append(u'<span class="path">{0}/</span>'
-                            '<span class="file">{1}</span> in '
-                            '<span class="func">{3}</span>('
-                            '<span class="lineno">{2}</span>)\n  '
-                            '<span class="code">Couldnt find the code</span>'
-                            .format(*params)
-                        )
-                        # This frame doesn't have the expected format, so
-                        # skip it and move on to the next one
-                        continue
-                query['stacktrace'] = mark_safe('\n'.join(stacktrace))
                 i += 1
 
             if trans_id:
                 self._queries[i-1][1]['ends_trans'] = True
 
+        self._defer_explain()
+
         # Should we check for duplicate queries?
         dupe_queries = None
         if _get_setting('SQL_DUPLICATES'):
@@ -280,61 +312,152 @@ class SQLDebugPanel(DebugPanel):
             ),
             'queries': [q for a, q in self._queries],
             'dupe_queries': dupe_queries,
+            'n_plus_one': n_plus_one,
+            'aggregates': aggregates,
             'sql_time': self._sql_time,
-            'tables': tables,
         })
 
-    @classmethod
-    def _anonymize_query(cls, sql):
-        for search, replace in ANONYMIZE_QUERY_REPLACEMENTS:
-            sql = search.sub(replace, sql)
-        return sql
-
-    def _get_dupe_queries(self):
-        ''' Returns information about duplicate queries.
-
-            Builds the _seen dict, which describes duplicate queries:
-
-            _seen = {'<some query>': {'time': 0.123,
-                                       'queries': [q1, q2, q3]}
-            }
+    def content(self):
+        self.format_queries()
+        return super(SQLDebugPanel, self).content()
 
-            ... where time is the total time taken to execute all iterations
-            of this query, and queries is a list of query objects that used
-            this query.
+    def format_queries(self):
+        '''
+        Adds the formatted SQL, the tables used and the rendered stack trace
+        to the recorded queries. This is left until the content of the panel
+        is rendered, and statements that were formatted before come from the
+        format cache.
+        '''
+        stats = self.get_stats()
+        cache = get_format_cache()
+        tables = set()
+        for query in stats.get('queries') or ():
+            if 'formatted_sql' not in query:
+                query['formatted_sql'], query['tables'] = format_query(cache,
+                    query)
+            tables |= query['tables']
+            if 'stacktrace_html' not in query:
+                query['stacktrace_html'] = query['stacktrace'] and \
+                    mark_safe(query['stacktrace'].html()) or ''
+        for data in stats.get('dupe_queries') or ():
+            if 'formatted_sql' not in data and data['queries']:
+                data['formatted_sql'], data['tables'] = format_query(cache,
+                    data['queries'][0])
+            elif 'formatted_sql' not in data:
+                data['formatted_sql'], data['tables'] = cache.format(data['sql'])
+        for data in stats.get('aggregates') or ():
+            if 'formatted_sql' not in data:
+                data['formatted_sql'], data['tables'] = cache.format(data['sql'])
+        stats['tables'] = tables
+        stats['format_cache'] = cache.get_stats()
+        pool = get_explain_pool()
+        if pool is not None:
+            for i, query in enumerate(stats.get('queries') or ()):
+                if query['is_slow'] and 'plan' not in query:
+                    query['plan'] = plan = pool.cache.get(
+                        (query['alias'], query['fingerprint']))
+                    if plan and plan['tree']:
+                        query['plan_nodes'] = plan['tree'].flatten(
+                            'plan_%d' % i)
+        if 'index_advice' not in stats:
+            stats['index_advice'] = advise(stats.get('queries') or (),
+                get_cached_plan)
+
+    def _defer_explain(self):
+        '''
+        Schedules the slow ``SELECT`` statements to be explained once the
+        request has finished, see ``ExplainPool``.
+        '''
+        pool = get_explain_pool()
+        if pool is None:
+            return
+        for alias, query in self._queries:
+            # The parameters of a query are let go of when they're too big
+            if query['is_slow'] and query['is_select'] and \
+                    query['kind'] == 'execute' and query.raw_params is not None:
+                pool.defer(alias, query['fingerprint'], query['raw_sql'],
+                    query.raw_params)
 
-            The original query object is modifed - a boolean 'duplicate'
-            value is set, depending on whether or not this is a dupe query.
+    def _get_n_plus_one(self):
         '''
-        # Should we be looking at sql or raw_sql?
-        # If sql, the params are included when checking for dupes. If
-        # raw_sql, params are ignored when checking for dupes.
-        if _get_setting('SQL_DUPE_PARAMS'):
-            # This is a tiny bit hacky. Only 'raw_sql' needs to be passed
-            # to reformat_sql, so here's a lambda funcion that just
-            # returns the query so we can use the same code for both
-            # sql/raw_sql.
-            func = lambda query: query
-            sql_attr = 'sql'
-        else:
-            func = reformat_sql
-            sql_attr = 'raw_sql'
+        Returns the N+1 patterns, see ``find_n_plus_one``, with the tables,
+        model and relation of each. Only the statement of each pattern is
+        formatted to find its tables.
+        '''
+        patterns = find_n_plus_one(self._queries,
+            _get_setting('SQL_N_PLUS_ONE_THRESHOLD', 5),
+            self._aggregates.itervalues())
+        for pattern in patterns:
+            html, tables = get_format_cache().format(pattern['sql'])
+            pattern['formatted_sql'] = html
+            pattern['tables'] = sorted(tables)
+            pattern['model'], pattern['relation'], \
+                pattern['relation_candidates'] = describe_relation(
+                    pattern['sql'], tables, get_source_lines(pattern))
+        return patterns
 
+    def _get_dupe_queries(self):
+        '''
+        Groups the queries by fingerprint, or with ``SQL_DUPE_PARAMS`` by
+        statement and parameters, and returns the groups, the most costly
+        first. Each group is a dict:
+
+            {'key': '<fingerprint>',
+             'sql': '<the statement of the first query>',
+             'alias': 'default',
+             'time': 0.123,
+             'count': 4,
+             'queries': [q1, q2, q3]}
+
+        ... where time and count are the total time taken by the queries of
+        the group and their number, including those only counted in the
+        aggregates, and queries are those recorded in detail.
+
+        The groups are kept in ``_seen`` by key, and the key of its group is
+        set on each query as ``group``.
+        '''
+        dupe_params = _get_setting('SQL_DUPE_PARAMS')
         for alias, query in self._queries:
-            sql = func(self._anonymize_query(query[sql_attr]))
-            query['unique_hash'] = hash(sql)
-            # Add this query to the list of occurrances for this query.
-            data = self._seen.get(sql, {
-                'time': 0,
-                'queries': [],
-                'unique_hash': hash(sql),
-                'tables': query['tables'],
-                'alias': query['alias'],
-            })
+            if dupe_params:
+                # The hash covers the statement and its parameters
+                key, sql = query['hash'], query['sql']
+            else:
+                key, sql = query['fingerprint'], query['raw_sql']
+            query['group'] = key
+            data = self._seen.get(key)
+            if data is None:
+                data = self._seen[key] = {
+                    'key': key,
+                    'sql': sql,
+                    'alias': alias,
+                    'time': 0,
+                    'count': 0,
+                    'queries': [],
+                }
             data['queries'].append(query)
             data['time'] += query['duration']
-            self._seen[sql] = data
-        return self._seen
+            data['count'] += 1
+        for aggregate in self._aggregates.itervalues():
+            if dupe_params:
+                groups = aggregate.hashes.iteritems()
+            else:
+                groups = [(aggregate.fingerprint,
+                    (aggregate.count, aggregate.time))]
+            for key, (count, time) in groups:
+                data = self._seen.get(key)
+                if data is None:
+                    data = self._seen[key] = {
+                        'key': key,
+                        'sql': aggregate.sql,
+                        'alias': aggregate.alias,
+                        'time': 0,
+                        'count': 0,
+                        'queries': [],
+                    }
+                data['time'] += time
+                data['count'] += count
+        return sorted(self._seen.itervalues(),
+            key=lambda data: (-data['time'], -data['count']))
 
 
 class TableCollectionFilter(sqlparse.filters.Filter):
@@ -429,3 +552,221 @@ def reformat_sql(sql, tables=None, expand=True):
         sql = swap_fields(sql).replace('...', '&bull;'*3)
     return sql
 
+
+
+class QueryAggregate(object):
+    '''
+    The figures of the queries of a fingerprint that weren't recorded in
+    detail. The 95th percentile is estimated from a uniform sample of at most
+    ``sample_size`` durations.
+
+    The count and time are also kept by call site, with the template info of
+    the first query from it, in ``call_sites``, and by hash, when it's given,
+    in ``hashes``.
+    '''
+    sample_size = 200
+
+    def __init__(self, alias, fingerprint, sql):
+        self.alias = alias
+        self.fingerprint = fingerprint
+        self.sql = sql
+        self.count = 0
+        self.time = 0
+        self.min = None
+        self.max = None
+        self.sample = []
+        self.call_sites = {}
+        self.hashes = {}
+
+    def add(self, duration, call_site=None, template_info=None, hash=None):
+        self.count += 1
+        self.time += duration
+        figures = self.call_sites.get(call_site)
+        if figures is None:
+            figures = self.call_sites[call_site] = [0, 0, template_info]
+        figures[0] += 1
+        figures[1] += duration
+        if hash is not None:
+            figures = self.hashes.setdefault(hash, [0, 0])
+            figures[0] += 1
+            figures[1] += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        # Reservoir sampling, each duration ends up in the sample with the
+        # same probability
+        if len(self.sample) < self.sample_size:
+            self.sample.append(duration)
+        else:
+            i = random.randrange(self.count)
+            if i < self.sample_size:
+                self.sample[i] = duration
+
+    def percentile(self, fraction):
+        if not self.sample:
+            return None
+        sample = sorted(self.sample)
+        return sample[min(len(sample) - 1, int(len(sample) * fraction))]
+
+    def get_stats(self):
+        return {
+            'alias': self.alias,
+            'fingerprint': self.fingerprint,
+            'sql': self.sql,
+            'count': self.count,
+            'time': self.time,
+            'min': self.min,
+            'max': self.max,
+            'p95': self.percentile(0.95),
+        }
+
+
+# The placeholders of the parameters of a statement, and the names they're
+# formatted as by ``SQLFormatCache.format_statement``
+PLACEHOLDER_RE = re.compile(r'%%|%s')
+PARAM_NAME_RE = re.compile(r'djdtparam(\d+)')
+
+
+def sql_literal(value):
+    '''
+    Returns ``value``, a parameter of a statement, as an SQL literal.
+    '''
+    if value is None:
+        return u'NULL'
+    if isinstance(value, (bool, int, long, float, Decimal)):
+        return unicode(value)
+    return u"'%s'" % force_unicode(value, errors='replace').replace(u"'", u"''")
+
+
+def format_query(cache, query):
+    '''
+    Returns the formatted HTML of ``query``, a ``QueryRecord``, and the tables
+    it uses, see ``SQLFormatCache.format_statement``. The statements of
+    procedures and those whose parameters were cut are formatted as they are.
+    '''
+    if query['kind'] != 'callproc' and query.raw_params is not None and \
+            not query['params_truncated']:
+        formatted = cache.format_statement(query['raw_sql'], query.raw_params)
+        if formatted is not None:
+            return formatted
+    return cache.format(query['sql'])
+
+
+class SQLFormatCache(object):
+    '''
+    A bounded cache of the output of ``reformat_sql``, keyed by the text of
+    the statement. It's shared by all requests, as most statements are run
+    over and over again. Statements are formatted without their parameters
+    (see ``format_statement``), so that they share an entry whatever the
+    values they're run with.
+
+    Once it holds more than ``max_entries`` statements, the least recently
+    used quarter of them is evicted at once, so that a lookup never has to
+    reorder the entries.
+    '''
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # sql -> [html, tables, last use]
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def format(self, sql):
+        '''
+        Returns the formatted HTML of ``sql`` and a frozenset of the tables it
+        uses.
+        '''
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            entry = self._entries.get(sql)
+            if entry is not None:
+                self.hits += 1
+                entry[2] = self._clock
+                return entry[0], entry[1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        # Formatting is slow, so it's done without holding the lock
+        tables = set()
+        html = reformat_sql(sql, tables)
+        tables = frozenset(tables)
+
+        self._lock.acquire()
+        try:
+            self._entries[sql] = [html, tables, self._clock]
+            if len(self._entries) > self.max_entries:
+                self._evict()
+        finally:
+            self._lock.release()
+        return html, tables
+
+    def format_statement(self, sql, params):
+        '''
+        Returns the formatted HTML of ``sql`` with the sequence ``params`` in
+        place of its placeholders, and a frozenset of the tables it uses.
+        The statement is formatted with a name in place of each placeholder,
+        which is then replaced by the parameter. Returns None when the
+        parameters don't match the placeholders.
+        '''
+        if not isinstance(params, (list, tuple)):
+            return None
+        count = [0]
+        def name(match):
+            if match.group() == '%%':
+                return '%'
+            count[0] += 1
+            return 'djdtparam%d' % (count[0] - 1)
+        statement = PLACEHOLDER_RE.sub(name, sql)
+        if count[0] != len(params) or PARAM_NAME_RE.search(sql):
+            return None
+        html, tables = self.format(statement)
+        literals = [escape(sql_literal(param)) for param in params]
+        html = PARAM_NAME_RE.sub(lambda m: literals[int(m.group(1))], html)
+        return html, tables
+
+    def _evict(self):
+        entries = sorted(self._entries.iteritems(), key=lambda e: e[1][2])
+        count = len(entries) - self.max_entries * 3 // 4
+        for sql, entry in entries[:count]:
+            del self._entries[sql]
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+        }
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+
+
+def get_format_cache():
+    '''
+    Returns the format cache of this process, creating it the first time with
+    ``SQL_FORMAT_CACHE_SIZE`` entries.
+    '''
+    global _format_cache
+    if _format_cache is None:
+        _format_cache_lock.acquire()
+        try:
+            if _format_cache is None:
+                _format_cache = SQLFormatCache(
+                    _get_setting('SQL_FORMAT_CACHE_SIZE', 1000))
+        finally:
+            _format_cache_lock.release()
+    return _format_cache
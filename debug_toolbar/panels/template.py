@@ -1,3 +1,4 @@
+import time
 from os.path import normpath
 from pprint import pformat
 
@@ -9,36 +10,59 @@ from django.test.signals import template_rendered
 from django.utils.translation import ugettext_lazy as _
 from django.db.models.query import QuerySet
 from debug_toolbar.panels import DebugPanel
+from debug_toolbar.utils import timer
 from debug_toolbar.utils.tracking.db import recording, SQLQueryTriggered
 
 # Code taken and adapted from Simon Willison and Django Snippets:
 # http://www.djangosnippets.org/snippets/766/
 
-# Monkeypatch instrumented test renderer from django.test.utils - we could use
+# Monkeypatch the template renderer to send the template_rendered signal, like
+# the instrumented test renderer from django.test.utils does - we could use
 # django.test.utils.setup_test_environment for this but that would also set up
-# e-mail interception, which we don't want
+# e-mail interception, which we don't want. The instrumented test renderer is
+# left alone when the test environment already installed it.
 from django.test.utils import instrumented_test_render
 from django.template import Template
 from django.dispatch import Signal
 
 get_template = Signal(providing_args=['template'])
 
+def timed_test_render(self, context):
+    """
+    Sends the ``template_rendered`` signal and renders the template, like
+    ``instrumented_test_render``. The signal is sent with a ``timing`` list
+    that is filled with the ``timer()`` readings before and after rendering.
+    """
+    timing = [None, None]
+    template_rendered.send(sender=self, template=self, context=context,
+        timing=timing)
+    timing[0] = timer()
+    try:
+        return self.nodelist.render(context)
+    finally:
+        timing[1] = timer()
+
 if not hasattr(Template, '_render'): # Django < 1.2
-    if Template.render != instrumented_test_render:
+    if Template.render not in (instrumented_test_render, timed_test_render):
         Template.original_render = Template.render
-        Template.render = instrumented_test_render
+        Template.render = timed_test_render
 else:
-    if Template._render != instrumented_test_render:
+    if Template._render not in (instrumented_test_render, timed_test_render):
         Template.original_render = Template._render
-        Template._render = instrumented_test_render
+        Template._render = timed_test_render
 
 
 # Monkey patch coffin's render function to send template_rendered signal
 def new_render(func):
     def render(self, context=None):
+        timing = [None, None]
         template_rendered.send(sender=self, template=self,
-            context=context)
-        return func(self, context)
+            context=context, timing=timing)
+        timing[0] = timer()
+        try:
+            return func(self, context)
+        finally:
+            timing[1] = timer()
     return render
 
 def track(f, name):
@@ -97,6 +121,13 @@ class TemplateDebugPanel(DebugPanel):
         self.context = None
     
     def _store_template_info(self, sender, **kwargs):
+        start = time.time()
+        try:
+            self._record_template_info(sender, **kwargs)
+        finally:
+            self.add_tracking_time((time.time() - start) * 1000)
+
+    def _record_template_info(self, sender, **kwargs):
         t = kwargs.get('template')
         if t:
             name = t.name
@@ -0,0 +1,182 @@
+from django.utils.translation import ugettext_lazy as _
+from debug_toolbar.panels import DebugPanel
+from debug_toolbar.utils import timer
+
+# Spans that block on a database or a cache server, the time between them is
+# spent in Python
+IO_KINDS = ('sql', 'cache')
+
+# Consecutive I/O spans less than SERIAL_GAP ms apart are issued back to back;
+# a run of at least SERIAL_RUN of them could probably be batched or made in
+# parallel
+SERIAL_GAP = 1.0
+SERIAL_RUN = 3
+
+# Labels are cut to this many characters
+LABEL_LENGTH = 80
+
+
+def shorten(label):
+    label = u' '.join(unicode(label).split())
+    if len(label) > LABEL_LENGTH:
+        return label[:LABEL_LENGTH - 3] + u'...'
+    return label
+
+
+class TimelineDebugPanel(DebugPanel):
+    """
+    Panel that shows the queries, cache calls, template renders and log
+    records of the request on a single waterfall, on the ``timer()`` clock
+    from the start of the request. It should come after the panels it reads
+    from.
+    """
+    name = 'Timeline'
+    template = 'debug_toolbar/panels/timeline.html'
+    has_content = True
+
+    def nav_title(self):
+        return _('Timeline')
+
+    def nav_subtitle(self):
+        stats = self.get_stats()
+        if 'python_time' not in stats:
+            return ''
+        return 'Python: %0.2fms (%0.2fms)' % (stats['python_time'],
+            stats['total_time'])
+
+    def title(self):
+        return _('Timeline')
+
+    def url(self):
+        return ''
+
+    def get_panel(self, name):
+        """
+        Returns the panel of the toolbar called ``name``, or None. Panels are
+        looked up by name so that those that aren't installed aren't imported.
+        """
+        for panel in self.toolbar.panels:
+            if panel.name == name:
+                return panel
+        return None
+
+    def get_sql_spans(self):
+        panel = self.get_panel('SQL')
+        if panel is None:
+            return []
+        return [('sql', shorten(query.raw_sql), query.start, query.stop)
+            for alias, query in panel._queries]
+
+    def get_cache_spans(self):
+        panel = self.get_panel('Cache')
+        if panel is None:
+            return []
+        spans = []
+        for call in panel.cache.stats['calls']:
+            if len(call) > 4:
+                label = u'%s %s' % (call[1], call[2] and call[2][0] or '')
+                spans.append(('cache', shorten(label), call[4], call[5]))
+        return spans
+
+    def get_template_spans(self):
+        panel = self.get_panel('Template')
+        if panel is None:
+            return []
+        spans = []
+        for template_data in panel.templates:
+            # Templates rendered with Django's own instrumented renderer
+            # aren't timed
+            timing = template_data.get('timing')
+            if not timing or timing[1] is None:
+                continue
+            if 'template' in template_data:
+                name = template_data['template'].name
+            else:
+                name = template_data['filename']
+            spans.append(('template', shorten(name), timing[0], timing[1]))
+        return spans
+
+    def get_log_spans(self):
+        panel = self.get_panel('Logging')
+        if panel is None:
+            return []
+        records = panel.get_stats().get('records', [])
+        return [('log', shorten(u'%s: %s' % (record['level'],
+            record['message'])), record['timer'], record['timer'])
+            for record in records if 'timer' in record]
+
+    def get_spans(self):
+        """
+        Returns the spans of the other panels as ``(kind, label, start,
+        stop)`` tuples of ``timer()`` readings, sorted by start.
+        """
+        spans = (self.get_sql_spans() + self.get_cache_spans() +
+            self.get_template_spans() + self.get_log_spans())
+        spans.sort(key=lambda span: (span[2], -span[3]))
+        return spans
+
+    def process_request(self, request):
+        self._start_time = timer()
+
+    def process_response(self, request, response):
+        stop_time = timer()
+        spans = self.get_spans()
+        start_time = self._start_time
+        if spans:
+            start_time = min(start_time, spans[0][2])
+        total_time = (stop_time - start_time) * 1000
+
+        rows = []
+        runs = []
+        run = None
+        io_time = 0
+        io_end = start_time
+        # End times of the templates being rendered around the current span
+        templates = []
+        for kind, label, start, stop in spans:
+            while templates and templates[-1] <= start:
+                templates.pop()
+            row = {
+                'kind': kind,
+                'label': label,
+                'start': (start - start_time) * 1000,
+                'duration': (stop - start) * 1000,
+                'depth': len(templates),
+                'io': kind in IO_KINDS,
+                'gap': None,
+            }
+            if kind == 'template':
+                templates.append(stop)
+            elif row['io']:
+                # Python time since the end of the previous I/O span, spans
+                # that overlap it (from other threads) only count for the
+                # part that doesn't
+                gap = (start - io_end) * 1000
+                row['gap'] = max(gap, 0)
+                io_time += max(stop - max(start, io_end), 0) * 1000
+                if run is not None and gap < SERIAL_GAP:
+                    run['count'] += 1
+                    run['time'] = (stop - start_time) * 1000 - run['start']
+                else:
+                    run = {'start': row['start'], 'count': 1,
+                        'time': row['duration']}
+                    runs.append(run)
+                io_end = max(io_end, stop)
+            if total_time:
+                row['left'] = 100.0 * row['start'] / total_time
+                row['width'] = 100.0 * row['duration'] / total_time
+            else:
+                row['left'] = row['width'] = 0
+            rows.append(row)
+
+        gaps = [row['gap'] for row in rows if row['gap'] is not None]
+        # The time after the last I/O span counts as well
+        gaps.append((stop_time - io_end) * 1000)
+        self.record_stats({
+            'spans': rows,
+            'runs': [r for r in runs if r['count'] >= SERIAL_RUN],
+            'total_time': total_time,
+            'io_time': io_time,
+            'python_time': total_time - io_time,
+            'max_gap': max(gaps),
+        })
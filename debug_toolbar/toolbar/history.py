@@ -0,0 +1,538 @@
+"""
+The request history: a bounded store of the toolbars of recent requests.
+
+Which backend is used is set by the ``HISTORY_BACKEND`` option. The
+in-process backend keeps the toolbars themselves so their panels can still be
+rendered on demand. The file and SQLite backends keep a snapshot instead (the
+fully rendered toolbar and the panel stats as JSON), which survives restarts
+and is shared between processes.
+
+Every backend holds at most ``RESULTS_STORE_SIZE`` requests and about
+``RESULTS_STORE_BYTES`` bytes, evicting the least recently used requests first.
+The size of a request kept in memory is estimated from its queries (see
+``estimate_size``), as serializing it would work out every value its panels
+leave until they're displayed. For the backends that keep a snapshot, it's
+the size of the stats as JSON plus the rendered toolbar.
+
+The snapshots of the requests the middleware handles are only written once
+the request has finished (see ``defer``), so that serializing and writing
+them doesn't hold up the response.
+"""
+import datetime
+import os
+import re
+import sqlite3
+import thread
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core import exceptions
+from django.core.signals import request_finished
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import force_unicode
+from django.utils.importlib import import_module
+
+
+DEFAULT_CONFIG = {
+    'HISTORY_BACKEND': 'debug_toolbar.toolbar.history.MemoryHistoryStore',
+    'HISTORY_PATH': None,
+    'RESULTS_STORE_SIZE': 10,
+    'RESULTS_STORE_BYTES': 32 * 1024 * 1024,
+}
+
+# The estimated size of a request kept in memory, and of each of its queries
+# besides its statement
+REQUEST_SIZE = 16 * 1024
+QUERY_SIZE = 1024
+
+# The ids requests are stored under, see ``uuid.uuid4().hex``
+STORE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class StatsEncoder(simplejson.JSONEncoder):
+    """
+    Encodes panel stats, which may hold arbitrary objects, falling back to
+    their text representation.
+    """
+    def default(self, o):
+        if hasattr(o, 'to_dict'):
+            return o.to_dict()
+        if isinstance(o, (set, frozenset)):
+            return list(o)
+        if isinstance(o, (datetime.date, datetime.time)):
+            return o.isoformat()
+        try:
+            return force_unicode(o)
+        except Exception:
+            return repr(o)
+
+
+def dump_stats(stats):
+    return simplejson.dumps(stats, cls=StatsEncoder, skipkeys=True)
+
+
+def is_store_id(store_id):
+    """
+    Tells whether ``store_id``, which may come from a URL, has the form of
+    the ids requests are stored under, so it can be used in a file name.
+    """
+    return bool(store_id and STORE_ID_RE.match(store_id))
+
+
+def estimate_size(toolbar):
+    """
+    Returns a rough number of bytes ``toolbar`` takes up in memory, from the
+    number of queries it recorded and the length of their statements.
+    """
+    size = REQUEST_SIZE
+    for query in toolbar.stats.get('sql', {}).get('queries') or ():
+        if isinstance(query, dict):
+            sql = query.get('sql')
+        else:
+            sql = getattr(query, 'raw_sql', None)
+        size += QUERY_SIZE + len(sql or '')
+    return size
+
+
+def get_summary(toolbar):
+    """
+    Returns the figures shown for a request in the history list.
+    """
+    sql = toolbar.stats.get('sql', {})
+    return {
+        'query_count': len(sql.get('queries') or ()),
+        'sql_time': sql.get('sql_time', 0),
+        'n_plus_one': len(sql.get('n_plus_one') or ()),
+        'total_time': toolbar.stats.get('timer', {}).get('total_time', 0),
+    }
+
+
+class HistoryRecord(object):
+    """
+    A request in the history. ``toolbar`` is only set by backends that keep
+    the toolbar itself, the others set ``html`` and ``stats`` instead.
+    """
+    def __init__(self, store_id, method, path, created, summary, size,
+                 toolbar=None, html=None, stats=None):
+        self.store_id = store_id
+        self.method = method
+        self.path = path
+        self.created = created
+        self.summary = summary
+        self.size = size
+        self.toolbar = toolbar
+        self.html = html
+        self.stats = stats
+
+    @property
+    def created_datetime(self):
+        return datetime.datetime.fromtimestamp(self.created)
+
+    def render_toolbar(self):
+        if self.toolbar is not None:
+            return self.toolbar.render_toolbar()
+        return self.html
+
+    def stats_json(self):
+        if self.toolbar is not None:
+            return dump_stats(self.toolbar.stats)
+        return self.stats
+
+    def get_queries(self):
+        """
+        Returns the queries the SQL panel recorded for the request, as dicts.
+        """
+        if self.toolbar is not None:
+            stats = self.toolbar.stats
+        else:
+            try:
+                stats = simplejson.loads(self.stats)
+            except (TypeError, ValueError):
+                return []
+        return stats.get('sql', {}).get('queries') or []
+
+
+class BaseHistoryStore(object):
+    """
+    Base class for the history backends. Subclasses implement ``_add``,
+    ``get``, ``list`` and ``clear``.
+    """
+    # Whether the records hold the toolbars themselves
+    keeps_toolbars = False
+
+    def __init__(self, max_entries=10, max_bytes=None, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.path = path
+        # thread ident -> [(store_id, toolbar or record)], see ``defer``
+        self._deferred = {}
+        self._deferred_lock = threading.Lock()
+
+    def add(self, toolbar, store_id=None):
+        """
+        Stores ``toolbar`` under ``store_id`` or a new id, which is returned.
+        The backends that keep a snapshot reuse the toolbar the middleware
+        rendered with all its panels (``toolbar.html``), or render it.
+        """
+        store_id = store_id or uuid.uuid4().hex
+        request = toolbar.request
+        if self.keeps_toolbars:
+            record = HistoryRecord(store_id, request.method, request.get_full_path(),
+                time.time(), get_summary(toolbar), estimate_size(toolbar),
+                toolbar=toolbar)
+        else:
+            stats = dump_stats(toolbar.stats)
+            html = getattr(toolbar, 'html', None) or \
+                toolbar.render_toolbar(render_panels=True)
+            record = HistoryRecord(store_id, request.method, request.get_full_path(),
+                time.time(), get_summary(toolbar), len(html) + len(stats),
+                html=html, stats=stats)
+        self._add(record)
+        return store_id
+
+    def _defer(self, store_id, item):
+        self._deferred_lock.acquire()
+        try:
+            self._deferred.setdefault(thread.get_ident(), []).append(
+                (store_id, item))
+        finally:
+            self._deferred_lock.release()
+
+    def _pop_deferred(self):
+        self._deferred_lock.acquire()
+        try:
+            return self._deferred.pop(thread.get_ident(), ())
+        finally:
+            self._deferred_lock.release()
+
+    def defer(self, toolbar):
+        """
+        Returns a new id under which ``toolbar`` will be stored by ``flush``,
+        once the current request has finished.
+        """
+        store_id = uuid.uuid4().hex
+        self._defer(store_id, toolbar)
+        return store_id
+
+    def flush(self):
+        """
+        Stores the toolbars the current thread deferred.
+        """
+        for store_id, toolbar in self._pop_deferred():
+            self.add(toolbar, store_id)
+
+    def is_full(self, count, size):
+        return count > self.max_entries or \
+            (self.max_bytes is not None and size > self.max_bytes)
+
+    def _add(self, record):
+        raise NotImplementedError
+
+    def get(self, store_id):
+        """
+        Returns the record stored under ``store_id``, or None.
+        """
+        raise NotImplementedError
+
+    def list(self):
+        """
+        Returns the records, most recently stored first.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryHistoryStore(BaseHistoryStore):
+    """
+    Keeps the toolbars in the memory of the current process.
+    """
+    keeps_toolbars = True
+
+    def __init__(self, *args, **kwargs):
+        super(MemoryHistoryStore, self).__init__(*args, **kwargs)
+        # Ordered from least to most recently used
+        self._records = SortedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def defer(self, toolbar):
+        """
+        Keeps ``toolbar`` right away, so that its panels can be rendered as
+        soon as the response has been sent. Nothing is serialized.
+        """
+        return self.add(toolbar)
+
+    def _add(self, record):
+        self._lock.acquire()
+        try:
+            self._records[record.store_id] = record
+            self._size += record.size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        while len(self._records) > 1 and \
+                self.is_full(len(self._records), self._size):
+            oldest = self._records.pop(self._records.keyOrder[0])
+            self._size -= oldest.size
+
+    def get(self, store_id):
+        self._lock.acquire()
+        try:
+            record = self._records.get(store_id)
+            if record is not None:
+                self._records.keyOrder.remove(store_id)
+                self._records.keyOrder.append(store_id)
+            return record
+        finally:
+            self._lock.release()
+
+    def list(self):
+        records = self._records.values()
+        records.sort(key=lambda r: r.created, reverse=True)
+        return records
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._records.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+
+class FileHistoryStore(BaseHistoryStore):
+    """
+    Keeps a snapshot of each request in a JSON file in the directory
+    ``HISTORY_PATH``. The modification time of a file is its last use.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FileHistoryStore, self).__init__(*args, **kwargs)
+        if not self.path:
+            raise exceptions.ImproperlyConfigured(
+                'The file history backend needs HISTORY_PATH to be set')
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _filename(self, store_id):
+        return os.path.join(self.path, '%s.json' % store_id)
+
+    def _entries(self):
+        """
+        Returns (mtime, size, store_id) for each stored request, least
+        recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            store_id, ext = os.path.splitext(name)
+            if ext != '.json':
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, store_id))
+        entries.sort()
+        return entries
+
+    def _load(self, store_id):
+        if not is_store_id(store_id):
+            return None
+        try:
+            f = open(self._filename(store_id), 'rb')
+        except IOError:
+            return None
+        try:
+            data = simplejson.load(f)
+        finally:
+            f.close()
+        return HistoryRecord(store_id, data['method'], data['path'],
+            data['created'], data['summary'], data['size'],
+            html=data['html'], stats=data['stats'])
+
+    def _add(self, record):
+        filename = self._filename(record.store_id)
+        tmp = '%s.tmp' % filename
+        f = open(tmp, 'wb')
+        try:
+            simplejson.dump({
+                'method': record.method,
+                'path': record.path,
+                'created': record.created,
+                'summary': record.summary,
+                'size': record.size,
+                'html': record.html,
+                'stats': record.stats,
+            }, f)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+        # Set the time explicitly, the file system's clock may be too coarse
+        # to order requests stored in quick succession
+        now = time.time()
+        os.utime(filename, (now, now))
+
+        entries = self._entries()
+        size = sum([e[1] for e in entries])
+        while len(entries) > 1 and self.is_full(len(entries), size):
+            mtime, entry_size, store_id = entries.pop(0)
+            size -= entry_size
+            try:
+                os.remove(self._filename(store_id))
+            except OSError:
+                pass
+
+    def get(self, store_id):
+        record = self._load(store_id)
+        if record is not None:
+            try:
+                now = time.time()
+                os.utime(self._filename(store_id), (now, now))
+            except OSError:
+                pass
+        return record
+
+    def list(self):
+        records = [self._load(store_id) for m, s, store_id in self._entries()]
+        records = [r for r in records if r is not None]
+        records.sort(key=lambda r: r.created, reverse=True)
+        return records
+
+    def clear(self):
+        for m, s, store_id in self._entries():
+            try:
+                os.remove(self._filename(store_id))
+            except OSError:
+                pass
+
+
+class SQLiteHistoryStore(BaseHistoryStore):
+    """
+    Keeps a snapshot of each request in the SQLite database ``HISTORY_PATH``.
+    """
+    def __init__(self, *args, **kwargs):
+        super(SQLiteHistoryStore, self).__init__(*args, **kwargs)
+        if not self.path:
+            raise exceptions.ImproperlyConfigured(
+                'The SQLite history backend needs HISTORY_PATH to be set')
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS djdt_history ('
+                'store_id TEXT PRIMARY KEY, method TEXT, path TEXT, '
+                'created REAL, used REAL, summary TEXT, size INTEGER, '
+                'html TEXT, stats TEXT)')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # A connection per call, sqlite3 connections can't be shared between
+        # threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _record(self, row):
+        store_id, method, path, created, summary, size, html, stats = row
+        return HistoryRecord(store_id, method, path, created,
+            simplejson.loads(summary), size, html=html, stats=stats)
+
+    def _add(self, record):
+        conn = self._connect()
+        try:
+            conn.execute('INSERT INTO djdt_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (record.store_id, record.method, record.path, record.created,
+                 time.time(), simplejson.dumps(record.summary), record.size,
+                 record.html, record.stats))
+            entries = conn.execute('SELECT store_id, size FROM djdt_history '
+                'ORDER BY used').fetchall()
+            size = sum([s for i, s in entries])
+            evicted = []
+            while len(entries) > 1 and self.is_full(len(entries), size):
+                store_id, entry_size = entries.pop(0)
+                size -= entry_size
+                evicted.append((store_id,))
+            conn.executemany('DELETE FROM djdt_history WHERE store_id = ?', evicted)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def get(self, store_id):
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT store_id, method, path, created, summary, '
+                'size, html, stats FROM djdt_history WHERE store_id = ?',
+                (store_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE djdt_history SET used = ? WHERE store_id = ?',
+                (time.time(), store_id))
+            conn.commit()
+            return self._record(row)
+        finally:
+            conn.close()
+
+    def list(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT store_id, method, path, created, summary, '
+                'size, NULL, NULL FROM djdt_history ORDER BY created DESC').fetchall()
+        finally:
+            conn.close()
+        return [self._record(row) for row in rows]
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM djdt_history')
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def load_history_store():
+    """
+    Instantiates the backend set by the ``HISTORY_BACKEND`` option.
+    """
+    config = DEFAULT_CONFIG.copy()
+    config.update(getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}))
+    path = config['HISTORY_BACKEND']
+    try:
+        dot = path.rindex('.')
+        module = import_module(path[:dot])
+        store_class = getattr(module, path[dot+1:])
+    except (ValueError, ImportError, AttributeError), e:
+        raise exceptions.ImproperlyConfigured(
+            'Error loading history backend %s: "%s"' % (path, e))
+    return store_class(max_entries=config['RESULTS_STORE_SIZE'],
+        max_bytes=config['RESULTS_STORE_BYTES'], path=config['HISTORY_PATH'])
+
+
+def get_history_store():
+    """
+    Returns the history store of this process, creating it the first time.
+    """
+    global _store
+    if _store is None:
+        _store_lock.acquire()
+        try:
+            if _store is None:
+                _store = load_history_store()
+        finally:
+            _store_lock.release()
+    return _store
+
+
+def _request_finished(sender, **kwargs):
+    if _store is not None:
+        _store.flush()
+
+request_finished.connect(_request_finished,
+    dispatch_uid='debug_toolbar.toolbar.history.request_finished')
@@ -1,22 +1,113 @@
 """
 The main DebugToolbar class that loads and renders the Toolbar.
 """
-import os.path, os
+import logging
+import threading
+import time
+import weakref
 
 from django.conf import settings
+from django.core import exceptions
 from django.template.loader import render_to_string
 from django.utils.datastructures import SortedDict
 from django.utils.safestring import mark_safe
 
+from debug_toolbar.panels import DebugPanel
+from debug_toolbar.toolbar.history import get_history_store, is_store_id
+from debug_toolbar.utils import media
+
+logger = logging.getLogger('debug_toolbar')
+
+# Override this tuple by copying to settings.py as `DEBUG_TOOLBAR_PANELS`
+DEFAULT_PANELS = (
+    'debug_toolbar.panels.version.VersionDebugPanel',
+    'debug_toolbar.panels.timer.TimerDebugPanel',
+    'debug_toolbar.panels.settings_vars.SettingsVarsDebugPanel',
+    'debug_toolbar.panels.headers.HeaderDebugPanel',
+    'debug_toolbar.panels.request_vars.RequestVarsDebugPanel',
+    'debug_toolbar.panels.sql.SQLDebugPanel',
+    'debug_toolbar.panels.template.TemplateDebugPanel',
+    #'debug_toolbar.panels.cache.CacheDebugPanel',
+    'debug_toolbar.panels.signals.SignalDebugPanel',
+    'debug_toolbar.panels.logger.LoggingPanel',
+    'debug_toolbar.panels.timeline.TimelineDebugPanel',
+    'debug_toolbar.panels.overhead.OverheadDebugPanel',
+)
+
+# Registry of the panel classes, resolved once per process by
+# ``load_panel_classes``
+panel_classes = []
+# (panel path, milliseconds it took to resolve) for each panel
+panel_load_times = []
+_panel_classes_lock = threading.Lock()
+
+def load_panel_class(panel_path):
+    """
+    Imports and validates the panel class at ``panel_path``.
+    """
+    try:
+        dot = panel_path.rindex('.')
+    except ValueError:
+        raise exceptions.ImproperlyConfigured, '%s isn\'t a debug panel module' % panel_path
+    panel_module, panel_classname = panel_path[:dot], panel_path[dot+1:]
+    try:
+        mod = __import__(panel_module, {}, {}, [''])
+    except ImportError, e:
+        raise exceptions.ImproperlyConfigured, 'Error importing debug panel %s: "%s"' % (panel_module, e)
+    try:
+        panel_class = getattr(mod, panel_classname)
+    except AttributeError:
+        raise exceptions.ImproperlyConfigured, 'Toolbar Panel module "%s" does not define a "%s" class' % (panel_module, panel_classname)
+    if not (isinstance(panel_class, type) and issubclass(panel_class, DebugPanel)):
+        raise exceptions.ImproperlyConfigured, 'Toolbar Panel "%s" is not a subclass of DebugPanel' % panel_path
+    return panel_class
+
+def load_panel_classes():
+    """
+    Populates the panel registry from ``DEBUG_TOOLBAR_PANELS``. The panels are
+    only resolved the first time this is called, later calls return the
+    registry as is.
+    """
+    if panel_classes:
+        return panel_classes
+    _panel_classes_lock.acquire()
+    try:
+        if panel_classes:
+            return panel_classes
+        # Check if settings has a DEBUG_TOOLBAR_PANELS, otherwise use default
+        panel_paths = getattr(settings, 'DEBUG_TOOLBAR_PANELS', DEFAULT_PANELS)
+        classes, load_times = [], []
+        for panel_path in panel_paths:
+            start = time.time()
+            panel_class = load_panel_class(panel_path)
+            load_time = (time.time() - start) * 1000
+            if panel_class not in classes:
+                classes.append(panel_class)
+            load_times.append((panel_path, load_time))
+            logger.debug('Loaded debug panel %s in %.2fms', panel_path, load_time)
+        panel_load_times[:] = load_times
+        panel_classes[:] = classes
+        logger.debug('Loaded %d debug panels in %.2fms', len(classes),
+            sum([t for p, t in load_times]))
+    finally:
+        _panel_classes_lock.release()
+    return panel_classes
+
 class DebugToolbar(object):
+    # All toolbars that are still referenced, to tell whether they leak
+    _live = weakref.WeakValueDictionary()
 
     def __init__(self, request):
         self.request = request
+        self.__class__._live[id(self)] = self
         self._panels = SortedDict()
         base_url = self.request.META.get('SCRIPT_NAME', '')
         self.config = {
+            'CAPTURE_HEADLESS': False,
             'INTERCEPT_REDIRECTS': True,
-            'MEDIA_URL': u'%s/__debug__/m/' % base_url
+            'MEDIA_URL': u'%s/__debug__/m/' % base_url,
+            'INLINE_MEDIA': False,
+            'RENDER_PANELS': True,
         }
         # Check if settings has a DEBUG_TOOLBAR_CONFIG and updated config
         self.config.update(getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}))
@@ -24,21 +115,23 @@ class DebugToolbar(object):
             'BASE_URL': base_url, # for backwards compatibility
             'DEBUG_TOOLBAR_MEDIA_URL': self.config.get('MEDIA_URL'),
         }
-        # Override this tuple by copying to settings.py as `DEBUG_TOOLBAR_PANELS`
-        self.default_panels = (
-            'debug_toolbar.panels.version.VersionDebugPanel',
-            'debug_toolbar.panels.timer.TimerDebugPanel',
-            'debug_toolbar.panels.settings_vars.SettingsVarsDebugPanel',
-            'debug_toolbar.panels.headers.HeaderDebugPanel',
-            'debug_toolbar.panels.request_vars.RequestVarsDebugPanel',
-            'debug_toolbar.panels.sql.SQLDebugPanel',
-            'debug_toolbar.panels.template.TemplateDebugPanel',
-            #'debug_toolbar.panels.cache.CacheDebugPanel',
-            'debug_toolbar.panels.signals.SignalDebugPanel',
-            'debug_toolbar.panels.logger.LoggingPanel',
-        )
+        self.store_id = None
+        # The toolbar rendered with all its panels, which the history reuses
+        self.html = None
+        # Time in ms spent in the toolbar's middleware hooks for this request
+        self.overhead = 0.0
         self.load_panels()
         self.stats = {}
+        # {panel class: {hook: ms}}, see ``record_timing``
+        self.timings = {}
+
+    @classmethod
+    def live_count(cls):
+        """
+        Returns the number of toolbars in memory. Besides the requests being
+        handled and the history, nothing should hold on to them.
+        """
+        return len(cls._live)
 
     def _get_panels(self):
         return self._panels.values()
@@ -47,60 +140,94 @@ class DebugToolbar(object):
     def get_panel(self, cls):
         return self._panels[cls]
 
-    def load_panels(self):
+    def get_panel_by_id(self, dom_id):
+        for panel in self.panels:
+            if panel.dom_id() == dom_id:
+                return panel
+        return None
+
+    def run_hook(self, hook, *args):
         """
-        Populate debug panels
+        Calls the method ``hook`` of every panel, timing each call.
         """
-        from django.conf import settings
-        from django.core import exceptions
+        for panel in self.panels:
+            start = time.time()
+            getattr(panel, hook)(*args)
+            self.record_timing(panel.__class__, hook, (time.time() - start) * 1000)
 
-        # Check if settings has a DEBUG_TOOLBAR_PANELS, otherwise use default
-        if hasattr(settings, 'DEBUG_TOOLBAR_PANELS'):
-            self.default_panels = settings.DEBUG_TOOLBAR_PANELS
-
-        for panel_path in self.default_panels:
-            try:
-                dot = panel_path.rindex('.')
-            except ValueError:
-                raise exceptions.ImproperlyConfigured, '%s isn\'t a debug panel module' % panel_path
-            panel_module, panel_classname = panel_path[:dot], panel_path[dot+1:]
-            try:
-                mod = __import__(panel_module, {}, {}, [''])
-            except ImportError, e:
-                raise exceptions.ImproperlyConfigured, 'Error importing debug panel %s: "%s"' % (panel_module, e)
-            try:
-                panel_class = getattr(mod, panel_classname)
-            except AttributeError:
-                raise exceptions.ImproperlyConfigured, 'Toolbar Panel module "%s" does not define a "%s" class' % (panel_module, panel_classname)
-
-            try:
-                panel_instance = panel_class(context=self.template_context)
-            except:
-                raise # Bubble up problem loading panel
-
-            self._panels[panel_class] = panel_instance
-
-    def render_toolbar(self):
-        """
-        Renders the overall Toolbar with panels inside.
-        """
-        media_path = os.path.join(os.path.dirname(__file__), os.pardir,
-            'media', 'debug_toolbar')
-        read_css = lambda f: open(os.path.join(media_path, 'css', f)).read()
-        read_js = lambda f: open(os.path.join(media_path, 'js', f)).read()
+    def record_timing(self, panel_class, hook, duration):
+        """
+        Adds ``duration`` (in ms) to the time ``panel_class`` spent in
+        ``hook``.
+        """
+        timings = self.timings.setdefault(panel_class, {})
+        timings[hook] = timings.get(hook, 0) + duration
 
+    def should_render_panels(self):
+        """
+        When False, only the toolbar itself is rendered with the response and
+        the content of each panel is fetched from ``render_panel`` on demand.
+        That needs a history backend which keeps the toolbars themselves.
+        """
+        return bool(self.config['RENDER_PANELS']) or \
+            not get_history_store().keeps_toolbars
+
+    def store(self):
+        """
+        Adds this toolbar to the request history under a unique id, so that
+        it can be looked at again in a later request. The id is known right
+        away, but the history backend may only store the toolbar once the
+        request has finished.
+        """
+        if self.store_id is None:
+            self.store_id = get_history_store().defer(self)
+
+    @classmethod
+    def fetch(cls, store_id):
+        """
+        Returns the stored toolbar with the id ``store_id``, or None if it
+        has been evicted, the history backend doesn't keep toolbars or
+        ``store_id`` isn't an id requests are stored under.
+        """
+        if not is_store_id(store_id):
+            return None
+        record = get_history_store().get(store_id)
+        return record and record.toolbar
+
+    def load_panels(self):
+        """
+        Populate debug panels from the panel registry
+        """
+        for panel_class in load_panel_classes():
+            self._panels[panel_class] = panel_class(self, context=self.template_context)
+
+    def render_toolbar(self, render_panels=None):
+        """
+        Renders the overall Toolbar with panels inside. ``render_panels``
+        overrides ``should_render_panels()``.
+        """
+        if render_panels is None:
+            render_panels = self.should_render_panels()
         context = self.template_context.copy()
         context.update({
+            'toolbar': self,
             'panels': self.panels,
-            'js': mark_safe('\n'.join([
-                read_js('jquery.js'),
-                read_js('jquery.cookie.js'),
-                read_js('toolbar.js'),
-            ])),
-            'css': mark_safe('\n'.join([
-                read_css('toolbar.css'),
-                read_css('pygments_pastie.css'),
-            ])),
+            'render_panels': render_panels,
         })
+        js, css = 'js/toolbar.bundle.js', 'css/toolbar.bundle.css'
+        if self.config['INLINE_MEDIA']:
+            context.update({
+                'js': mark_safe(media.get_media(js).content),
+                'css': mark_safe(media.get_media(css).content),
+            })
+        else:
+            media_url = self.config['MEDIA_URL']
+            context.update({
+                'js_url': media.media_url(media_url, js),
+                'css_url': media.media_url(media_url, css),
+            })
 
-        return render_to_string('debug_toolbar/base.html', context)
+        html = render_to_string('debug_toolbar/base.html', context)
+        if render_panels:
+            self.html = html
+        return html
@@ -11,6 +11,11 @@ _PREFIX = '__debug__'
 
 urlpatterns = patterns('',
     url(r'^%s/m/(.*)$' % _PREFIX, 'debug_toolbar.views.debug_media'),
+    url(r'^%s/render_panel/$' % _PREFIX, 'debug_toolbar.views.render_panel', name='render_panel'),
+    url(r'^%s/history/$' % _PREFIX, 'debug_toolbar.views.history', name='history'),
+    url(r'^%s/history/indexes/$' % _PREFIX, 'debug_toolbar.views.index_advice', name='index_advice'),
+    url(r'^%s/toolbar/(?P<store_id>\w+)/$' % _PREFIX, 'debug_toolbar.views.stored_toolbar', name='stored_toolbar'),
+    url(r'^%s/toolbar/(?P<store_id>\w+)/json/$' % _PREFIX, 'debug_toolbar.views.stored_toolbar_json', name='stored_toolbar_json'),
     url(r'^%s/sql_select/$' % _PREFIX, 'debug_toolbar.views.sql_select', name='sql_select'),
     url(r'^%s/sql_explain/$' % _PREFIX, 'debug_toolbar.views.sql_explain', name='sql_explain'),
     url(r'^%s/sql_profile/$' % _PREFIX, 'debug_toolbar.views.sql_profile', name='sql_profile'),
@@ -1,8 +1,10 @@
 import inspect
+import linecache
 import os.path
 import django
 import SocketServer
 import sys
+import time
 
 from django.conf import settings
 from django.views.debug import linebreak_iter
@@ -10,6 +12,57 @@ from django.views.debug import linebreak_iter
 # Figure out some paths
 django_path = os.path.realpath(os.path.dirname(django.__file__))
 socketserver_path = os.path.realpath(os.path.dirname(SocketServer.__file__))
+toolbar_path = os.path.realpath(os.path.dirname(os.path.dirname(__file__)))
+
+# The id of CLOCK_MONOTONIC for clock_gettime, by platform
+CLOCK_MONOTONIC = {
+    'linux': 1,
+    'darwin': 6,
+    'freebsd': 4,
+}
+
+def _get_timer():
+    """
+    Returns a monotonic clock, in seconds: ``time.monotonic`` where Python
+    has it, else ``clock_gettime(CLOCK_MONOTONIC)`` through ctypes, else
+    ``time.time``, which jumps when the system clock is set.
+    """
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    clock_id = None
+    for platform, value in CLOCK_MONOTONIC.iteritems():
+        if sys.platform.startswith(platform):
+            clock_id = value
+    try:
+        import ctypes
+        import ctypes.util
+        if clock_id is None:
+            raise OSError('No monotonic clock known for %s' % sys.platform)
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or
+            ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    def monotonic():
+        t = timespec()
+        if clock_gettime(clock_id, ctypes.byref(t)):
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
+    try:
+        monotonic()
+    except OSError:
+        return time.time
+    return monotonic
+
+# A clock for measuring durations
+timer = _get_timer()
 
 def ms_from_timedelta(td):
     """
@@ -45,6 +98,71 @@ def tidy_stacktrace(stack):
         trace.append((path, line_no, func_name, text))
     return trace
 
+# What kind of file each source file is, see ``get_stack_frames``
+_file_kinds = {}
+
+def _get_file_kind(filename):
+    kind = _file_kinds.get(filename)
+    if kind is None:
+        path = os.path.realpath(filename)
+        if socketserver_path in path:
+            kind = 'socketserver'
+        elif django_path in path and not 'django/contrib' in path:
+            kind = 'django'
+        elif toolbar_path in path:
+            kind = 'toolbar'
+        else:
+            kind = 'other'
+        _file_kinds[filename] = kind
+    return kind
+
+def get_stack_frames(skip=0):
+    """
+    Returns the stack of the caller as ``(code, lineno)`` pairs, outermost
+    first, leaving out the frames ``tidy_stacktrace`` would remove.
+
+    Unlike ``get_stack()`` this doesn't look up any source, which is left to
+    ``resolve_stack_frames`` for the stacks that are actually displayed.
+    ``skip`` is the number of callers to leave out.
+    """
+    hide_django = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}).get(
+        'HIDE_DJANGO_SQL', True)
+    frames = []
+    frame = sys._getframe(skip + 1)
+    while frame is not None:
+        code = frame.f_code
+        kind = _get_file_kind(code.co_filename)
+        # Looking at co_varnames avoids building the frame's f_locals
+        if kind != 'socketserver' and not (hide_django and kind == 'django') \
+                and '__traceback_hide__' not in code.co_varnames:
+            lineno = frame.f_lineno
+            template = frame.f_globals.get('__jinja_template__')
+            if template is not None:
+                lineno = template.get_corresponding_lineno(lineno)
+            frames.append((code, lineno))
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+def resolve_stack_frames(frames):
+    """
+    Turns the pairs returned by ``get_stack_frames`` into
+    ``(path, line_no, func_name, text)`` tuples like ``tidy_stacktrace``
+    returns.
+    """
+    trace = []
+    for code, lineno in frames:
+        text = linecache.getline(code.co_filename, lineno).strip()
+        trace.append((code.co_filename, lineno, code.co_name, text))
+    return trace
+
+def is_app_frame(frame):
+    """
+    Tells whether the ``(code, lineno)`` pair ``frame`` is in the code of the
+    project rather than in Django (except contrib apps) or the toolbar.
+    """
+    return _get_file_kind(frame[0].co_filename) == 'other'
+
 def get_template_info(source, context_lines=3):
     line = 0
     upto = 0
@@ -93,6 +211,32 @@ def get_name_from_obj(obj):
 
     return name
 
+def approximate_size(obj):
+    """
+    Approximates the number of bytes used by ``obj`` and the strings, numbers
+    and containers it holds. Other objects are counted but not looked into.
+    """
+    seen = set()
+    pending = [obj]
+    size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        try:
+            size += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        if isinstance(obj, dict):
+            pending.extend(obj.iterkeys())
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif hasattr(obj, '__slots__'):
+            pending.extend([getattr(obj, name, None) for name in obj.__slots__])
+    return size
+
 def getframeinfo(frame, context=1):
     """
     Get information about a frame or traceback object.
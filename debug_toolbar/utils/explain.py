@@ -0,0 +1,345 @@
+"""
+Automatic EXPLAIN of slow queries.
+
+The SQL panel defers the slow ``SELECT`` statements of a request to the
+explain pool, which hands them to its worker threads once the request has
+finished, so that the response isn't held up. The workers run ``EXPLAIN`` on
+connections of their own, except for in-memory SQLite databases, which can't
+be shared between connections and are explained by the request's thread. The
+plans are kept in a cache keyed by connection alias and fingerprint: each
+statement is only explained once per process, whatever the values it's run
+with.
+"""
+import Queue
+import thread
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import reset_queries
+
+from debug_toolbar.utils.compat.db import connections
+from debug_toolbar.utils.plans import parse_plan
+
+_explain_pool = None
+_explain_pool_lock = threading.Lock()
+
+
+def get_engine(alias):
+    """
+    Returns the name of the DB-API module of the connection ``alias``, e.g.
+    ``sqlite3`` or ``psycopg2``. The connection must be open.
+    """
+    conn = connections[alias].connection
+    return conn.__class__.__module__.split('.', 1)[0]
+
+
+# How to ask each engine for a plan in JSON
+JSON_EXPLAIN = {
+    'psycopg2': "EXPLAIN (FORMAT JSON) %s",
+    'MySQLdb': "EXPLAIN FORMAT=JSON %s",
+}
+
+
+def run_explain(alias, cursor, sql, params):
+    """
+    Runs ``EXPLAIN`` of ``sql`` with ``params`` on ``cursor``, a cursor of
+    the connection ``alias``, and returns the headers and rows of the plan.
+    PostgreSQL and MySQL are asked for a plan in JSON, which ``parse_plan``
+    understands. Servers that are too old for it (PostgreSQL before 9.0,
+    MySQL before 5.6) give the rows of a plain ``EXPLAIN`` instead, see
+    ``execute_in_savepoint``.
+    """
+    engine = get_engine(alias)
+    if engine == "sqlite3":
+        # SQLite's EXPLAIN dumps the low-level opcodes generated for a query;
+        # EXPLAIN QUERY PLAN dumps a more human-readable summary
+        # See http://www.sqlite.org/lang_explain.html for details
+        cursor.execute("EXPLAIN QUERY PLAN %s" % (sql,), params)
+    elif engine in JSON_EXPLAIN:
+        plan = _run_json_explain(alias, engine, cursor, sql, params)
+        if plan is not None:
+            return plan
+        cursor.execute("EXPLAIN %s" % (sql,), params)
+    else:
+        cursor.execute("EXPLAIN %s" % (sql,), params)
+    headers = [d[0] for d in cursor.description]
+    return headers, cursor.fetchall()
+
+
+def _run_json_explain(alias, engine, cursor, sql, params):
+    """
+    Returns the headers and rows of the plan of ``sql`` in JSON, or None if
+    the server doesn't know the syntax.
+    """
+    if not execute_in_savepoint(alias, cursor, JSON_EXPLAIN[engine] % (sql,),
+            params):
+        return None
+    headers = [d[0] for d in cursor.description]
+    return headers, cursor.fetchall()
+
+
+def execute_in_savepoint(alias, cursor, sql, params):
+    """
+    Executes ``sql`` with ``params`` on ``cursor``, a cursor of the
+    connection ``alias``, and returns whether it succeeded. On PostgreSQL,
+    where an error aborts the transaction, it's run in a savepoint that is
+    rolled back to when it fails. The savepoint is handled on a cursor of its
+    own, which leaves the rows of ``cursor`` to be fetched.
+    """
+    connection = connections[alias]
+    if get_engine(alias) != 'psycopg2' or \
+            connection.connection.isolation_level == 0:
+        try:
+            cursor.execute(sql, params)
+        except Exception:
+            return False
+        return True
+    savepoint = connection.cursor()
+    try:
+        savepoint.execute("SAVEPOINT djdt_savepoint")
+        try:
+            cursor.execute(sql, params)
+        except Exception:
+            savepoint.execute("ROLLBACK TO SAVEPOINT djdt_savepoint")
+            return False
+        finally:
+            savepoint.execute("RELEASE SAVEPOINT djdt_savepoint")
+    finally:
+        savepoint.close()
+    return True
+
+
+class PlanCache(object):
+    """
+    A bounded cache of plans, keyed by ``(alias, fingerprint)``. Like the
+    format cache of the SQL panel, the least recently used quarter of the
+    plans is evicted at once when it's full.
+    """
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        # key -> [plan, last use]
+        self._entries = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._clock += 1
+            entry[1] = self._clock
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def set(self, key, plan):
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._entries[key] = [plan, self._clock]
+            if len(self._entries) > self.max_entries:
+                entries = sorted(self._entries.iteritems(),
+                    key=lambda e: e[1][1])
+                for k, entry in entries[:len(entries) - self.max_entries * 3 // 4]:
+                    del self._entries[k]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+class ExplainPool(object):
+    """
+    Explains statements on up to ``workers`` threads. At most
+    ``max_pending`` statements wait to be explained, more are dropped and
+    will be explained when they're run again.
+
+    Statements are first deferred with ``defer``, per thread, and only
+    queued by ``flush``, which runs when the request of that thread has
+    finished.
+    """
+    def __init__(self, workers=2, max_pending=100, cache_size=500):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.cache = PlanCache(cache_size)
+        self.dropped = 0
+        self._queue = Queue.Queue(max_pending)
+        # Keys that are deferred or queued, so they're only explained once
+        self._pending = set()
+        # thread ident -> [(key, sql, params)]
+        self._deferred = {}
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def defer(self, alias, fingerprint, sql, params):
+        """
+        Schedules ``sql`` to be explained once the current request has
+        finished, unless its plan is known or already scheduled. Returns
+        whether it was.
+        """
+        key = (alias, fingerprint)
+        self._lock.acquire()
+        try:
+            if key in self._pending or key in self.cache:
+                return False
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending.add(key)
+            jobs = self._deferred.setdefault(thread.get_ident(), [])
+            jobs.append((key, sql, params))
+        finally:
+            self._lock.release()
+        return True
+
+    def flush(self):
+        """
+        Queues the statements the current thread deferred. Those of in-memory
+        databases are explained right away by this thread instead, as a
+        worker's connection would see a database of its own, without tables.
+        """
+        self._lock.acquire()
+        try:
+            jobs = self._deferred.pop(thread.get_ident(), None)
+            if not jobs:
+                return
+            inline = [job for job in jobs if self.is_inline(job[0][0])]
+            jobs = [job for job in jobs if job not in inline]
+            while jobs and len(self._threads) < self.workers:
+                worker = threading.Thread(target=self._work,
+                    name='debug_toolbar explain %d' % len(self._threads))
+                worker.setDaemon(True)
+                worker.start()
+                self._threads.append(worker)
+        finally:
+            self._lock.release()
+        for job in inline:
+            self._run(job)
+        for job in jobs:
+            # There are never more jobs than pending keys
+            self._queue.put_nowait(job)
+
+    def join(self):
+        """
+        Waits for the queued statements to be explained.
+        """
+        self._queue.join()
+
+    def is_inline(self, alias):
+        """
+        Whether the statements of the connection ``alias`` are explained by
+        the thread that ran them, which is the case of in-memory SQLite
+        databases.
+        """
+        settings_dict = getattr(connections[alias], 'settings_dict', {})
+        return (settings_dict.get('ENGINE', '').endswith('sqlite3') and
+            settings_dict.get('NAME') in ('', ':memory:'))
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job, release=True)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job, release=False):
+        key, sql, params = job
+        try:
+            self.cache.set(key, self.explain(key[0], sql, params))
+        finally:
+            if release:
+                self._release(key[0])
+            self._lock.acquire()
+            try:
+                self._pending.discard(key)
+            finally:
+                self._lock.release()
+
+    def explain(self, alias, sql, params):
+        """
+        Returns the plan of ``sql`` as a dict with its ``headers`` and
+        ``rows``, its ``tree`` (see ``parse_plan``), or the ``error``
+        explaining it raised.
+        """
+        try:
+            cursor = connections[alias].cursor()
+            try:
+                headers, rows = run_explain(alias, cursor, sql, params)
+            finally:
+                cursor.close()
+            tree = parse_plan(get_engine(alias), headers, rows)
+        except Exception, e:
+            return {'headers': [], 'rows': [], 'tree': None,
+                'error': unicode(e)}
+        return {'headers': headers, 'rows': rows, 'tree': tree, 'error': None}
+
+    def _release(self, alias):
+        """
+        Rolls back the transaction a job opened on the connection ``alias`` of
+        this worker, so it isn't left idle in it, or closes the connection
+        if that fails.
+        """
+        connection = connections[alias]
+        try:
+            connection._rollback()
+        except Exception:
+            connection.close()
+        # This thread's connections never see a request_started signal
+        reset_queries()
+
+
+def get_explain_pool():
+    """
+    Returns the explain pool of this process, created the first time with
+    ``SQL_EXPLAIN_WORKERS`` workers and room for ``SQL_EXPLAIN_CACHE_SIZE``
+    plans. Returns None when ``SQL_EXPLAIN_WORKERS`` is 0.
+    """
+    global _explain_pool
+    config = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {})
+    workers = config.get('SQL_EXPLAIN_WORKERS', 2)
+    if not workers:
+        return None
+    if _explain_pool is None:
+        _explain_pool_lock.acquire()
+        try:
+            if _explain_pool is None:
+                _explain_pool = ExplainPool(workers,
+                    cache_size=config.get('SQL_EXPLAIN_CACHE_SIZE', 500))
+        finally:
+            _explain_pool_lock.release()
+    return _explain_pool
+
+
+def get_cached_plan(alias, fingerprint):
+    """
+    Returns the ``PlanNode`` of a statement the explain pool has explained,
+    or None.
+    """
+    pool = get_explain_pool()
+    if pool is None:
+        return None
+    plan = pool.cache.get((alias, fingerprint))
+    return plan and plan['tree'] or None
+
+
+def _request_finished(sender, **kwargs):
+    if _explain_pool is not None:
+        _explain_pool.flush()
+
+request_finished.connect(_request_finished,
+    dispatch_uid='debug_toolbar.utils.explain.request_finished')
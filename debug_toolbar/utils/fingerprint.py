@@ -0,0 +1,70 @@
+"""
+Fingerprinting of SQL statements, to tell which queries are the same
+statement run with different values.
+
+A statement is normalized in a single pass of a regex tokenizer: string and
+numeric literals and placeholders become ``?``, ``IN`` lists become
+``IN (?)``, the values of ``LIMIT`` and ``OFFSET`` are dropped and runs of
+whitespace are collapsed. Quoted identifiers are left alone. The fingerprint
+is a short hash of the normalized text.
+"""
+import re
+import threading
+
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+FINGERPRINT_RE = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<identifier>"(?:[^"]|"")*"|`[^`]*`)
+  | (?P<list>\bIN\s*\((?!\s*SELECT\b)(?:[^()'"]|'(?:[^']|'')*')*\))
+  | (?P<limit>\b(?:LIMIT|OFFSET)\s+\d+)
+  | (?P<number>(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b)
+  | (?P<placeholder>%s|%\(\w+\)s|\?)
+  | (?P<space>\s+)
+""", re.VERBOSE | re.IGNORECASE)
+
+# Most queries are issued from a handful of statements, so the fingerprints
+# of the last few hundred statements are memoized
+MAX_MEMOIZED = 500
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind == 'identifier':
+        return match.group()
+    if kind == 'space':
+        return ' '
+    if kind == 'list':
+        return 'IN (?)'
+    if kind == 'limit':
+        return match.group().split(None, 1)[0].upper() + ' ?'
+    return '?'
+
+
+def normalize_sql(sql):
+    """
+    Returns ``sql`` with its literals, ``IN`` lists, ``LIMIT`` and ``OFFSET``
+    values and whitespace normalized.
+    """
+    return FINGERPRINT_RE.sub(_replace_token, sql).strip()
+
+
+def fingerprint_sql(sql):
+    """
+    Returns the fingerprint of ``sql``, as 16 hex digits.
+    """
+    fingerprint = _fingerprints.get(sql)
+    if fingerprint is None:
+        fingerprint = md5_constructor(smart_str(normalize_sql(sql))).hexdigest()[:16]
+        _fingerprints_lock.acquire()
+        try:
+            if len(_fingerprints) >= MAX_MEMOIZED:
+                _fingerprints.clear()
+            _fingerprints[sql] = fingerprint
+        finally:
+            _fingerprints_lock.release()
+    return fingerprint
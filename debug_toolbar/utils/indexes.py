@@ -0,0 +1,295 @@
+"""
+Suggestion of missing indexes from the queries the toolbar recorded.
+
+The columns a statement filters (``WHERE``), joins (``ON``) and sorts
+(``ORDER BY``) on are read from its tokens. They make up candidate indexes,
+one per table with the filtered columns followed by the sorted ones, and one
+per joined column. A candidate is missing when its leading column isn't
+indexed according to Django's introspection; as introspection doesn't report
+the columns of multi-column indexes on every backend, the plan of the
+statement overrides it where the explain pool has one: a table the plan
+doesn't read in full is taken to be indexed well enough.
+
+Candidates are ranked by the total time of the queries they would serve.
+"""
+import threading
+
+from debug_toolbar.utils import sqlparse
+from debug_toolbar.utils.compat.db import connections
+
+T = sqlparse.tokens
+
+# The clauses whose columns make up indexes
+WHERE, JOIN, ORDER = 'where', 'join', 'order'
+
+# The columns of the last few hundred statements, by fingerprint
+MAX_MEMOIZED = 500
+
+_columns = {}
+_columns_lock = threading.Lock()
+# (alias, table) -> frozenset of the indexed columns, or None
+_indexes = {}
+
+
+def _is_identifier(token):
+    ttype, value = token
+    return ttype in T.String.Symbol or (ttype in T.Name and
+        ttype not in T.Name.Placeholder and ttype not in T.Name.Builtin)
+
+
+def _unquote(value):
+    if value[:1] in ('"', '`', '[') and len(value) > 1:
+        return value[1:-1]
+    return value
+
+
+def get_clause_columns(sql):
+    """
+    Returns the ``(clause, table, column)`` of each column ``sql`` filters,
+    joins or sorts on, in order, with table aliases resolved, and the aliases
+    of the tables as a dict. Columns that aren't qualified are given to the
+    first table of the statement.
+    """
+    tokens = [(ttype, value) for ttype, value in sqlparse.lexer.tokenize(sql)
+        if ttype not in T.Whitespace and ttype not in T.Comment]
+    aliases = {}
+    tables = []
+    references = []
+    clause = None
+    expect_table = False
+    i = 0
+    while i < len(tokens):
+        ttype, value = tokens[i]
+        words = ttype in T.Keyword and value.upper().split()
+        if words:
+            last = words[-1]
+            expect_table = False
+            if last in ('FROM', 'JOIN'):
+                clause, expect_table = 'from', True
+            elif last == 'ON':
+                clause = JOIN
+            elif last == 'WHERE':
+                clause = WHERE
+            elif last == 'BY' and (clause == 'order by' or words[0] == 'ORDER'):
+                clause = ORDER
+            elif last == 'ORDER':
+                clause = 'order by'
+            elif last in ('GROUP', 'HAVING', 'LIMIT', 'OFFSET', 'UNION',
+                    'SELECT', 'SET', 'VALUES'):
+                clause = None
+            elif last == 'AS' and clause == 'from' and tables:
+                expect_table = 'alias'
+            i += 1
+            continue
+        if ttype in T.DML:
+            clause = None
+        elif clause == 'from':
+            if ttype in T.Punctuation and value == ',':
+                expect_table = True
+            elif _is_identifier(tokens[i]):
+                if expect_table is True:
+                    tables.append(_unquote(value))
+                    aliases[tables[-1]] = tables[-1]
+                    expect_table = 'alias'
+                elif expect_table == 'alias':
+                    aliases[_unquote(value)] = tables[-1]
+                    expect_table = False
+        elif clause in (WHERE, JOIN, ORDER) and _is_identifier(tokens[i]):
+            following = i + 1 < len(tokens) and tokens[i + 1] or (None, None)
+            if following[1] == '.' and i + 2 < len(tokens) and \
+                    _is_identifier(tokens[i + 2]):
+                references.append((clause, _unquote(value),
+                    _unquote(tokens[i + 2][1])))
+                i += 3
+                continue
+            if following[1] != '(':
+                # Not a function call
+                references.append((clause, None, _unquote(value)))
+        i += 1
+
+    columns = []
+    for clause, qualifier, column in references:
+        if qualifier is None:
+            table = tables and tables[0] or None
+        else:
+            table = aliases.get(qualifier, qualifier)
+        if table is not None:
+            columns.append((clause, table, column))
+    return columns, aliases
+
+
+def get_candidates(sql, fingerprint=None):
+    """
+    Returns the candidate indexes of ``sql`` as a list of ``(table,
+    columns)``, where ``columns`` is a tuple, and the aliases of its tables
+    (see ``get_clause_columns``). They're memoized by ``fingerprint`` when
+    it's given.
+    """
+    if fingerprint is not None:
+        result = _columns.get(fingerprint)
+        if result is not None:
+            return result
+
+    by_table = {}
+    joined = []
+    columns, aliases = get_clause_columns(sql)
+    for clause, table, column in columns:
+        if clause == JOIN:
+            if (table, (column,)) not in joined:
+                joined.append((table, (column,)))
+            continue
+        table_columns = by_table.setdefault(table, [])
+        if column not in table_columns:
+            table_columns.append(column)
+    candidates = [(table, tuple(table_columns))
+        for table, table_columns in by_table.iteritems()]
+    candidates.sort()
+    leading = set([(table, columns[0]) for table, columns in candidates])
+    candidates.extend([(table, columns) for table, columns in joined
+        if (table, columns[0]) not in leading])
+
+    result = candidates, aliases
+    if fingerprint is not None:
+        _columns_lock.acquire()
+        try:
+            if len(_columns) >= MAX_MEMOIZED:
+                _columns.clear()
+            _columns[fingerprint] = result
+        finally:
+            _columns_lock.release()
+    return result
+
+
+def _get_sqlite_indexes(connection, cursor, table):
+    # Django's introspection lists every column of a SQLite table, and only
+    # the unique indexes, so the leading columns are read from the pragmas
+    quote_name = connection.ops.quote_name
+    cursor.execute('PRAGMA table_info(%s)' % quote_name(table))
+    # cid, name, type, notnull, dflt_value, pk
+    rows = cursor.fetchall()
+    if not rows:
+        # Not a table, e.g. the alias of a subquery
+        return None
+    columns = [row[1] for row in rows if row[5]]
+    cursor.execute('PRAGMA index_list(%s)' % quote_name(table))
+    # seq, name, unique, ...
+    for index in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('PRAGMA index_info(%s)' % quote_name(index))
+        # seqno, cid, name
+        info = sorted(cursor.fetchall())
+        if info:
+            columns.append(info[0][2])
+    return columns
+
+
+def get_indexed_columns(alias, table):
+    """
+    Returns the set of columns of ``table`` that lead an index, as told by
+    Django's introspection of the connection ``alias``, or None when the
+    table can't be introspected. The indexes of each table are only looked up
+    once per process.
+    """
+    key = (alias, table)
+    if key not in _indexes:
+        connection = connections[alias]
+        try:
+            # Bypasses the cursor the SQL panel wraps, so that introspection
+            # isn't recorded as queries of the request
+            cursor = connection._cursor()
+            try:
+                if connection.vendor == 'sqlite':
+                    indexes = _get_sqlite_indexes(connection, cursor, table)
+                else:
+                    indexes = connection.introspection.get_indexes(cursor,
+                        table)
+            finally:
+                cursor.close()
+        except Exception:
+            indexes = None
+        if indexes is not None:
+            indexes = frozenset(indexes)
+        _indexes[key] = indexes
+    return _indexes[key]
+
+
+def clear_indexes():
+    """
+    Forgets the indexes looked up so far, e.g. after the schema changed.
+    """
+    _indexes.clear()
+
+
+def advise(queries, get_plan=None):
+    """
+    Returns the indexes missing for ``queries``, an iterable of the queries
+    recorded by the SQL panel (or their stats), most costly first.
+
+    Each suggestion is a dict with the ``alias``, ``table`` and ``columns``
+    of the index, the ``count`` and ``time`` of the queries it would serve,
+    the number of distinct ``statements`` among them, an example ``sql``
+    statement, and whether the plan of a statement showed a ``full_scan`` of
+    the table.
+
+    ``get_plan(alias, fingerprint)`` returns the ``PlanNode`` of a statement,
+    or None when it isn't known.
+    """
+    suggestions = {}
+    plans = {}
+    for query in queries:
+        if not query['raw_sql'].lower().lstrip().startswith('select'):
+            continue
+        alias, fingerprint = query['alias'], query['fingerprint']
+        candidates, aliases = get_candidates(query['raw_sql'], fingerprint)
+        if not candidates:
+            continue
+        key = (alias, fingerprint)
+        if key not in plans:
+            plans[key] = None
+            plan = get_plan and get_plan(alias, fingerprint)
+            if plan is not None:
+                # The plan may name tables by their alias in the statement
+                plans[key] = set([aliases.get(t, t)
+                    for t in plan.get_full_scans()])
+        full_scans = plans[key]
+
+        for table, columns in candidates:
+            if full_scans is not None and table not in full_scans:
+                continue
+            indexed = get_indexed_columns(alias, table)
+            if indexed is None or columns[0] in indexed:
+                continue
+            suggestion = suggestions.get((alias, table, columns))
+            if suggestion is None:
+                suggestion = suggestions[(alias, table, columns)] = {
+                    'alias': alias,
+                    'table': table,
+                    'columns': columns,
+                    'count': 0,
+                    'time': 0,
+                    'statements': set(),
+                    'sql': query['raw_sql'],
+                    'full_scan': False,
+                }
+            suggestion['count'] += 1
+            suggestion['time'] += query['duration']
+            suggestion['statements'].add(fingerprint)
+            suggestion['full_scan'] = suggestion['full_scan'] or \
+                bool(full_scans)
+
+    suggestions = suggestions.values()
+    for suggestion in suggestions:
+        suggestion['statements'] = len(suggestion['statements'])
+        suggestion['create_sql'] = get_create_sql(suggestion['alias'],
+            suggestion['table'], suggestion['columns'])
+    suggestions.sort(key=lambda s: (-s['time'], -s['count']))
+    return suggestions
+
+
+def get_create_sql(alias, table, columns):
+    """
+    Returns the statement that creates an index on ``columns`` of ``table``.
+    """
+    quote_name = connections[alias].ops.quote_name
+    return 'CREATE INDEX %s ON %s (%s);' % (
+        quote_name('%s_%s' % (table, '_'.join(columns))),
+        quote_name(table), ', '.join([quote_name(c) for c in columns]))
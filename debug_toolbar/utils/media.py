@@ -0,0 +1,133 @@
+"""
+In-memory cache of the toolbar's JavaScript and CSS.
+
+Each file (or bundle of files) is read from disk once per process and kept
+together with a fingerprint of its content and a gzipped copy, so that it can
+be served with far-future cache headers from ``views.debug_media``.
+"""
+import gzip
+import mimetypes
+import os
+import posixpath
+import re
+import threading
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor
+
+# Files that are served as a single asset. The bundles live next to the files
+# they are made of so that relative urls in the CSS keep working.
+BUNDLES = {
+    'js/toolbar.bundle.js': (
+        'js/jquery.js',
+        'js/jquery.cookie.js',
+        'js/toolbar.js',
+    ),
+    'css/toolbar.bundle.css': (
+        'css/toolbar.css',
+        'css/pygments_pastie.css',
+    ),
+}
+
+CACHED_EXTENSIONS = ('.js', '.css')
+
+FINGERPRINT_RE = re.compile(r'^(?P<name>.+)\.(?P<digest>[0-9a-f]{12})(?P<ext>\.\w+)$')
+
+_cache = {}
+_lock = threading.Lock()
+
+
+def get_media_root():
+    root = getattr(settings, 'DEBUG_TOOLBAR_MEDIA_ROOT', None)
+    if root is None:
+        parent = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+        root = os.path.join(parent, 'media', 'debug_toolbar')
+    return root
+
+
+class MediaFile(object):
+    """
+    The content of a media file along with its fingerprint and a gzipped
+    variant, which is only compressed the first time it is asked for.
+    """
+    def __init__(self, path, content):
+        self.path = path
+        self.content = content
+        self.digest = md5_constructor(content).hexdigest()[:12]
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self._gzipped = None
+
+    @property
+    def etag(self):
+        return '"%s"' % self.digest
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            buf = StringIO()
+            zfile = gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf)
+            try:
+                zfile.write(self.content)
+            finally:
+                zfile.close()
+            self._gzipped = buf.getvalue()
+        return self._gzipped
+
+    def fingerprinted_path(self):
+        name, ext = posixpath.splitext(self.path)
+        return '%s.%s%s' % (name, self.digest, ext)
+
+
+def get_media(path):
+    """
+    Returns the ``MediaFile`` for ``path`` (relative to the media root), or
+    None if ``path`` isn't a JavaScript or CSS file of the toolbar.
+    """
+    media = _cache.get(path)
+    if media is not None:
+        return media
+
+    path = posixpath.normpath(path).lstrip('/')
+    if path.startswith('..') or posixpath.splitext(path)[1] not in CACHED_EXTENSIONS:
+        return None
+
+    root = get_media_root()
+    parts = []
+    try:
+        for name in BUNDLES.get(path, (path,)):
+            f = open(os.path.join(root, *name.split('/')), 'rb')
+            try:
+                parts.append(f.read())
+            finally:
+                f.close()
+    except IOError:
+        return None
+
+    media = MediaFile(path, '\n'.join(parts))
+    _lock.acquire()
+    try:
+        return _cache.setdefault(path, media)
+    finally:
+        _lock.release()
+
+
+def split_fingerprint(path):
+    """
+    Splits ``path`` into the path of the file and the fingerprint embedded in
+    it. The fingerprint is None for paths that don't carry one.
+    """
+    match = FINGERPRINT_RE.match(path)
+    if match is None:
+        return path, None
+    return match.group('name') + match.group('ext'), match.group('digest')
+
+
+def media_url(base_url, path):
+    """
+    Returns the fingerprinted url of the media file ``path``.
+    """
+    media = get_media(path)
+    if media is None:
+        return base_url + path
+    return base_url + media.fingerprinted_path()
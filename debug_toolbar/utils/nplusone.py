@@ -0,0 +1,162 @@
+"""
+Detection of N+1 query patterns: the same statement, as told by its
+fingerprint, issued over and over from the same line of the project's code,
+typically by following a relation for each object of a list.
+"""
+import re
+
+from debug_toolbar.utils import resolve_stack_frames
+
+# The first column compared in the WHERE clause, possibly qualified
+WHERE_COLUMN_RE = re.compile(
+    r'\bWHERE\s+\(?\s*(?:["`]?(\w+)["`]?\.)?["`]?(\w+)["`]?\s*(?:=|IN\b)',
+    re.IGNORECASE)
+
+
+def find_n_plus_one(queries, threshold, aggregates=()):
+    """
+    Groups ``queries``, the ``(alias, query)`` pairs recorded by the SQL
+    panel, by fingerprint and call site and returns the groups of more than
+    ``threshold`` queries, the most costly first. Queries without a stack
+    trace are grouped by fingerprint alone. The queries only counted in
+    ``aggregates``, ``QueryAggregate`` instances, are counted by their call
+    sites as well.
+    """
+    groups = {}
+    def add(fingerprint, sql, alias, call_site, template_info, count, time):
+        key = (fingerprint, call_site)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                'fingerprint': fingerprint,
+                'sql': sql,
+                'alias': alias,
+                'call_site': call_site,
+                'template_info': template_info,
+                'count': 0,
+                'time': 0,
+            }
+        group['count'] += count
+        group['time'] += time
+
+    for alias, query in queries:
+        stack = query['stacktrace']
+        add(query['fingerprint'], query['raw_sql'], alias,
+            stack and stack.call_site() or None, query['template_info'], 1,
+            query['duration'])
+    for aggregate in aggregates:
+        for call_site, (count, time, template_info) in \
+                aggregate.call_sites.iteritems():
+            add(aggregate.fingerprint, aggregate.sql, aggregate.alias,
+                call_site, template_info, count, time)
+
+    patterns = [g for g in groups.itervalues() if g['count'] > threshold]
+    patterns.sort(key=lambda g: (-g['time'], -g['count']))
+    for pattern in patterns:
+        if pattern['call_site'] is not None:
+            pattern['call_site'] = resolve_stack_frames([pattern['call_site']])[0]
+    return patterns
+
+
+def get_models_by_table():
+    from django.db.models import get_models
+    return dict([(model._meta.db_table, model)
+        for model in get_models(include_auto_created=True)])
+
+
+def get_source_lines(pattern):
+    """
+    Returns the lines of code a ``pattern`` of ``find_n_plus_one`` was issued
+    from: the line of its call site and the highlighted line of its template.
+    """
+    lines = []
+    if pattern.get('call_site'):
+        lines.append(pattern['call_site'][3])
+    info = pattern.get('template_info')
+    if info:
+        lines.extend([line['content'] for line in info['context']
+            if line['highlight']])
+    return lines
+
+
+def describe_relation(sql, tables, source_lines=()):
+    """
+    Returns the label of the model ``sql`` looks up (as ``app.Model``), the
+    relation the lookup goes through (as ``Model.field``) and whether that is
+    a list of candidate relations, for a statement that uses ``tables``. The
+    model and relation are None when they can't be told.
+
+    A lookup on a foreign key column is the reverse side of that foreign key
+    (e.g. ``author.book_set``). A lookup on the primary key is the forward
+    side of one of the foreign keys to the model: those whose field is
+    accessed (as ``obj.field``) in ``source_lines``, the code the statement
+    was issued from, on an object named after their model when there are
+    some (e.g. ``message.user`` for ``Message.user``). Otherwise they're all
+    candidates, since the lookup may not go through any of them.
+    """
+    models = get_models_by_table()
+    match = WHERE_COLUMN_RE.search(sql)
+    table, column = match and match.groups() or (None, None)
+    model = models.get(table)
+    if model is None:
+        candidates = [models[t] for t in sorted(tables) if t in models]
+        if not candidates:
+            return None, None, False
+        model = candidates[0]
+    label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+    for field in model._meta.fields:
+        if field.column != column:
+            continue
+        if field.rel:
+            return label, '%s.%s' % (model._meta.object_name, field.name), \
+                False
+        if field.primary_key:
+            relations = {}
+            for other in models.itervalues():
+                # The tables of many to many fields aren't followed per object
+                if other._meta.auto_created:
+                    continue
+                for other_field in other._meta.fields:
+                    if other_field.rel and other_field.rel.to is model:
+                        relations['%s.%s' % (other._meta.object_name,
+                            other_field.name)] = (other, other_field.name)
+            accessed = {}
+            for relation, (other, name) in relations.iteritems():
+                objects = _get_accessing_objects(name, source_lines)
+                if objects:
+                    accessed[relation] = _names_model(objects, other)
+            named = [relation for relation, is_named in accessed.iteritems()
+                if is_named]
+            if named or accessed:
+                accessed = named or accessed.keys()
+                return label, ', '.join(sorted(accessed)), len(accessed) > 1
+            return label, ', '.join(sorted(relations)) or None, \
+                bool(relations)
+    return label, None, False
+
+
+def _get_accessing_objects(name, source_lines):
+    """
+    Returns the names of the objects the attribute ``name`` is accessed on in
+    ``source_lines``, in lower case.
+    """
+    attribute_re = re.compile(r'(\w*)\.%s\b' % re.escape(name))
+    objects = []
+    for line in source_lines:
+        objects.extend([o.lower() for o in attribute_re.findall(line)])
+    return objects
+
+
+def _names_model(objects, model):
+    """
+    Tells whether one of the names ``objects`` looks like an instance of
+    ``model``, e.g. ``message``, ``messages`` or ``last_message`` for
+    ``Message``.
+    """
+    model_name = model._meta.object_name.lower()
+    for name in objects:
+        name = name.replace('_', '')
+        if model_name in name or (len(name) >= 3 and name in model_name):
+            return True
+    return False
@@ -0,0 +1,308 @@
+"""
+Parsing of query plans into a tree of ``PlanNode`` objects that is the same
+for every engine, with warnings about the steps that are likely to be slow.
+
+The plans are the output of ``run_explain``: the rows of SQLite's ``EXPLAIN
+QUERY PLAN``, PostgreSQL's ``EXPLAIN (FORMAT JSON)`` and MySQL's ``EXPLAIN
+FORMAT=JSON``.
+"""
+import re
+
+from django.utils import simplejson
+
+FULL_SCAN = 'Full table scan'
+FULL_INDEX_SCAN = 'Full index scan'
+FILESORT = 'Using filesort'
+TEMPORARY_TABLE = 'Using temporary table'
+DISK_SORT = 'Sort spills to disk'
+
+# Estimates off by this factor or more from the actual rows are flagged
+ROWS_ESTIMATE_FACTOR = 10
+
+SQLITE_ROWS_RE = re.compile(r'\(~(\d+) rows?\)')
+SQLITE_TEMP_B_TREE_RE = re.compile(r'USE TEMP B-TREE FOR (.+)$')
+SQLITE_TABLE_RE = re.compile(r'^(?:SCAN|SEARCH)(?: TABLE)? (\w+)')
+
+# The keys of a MySQL plan that hold further steps, in the order they run
+# from the outside in
+MYSQL_OPERATIONS = ('ordering_operation', 'grouping_operation',
+    'duplicates_removal', 'union_result', 'query_specifications',
+    'nested_loop', 'table', 'materialized_from_subquery', 'query_block',
+    'attached_subqueries', 'optimized_away_subqueries')
+
+
+class PlanNode(object):
+    """
+    A step of a query plan. ``cost`` and ``rows`` are the engine's estimates
+    and are None when it doesn't give them, ``details`` is a list of ``(name,
+    value)`` pairs of the other properties the engine gives. ``table`` is the
+    table the step reads, if any.
+    """
+    def __init__(self, label, cost=None, rows=None, warnings=None,
+            details=None, table=None):
+        self.label = label
+        self.table = table
+        self.cost = cost
+        self.rows = rows
+        self.warnings = warnings or []
+        self.details = details or []
+        self.children = []
+
+    def __repr__(self):
+        return '<PlanNode %s>' % self.label
+
+    def add(self, child):
+        self.children.append(child)
+        return child
+
+    def walk(self, depth=0):
+        """
+        Yields ``(depth, node)`` for this node and all those under it, depth
+        first.
+        """
+        yield depth, self
+        for child in self.children:
+            for item in child.walk(depth + 1):
+                yield item
+
+    def get_warnings(self):
+        """
+        Returns the warnings of this node and all those under it.
+        """
+        warnings = []
+        for depth, node in self.walk():
+            warnings.extend(node.warnings)
+        return warnings
+
+    def get_full_scans(self):
+        """
+        Returns the set of tables that are read in full by this node or any
+        under it.
+        """
+        return set([node.table for depth, node in self.walk()
+            if node.table and FULL_SCAN in node.warnings])
+
+    def flatten(self, prefix):
+        """
+        Returns the nodes as dicts for ``sql_plan.html``, each with an id
+        starting with ``prefix`` and the ids of its ancestors so that its
+        subtree can be collapsed.
+        """
+        rows = []
+        def visit(node, depth, node_id, parent_ids):
+            rows.append({
+                'id': node_id,
+                'parent_ids': parent_ids,
+                'depth': depth,
+                'indent': depth * 16,
+                'label': node.label,
+                'cost': node.cost,
+                'rows': node.rows,
+                'warnings': node.warnings,
+                'details': node.details,
+                'has_children': bool(node.children),
+            })
+            for i, child in enumerate(node.children):
+                visit(child, depth + 1, '%s_%d' % (node_id, i),
+                    parent_ids + [node_id])
+        visit(self, 0, prefix, [])
+        return rows
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'table': self.table,
+            'cost': self.cost,
+            'rows': self.rows,
+            'warnings': self.warnings,
+            'details': self.details,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+def _number(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _sqlite_node(detail):
+    warnings = []
+    if detail.startswith('SCAN ') and 'INDEX' not in detail and \
+            'CONSTANT ROW' not in detail and 'SUBQUERY' not in detail:
+        warnings.append(FULL_SCAN)
+    match = SQLITE_TEMP_B_TREE_RE.search(detail)
+    if match:
+        warnings.append('Temporary B-tree for %s' % match.group(1))
+    match = SQLITE_ROWS_RE.search(detail)
+    rows = match and int(match.group(1)) or None
+    match = SQLITE_TABLE_RE.search(detail)
+    return PlanNode(SQLITE_ROWS_RE.sub('', detail).strip(), rows=rows,
+        warnings=warnings, table=match and match.group(1) or None)
+
+
+def parse_sqlite(headers, rows):
+    """
+    Parses the rows of ``EXPLAIN QUERY PLAN``. Since SQLite 3.24 each row has
+    the id of its parent, before that the rows are only grouped by select.
+    """
+    headers = [h.lower() for h in headers]
+    root = PlanNode('QUERY PLAN')
+    if 'parent' in headers:
+        nodes = {0: root}
+        for row in rows:
+            row = dict(zip(headers, row))
+            node = _sqlite_node(row['detail'])
+            nodes.get(row['parent'], root).add(node)
+            nodes[row['id']] = node
+    else:
+        selects = {0: root}
+        for row in rows:
+            row = dict(zip(headers, row))
+            parent = selects.get(row['selectid'])
+            if parent is None:
+                parent = selects[row['selectid']] = root.add(
+                    PlanNode('SELECT #%d' % row['selectid']))
+            parent.add(_sqlite_node(row['detail']))
+    return root
+
+
+def _postgresql_node(plan):
+    label = plan['Node Type']
+    if 'Index Name' in plan:
+        label += ' using %s' % plan['Index Name']
+    if 'Relation Name' in plan:
+        label += ' on %s' % plan['Relation Name']
+        if plan.get('Alias', plan['Relation Name']) != plan['Relation Name']:
+            label += ' %s' % plan['Alias']
+    warnings = []
+    if plan['Node Type'] == 'Seq Scan':
+        warnings.append(FULL_SCAN)
+    if 'external' in plan.get('Sort Method', ''):
+        warnings.append(DISK_SORT)
+    estimate, actual = plan.get('Plan Rows'), plan.get('Actual Rows')
+    if estimate is not None and actual is not None:
+        low, high = sorted([max(estimate, 1), max(actual, 1)])
+        if high >= ROWS_ESTIMATE_FACTOR * low:
+            warnings.append('Estimated %d rows, got %d' % (estimate, actual))
+    details = []
+    for key in ('Join Type', 'Index Cond', 'Hash Cond', 'Merge Cond',
+            'Filter', 'Sort Key', 'Sort Method', 'Actual Rows',
+            'Actual Total Time', 'Shared Hit Blocks', 'Shared Read Blocks'):
+        if key in plan:
+            value = plan[key]
+            if isinstance(value, list):
+                value = ', '.join(value)
+            details.append((key, value))
+    node = PlanNode(label, cost=_number(plan.get('Total Cost')),
+        rows=estimate, warnings=warnings, details=details,
+        table=plan.get('Relation Name'))
+    for child in plan.get('Plans', ()):
+        node.add(_postgresql_node(child))
+    return node
+
+
+def parse_postgresql(data):
+    """
+    Parses the output of ``EXPLAIN (FORMAT JSON)``, as a string or as
+    decoded by psycopg2.
+    """
+    if isinstance(data, basestring):
+        data = simplejson.loads(data)
+    if isinstance(data, list):
+        data = data[0]
+    return _postgresql_node(data['Plan'])
+
+
+def _mysql_table(table):
+    access_type = table.get('access_type', '')
+    label = '%s on %s' % (access_type, table['table_name'])
+    if table.get('key'):
+        label += ' using %s' % table['key']
+    warnings = []
+    if access_type == 'ALL':
+        warnings.append(FULL_SCAN)
+    elif access_type == 'index':
+        warnings.append(FULL_INDEX_SCAN)
+    if table.get('using_filesort'):
+        warnings.append(FILESORT)
+    if table.get('using_temporary_table'):
+        warnings.append(TEMPORARY_TABLE)
+    details = []
+    for key in ('possible_keys', 'used_key_parts', 'ref', 'filtered',
+            'using_index', 'attached_condition'):
+        if key in table:
+            value = table[key]
+            if isinstance(value, list):
+                value = ', '.join(value)
+            details.append((key, value))
+    node = PlanNode(label,
+        cost=_number(table.get('cost_info', {}).get('prefix_cost')),
+        rows=table.get('rows_examined_per_scan'), warnings=warnings,
+        details=details, table=table['table_name'])
+    _mysql_operations(node, table)
+    return node
+
+
+def _mysql_block(block):
+    node = PlanNode('Query block #%s' % block.get('select_id', 1),
+        cost=_number(block.get('cost_info', {}).get('query_cost')))
+    _mysql_operations(node, block)
+    return node
+
+
+def _mysql_operations(node, data):
+    for key in MYSQL_OPERATIONS:
+        value = data.get(key)
+        if value is None:
+            continue
+        if key == 'table':
+            node.add(_mysql_table(value))
+        elif key == 'query_block':
+            node.add(_mysql_block(value))
+        elif key == 'nested_loop':
+            loop = node.add(PlanNode('Nested loop'))
+            for item in value:
+                _mysql_operations(loop, item)
+        elif isinstance(value, list):
+            # Subqueries, each with a query block
+            for item in value:
+                _mysql_operations(node, item)
+        else:
+            warnings = []
+            if value.get('using_filesort'):
+                warnings.append(FILESORT)
+            if value.get('using_temporary_table'):
+                warnings.append(TEMPORARY_TABLE)
+            child = node.add(PlanNode(key.replace('_', ' ').capitalize(),
+                warnings=warnings))
+            _mysql_operations(child, value)
+
+
+def parse_mysql(data):
+    """
+    Parses the output of ``EXPLAIN FORMAT=JSON``.
+    """
+    if isinstance(data, basestring):
+        data = simplejson.loads(data)
+    return _mysql_block(data['query_block'])
+
+
+def parse_plan(engine, headers, rows):
+    """
+    Returns the plan ``run_explain`` returned for a connection of ``engine``
+    as a ``PlanNode``, or None if it isn't understood.
+    """
+    try:
+        if engine == 'sqlite3':
+            return parse_sqlite(headers, rows)
+        if engine == 'psycopg2':
+            return parse_postgresql(rows[0][0])
+        if engine == 'MySQLdb':
+            return parse_mysql(rows[0][0])
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    return None
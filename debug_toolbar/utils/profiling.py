@@ -0,0 +1,152 @@
+"""
+Profiling of a statement for the ``sql_profile`` view, by engine.
+
+MySQL profiles it with ``SET PROFILING``. PostgreSQL runs ``EXPLAIN (ANALYZE,
+BUFFERS)``, which runs the statement, in a savepoint that is rolled back
+afterwards. SQLite counts the steps of its virtual machine with the progress
+handler of the connection, which is called on every step.
+
+The statement is then run a number of times on every engine, all its rows
+fetched, for the minimum, median and 95th percentile of its duration.
+"""
+from django.utils import simplejson
+
+from debug_toolbar.utils import timer
+from debug_toolbar.utils.compat.db import connections
+from debug_toolbar.utils.explain import get_engine
+from debug_toolbar.utils.plans import parse_postgresql
+
+# The most times a statement is run to time it
+MAX_REPEAT = 100
+
+# Rows are fetched this many at a time, and only counted
+FETCH_ROWS = 1000
+
+
+class ProfilingError(Exception):
+    pass
+
+
+def _fetch_all(cursor):
+    count = 0
+    while True:
+        rows = cursor.fetchmany(FETCH_ROWS)
+        if not rows:
+            return count
+        count += len(rows)
+
+
+def profile_mysql(alias, cursor, sql, params):
+    cursor.execute("SET PROFILING=1") # Enable profiling
+    try:
+        cursor.execute(sql, params) # Execute SELECT
+        _fetch_all(cursor)
+    finally:
+        cursor.execute("SET PROFILING=0") # Disable profiling
+    # The Query ID should always be 1 here but I'll subselect to get the last one just in case...
+    cursor.execute("SELECT * FROM information_schema.profiling WHERE query_id=(SELECT query_id FROM information_schema.profiling ORDER BY query_id DESC LIMIT 1)")
+    headers = [d[0] for d in cursor.description]
+    return {'headers': headers, 'rows': cursor.fetchall(), 'plan': None}
+
+
+def profile_postgresql(alias, cursor, sql, params):
+    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) %s" % (sql,),
+        params)
+    data = cursor.fetchone()[0]
+    if isinstance(data, basestring):
+        data = simplejson.loads(data)
+    rows = []
+    # Total Runtime before PostgreSQL 9.4
+    for key in ('Planning Time', 'Execution Time', 'Total Runtime'):
+        if key in data[0]:
+            rows.append((key, '%.3f ms' % data[0][key]))
+    return {'headers': ['Statistic', 'Value'], 'rows': rows,
+        'plan': parse_postgresql(data)}
+
+
+def profile_sqlite(alias, cursor, sql, params):
+    steps = [0]
+    def progress():
+        steps[0] += 1
+        return 0
+    conn = connections[alias].connection
+    # Called on every step, which slows the statement down a lot, but it's
+    # timed on runs of its own
+    conn.set_progress_handler(progress, 1)
+    try:
+        cursor.execute(sql, params)
+        count = _fetch_all(cursor)
+    finally:
+        conn.set_progress_handler(None, 0)
+    return {'headers': ['Statistic', 'Value'], 'rows': [
+        ('VM steps', steps[0]),
+        ('Rows', count),
+    ], 'plan': None}
+
+
+PROFILERS = {
+    'MySQLdb': profile_mysql,
+    'psycopg2': profile_postgresql,
+    'sqlite3': profile_sqlite,
+}
+
+
+def get_timings(cursor, sql, params, repeat):
+    """
+    Runs ``sql`` ``repeat`` times, fetching all its rows, and returns the
+    ``count``, ``min``, ``median``, ``p95`` and ``max`` of its durations in
+    ms.
+    """
+    durations = []
+    for i in range(repeat):
+        start = timer()
+        cursor.execute(sql, params)
+        _fetch_all(cursor)
+        durations.append((timer() - start) * 1000)
+    durations.sort()
+    return {
+        'count': len(durations),
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'max': durations[-1],
+    }
+
+
+def profile_query(alias, sql, params, repeat=1):
+    """
+    Profiles ``sql`` with ``params`` on the connection ``alias`` and times
+    ``repeat`` runs of it. Returns a dict with the ``headers`` and ``rows`` of
+    the profile, the ``plan`` as a ``PlanNode`` when the engine gives one,
+    the ``timings`` (see ``get_timings``) and the executed ``sql``.
+
+    Raises ``ProfilingError`` when the engine can't be profiled.
+    """
+    repeat = min(max(repeat, 1), MAX_REPEAT)
+    connection = connections[alias]
+    cursor = connection.cursor()
+    try:
+        engine = get_engine(alias)
+        profiler = PROFILERS.get(engine)
+        if profiler is None:
+            raise ProfilingError('Profiling is not supported for %s' % engine)
+        # EXPLAIN ANALYZE runs the statement, whatever it does is undone
+        in_transaction = engine == 'psycopg2' and \
+            connection.connection.isolation_level != 0
+        if engine == 'psycopg2':
+            cursor.execute(in_transaction and 'SAVEPOINT djdt_profile' or
+                'BEGIN')
+        try:
+            result = profiler(alias, cursor, sql, params)
+            result['timings'] = get_timings(cursor, sql, params, repeat)
+            result['sql'] = connection.ops.last_executed_query(cursor, sql,
+                params)
+        finally:
+            if in_transaction:
+                cursor.execute('ROLLBACK TO SAVEPOINT djdt_profile')
+                cursor.execute('RELEASE SAVEPOINT djdt_profile')
+            elif engine == 'psycopg2':
+                cursor.execute('ROLLBACK')
+    finally:
+        cursor.close()
+    return result
@@ -0,0 +1,133 @@
+"""
+Per-request storage of the stack traces captured with ``get_stack_frames``.
+
+Queries issued from the same loop share most of their stack, so rather than
+keeping a list of frames per query, frames are interned in a table and each
+stack is a node in a tree of (parent stack, frame) pairs. A stack then costs
+one node per frame it doesn't share with an earlier one, and the HTML of each
+frame is only rendered once.
+"""
+from django.utils.html import escape
+
+from debug_toolbar.utils import is_app_frame, resolve_stack_frames
+
+
+class Stack(object):
+    """
+    A stack trace in a ``StackTable``. Iterating over it gives its frames as
+    ``(code, lineno)`` pairs, outermost first.
+    """
+    __slots__ = ('table', 'node_id')
+
+    def __init__(self, table, node_id):
+        self.table = table
+        self.node_id = node_id
+
+    def __len__(self):
+        return self.table.depths[self.node_id]
+
+    def __iter__(self):
+        return iter(self.table.get_frames(self.node_id))
+
+    def html(self):
+        return self.table.render_stack(self.node_id)
+
+    def to_dict(self):
+        return {'frames': resolve_stack_frames(list(self))}
+
+    def call_site(self):
+        """
+        Returns the innermost frame in the project's code, or None.
+        """
+        frame_id = self.table.get_call_site(self.node_id)
+        if frame_id is None:
+            return None
+        return self.table.frames[frame_id]
+
+
+class StackTable(object):
+    def __init__(self):
+        # (code, lineno) of each frame, indexed by frame id
+        self.frames = []
+        self._frame_ids = {}
+        # (parent node id, frame id) and depth of each node, indexed by node
+        # id. The root node is the empty stack.
+        self.nodes = [(None, None)]
+        self.depths = [0]
+        self._node_ids = {}
+        self._frame_html = {}
+        self._call_sites = {}
+
+    def intern(self, frames):
+        """
+        Adds the stack ``frames`` (as returned by ``get_stack_frames``) and
+        returns it as a ``Stack``.
+        """
+        node_id = 0
+        for frame in frames:
+            frame_id = self._frame_ids.get(frame)
+            if frame_id is None:
+                frame_id = self._frame_ids[frame] = len(self.frames)
+                self.frames.append(frame)
+            key = (node_id, frame_id)
+            child_id = self._node_ids.get(key)
+            if child_id is None:
+                child_id = self._node_ids[key] = len(self.nodes)
+                self.nodes.append(key)
+                self.depths.append(self.depths[node_id] + 1)
+            node_id = child_id
+        return Stack(self, node_id)
+
+    def get_frame_ids(self, node_id):
+        frame_ids = []
+        while node_id:
+            node_id, frame_id = self.nodes[node_id]
+            frame_ids.append(frame_id)
+        frame_ids.reverse()
+        return frame_ids
+
+    def get_frames(self, node_id):
+        return [self.frames[frame_id] for frame_id in self.get_frame_ids(node_id)]
+
+    def get_call_site(self, node_id):
+        """
+        Returns the id of the innermost frame of the stack that is in the
+        project's code (see ``is_app_frame``), or None.
+        """
+        try:
+            return self._call_sites[node_id]
+        except KeyError:
+            pass
+        call_site = None
+        parent_id = node_id
+        while parent_id:
+            parent_id, frame_id = self.nodes[parent_id]
+            if is_app_frame(self.frames[frame_id]):
+                call_site = frame_id
+                break
+        self._call_sites[node_id] = call_site
+        return call_site
+
+    def render_frame(self, frame_id):
+        html = self._frame_html.get(frame_id)
+        if html is None:
+            frame = resolve_stack_frames([self.frames[frame_id]])[0]
+            params = map(escape, frame[0].rsplit('/', 1) + list(frame[1:]))
+            try:
+                html = (u'<span class="path">{0}/</span>'
+                    '<span class="file">{1}</span> in '
+                    '<span class="func">{3}</span>('
+                    '<span class="lineno">{2}</span>)\n  '
+                    '<span class="code">{4}</span>'.format(*params))
+            except IndexError:
+                # The path has no directory
+                html = (u'<span class="file">{0}</span> in '
+                    '<span class="func">{2}</span>('
+                    '<span class="lineno">{1}</span>)\n  '
+                    '<span class="code">{3}</span>'.format(*params))
+            self._frame_html[frame_id] = html
+        return html
+
+    def render_stack(self, node_id):
+        return u'\n'.join([self.render_frame(frame_id)
+            for frame_id in self.get_frame_ids(node_id)])
@@ -1,22 +1,55 @@
 import sys
+import time
 
 from datetime import datetime
 from threading import local
 
 from django.conf import settings
+from django.db.backends import BaseDatabaseOperations
 from django.template import Node
 from django.utils import simplejson
 from django.utils.encoding import force_unicode, smart_str
 from django.utils.hashcompat import sha_constructor
 
-from debug_toolbar.utils import ms_from_timedelta, tidy_stacktrace, get_template_info, \
-                                get_stack
+from debug_toolbar.utils import get_template_info, get_stack_frames, timer
 from debug_toolbar.utils.compat.db import connections
+from debug_toolbar.utils.fingerprint import fingerprint_sql
 # TODO:This should be set in the toolbar loader as a default and panels should
 # get a copy of the toolbar object with access to its config dictionary
 SQL_WARNING_THRESHOLD = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}) \
                             .get('SQL_WARNING_THRESHOLD', 500)
 
+# To turn readings of ``timer`` into dates
+_wall_clock_offset = time.time() - timer()
+
+def cut_to_bytes(text, max_bytes):
+    """
+    Cuts ``text`` to at most ``max_bytes`` bytes of UTF-8, without splitting
+    a character, followed by '...'. Returns it and whether it was cut.
+    """
+    encoded = smart_str(text)
+    if len(encoded) <= max_bytes:
+        return text, False
+    return encoded[:max_bytes].decode('utf-8', 'ignore') + u'...', True
+
+def _params_size(params):
+    """
+    Returns at least the number of bytes ``params`` take up as JSON, counting
+    a few for each value that isn't a string.
+    """
+    if isinstance(params, dict):
+        params = params.values()
+    size = 0
+    try:
+        for param in params:
+            if isinstance(param, basestring):
+                size += len(param)
+            else:
+                size += 4
+    except TypeError:
+        pass
+    return size
+
 class SQLQueryTriggered(Exception):
     """Thrown when template panel triggers a query"""
     pass
@@ -51,6 +84,253 @@ class ExceptionCursorWrapper(object):
     def __getattr__(self, attr):
         raise SQLQueryTriggered()
 
+class QueryRecord(object):
+    """
+    A query recorded by ``NormalCursorWrapper``, which can be used like a
+    dict. Only what is needed to work out the rest is stored when the query
+    is run. The values that are costly and often not needed (the SQL with
+    the parameters interpolated, the parameters as JSON, the tamper hash...)
+    are computed when they're first looked up. Other keys can be set on it
+    as on a dict.
+    """
+    __slots__ = ('alias', 'engine', 'kind', 'raw_sql', 'raw_params',
+                 'batch_size', 'batch_last', 'start', 'stop', 'stacktrace',
+                 'template_info', 'fingerprint', 'rows', 'fetch_time',
+                 'fetch_end', 'exhausted', 'max_params_bytes', '_ops',
+                 '_executed_sql', '_values')
+
+    # The keys stored as attributes
+    fields = frozenset(['alias', 'engine', 'kind', 'raw_sql', 'batch_size',
+                        'stacktrace', 'template_info', 'fingerprint', 'rows',
+                        'exhausted'])
+    # The keys worked out from the attributes each time
+    derived = frozenset(['duration', 'fetch_duration', 'elapsed'])
+
+    def __init__(self, db, cursor, alias, engine, sql, params, start, stop,
+                 stacktrace=(), template_info=None, kind='execute',
+                 batch_size=None, batch_last=None):
+        self.alias = alias
+        self.engine = engine
+        # 'execute', 'executemany' or 'callproc'. The parameters of a batch
+        # run with executemany are those of its first row, ``batch_last``
+        # those of its last row.
+        self.kind = kind
+        self.raw_sql = sql
+        self.raw_params = params
+        self.batch_size = batch_size
+        self.batch_last = batch_last
+        # Readings of ``timer``
+        self.start = start
+        self.stop = stop
+        self.stacktrace = stacktrace
+        self.template_info = template_info
+        self.fingerprint = fingerprint_sql(sql)
+        # The rows fetched from the cursor since, the time spent fetching
+        # them (in seconds), and when the last of them was fetched or the
+        # cursor was closed
+        self.rows = 0
+        self.fetch_time = 0
+        self.fetch_end = None
+        self.exhausted = False
+        # The size the parameters are cut to, if any, see ``limit_params``
+        self.max_params_bytes = None
+        self._ops = db.ops
+        # Backends that read the executed statement off the cursor have to
+        # be asked before the cursor is used again. After executemany, the
+        # cursor holds the last row of the batch, the first one is
+        # interpolated when it's looked up instead.
+        if kind in ('callproc', 'executemany') or \
+                db.ops.__class__.last_executed_query.im_func is \
+                BaseDatabaseOperations.last_executed_query.im_func:
+            self._executed_sql = None
+        else:
+            self._executed_sql = db.ops.last_executed_query(cursor, sql, params)
+        self._values = {}
+
+    @property
+    def duration(self):
+        """
+        The time the query took, in ms.
+        """
+        return (self.stop - self.start) * 1000
+
+    @property
+    def fetch_duration(self):
+        """
+        The time spent fetching the rows of the query, in ms.
+        """
+        return self.fetch_time * 1000
+
+    @property
+    def elapsed(self):
+        """
+        The time from the start of the query until its last row was fetched
+        or its cursor closed, in ms. It includes the time spent on each row
+        between fetches, like building model instances.
+        """
+        return ((self.fetch_end or self.stop) - self.start) * 1000
+
+    def add_fetch(self, start, rows, exhausted=False):
+        """
+        Accounts for ``rows`` rows fetched since the ``timer`` reading
+        ``start``. Once the cursor is exhausted, the time it took is set.
+        """
+        now = timer()
+        self.rows += rows
+        self.fetch_time += now - start
+        if not self.exhausted:
+            self.fetch_end = now
+            self.exhausted = exhausted
+
+    def limit_params(self, max_bytes):
+        """
+        Cuts the parameters to ``max_bytes`` bytes when they're shown. When
+        they take up more than that, the values that need them are worked
+        out right away and the parameters are let go of: ``raw_params`` and
+        ``batch_last`` are set to None.
+        """
+        self.max_params_bytes = max_bytes
+        if max_bytes is None:
+            return
+        size = _params_size(self.raw_params)
+        if self.batch_last is not None:
+            size = max(size, _params_size(self.batch_last))
+        if size > max_bytes:
+            for key in ('sql', 'params', 'params_truncated', 'hash',
+                        'batch_params'):
+                self[key]
+            self.raw_params = self.batch_last = None
+
+    def _get_sql(self):
+        sql = self._executed_sql
+        if sql is None and self.kind == 'callproc':
+            # The parameters as JSON, without the brackets
+            sql = u'%s(%s)' % (self.raw_sql, self._dump_params()[1:-1])
+        elif sql is None:
+            # Backends that override it read the cursor, which isn't kept
+            sql = BaseDatabaseOperations.last_executed_query(self._ops, None,
+                self.raw_sql, self.raw_params)
+        if self.max_params_bytes is not None:
+            sql, self._values['sql_truncated'] = cut_to_bytes(sql,
+                len(smart_str(self.raw_sql)) + self.max_params_bytes)
+        return sql
+
+    def _dump_params(self, params=None):
+        if params is None:
+            params = self.raw_params
+        try:
+            return simplejson.dumps([force_unicode(x, strings_only=True)
+                for x in params])
+        except TypeError:
+            return '' # object not JSON serializable
+
+    def _cut_params(self, params):
+        if self.max_params_bytes is not None:
+            params = cut_to_bytes(params, self.max_params_bytes)[0]
+        return params
+
+    def _get_params(self):
+        return self._cut_params(self._dump_params())
+
+    def _get_batch_params(self):
+        """
+        A summary of the parameters of an executemany batch: the number of
+        rows, and the first and last rows as JSON.
+        """
+        if self.kind != 'executemany':
+            return None
+        last = self.batch_last
+        return {
+            'count': self.batch_size,
+            'first': self['params'],
+            'last': last is not None and self._cut_params(self._dump_params(last)) or '',
+        }
+
+    def _get_params_truncated(self):
+        # A truncated query can't be run again
+        budget = self.max_params_bytes
+        if budget is None:
+            return False
+        # Looking the SQL up tells whether it was cut
+        self['sql']
+        return len(smart_str(self._dump_params())) > budget or \
+            self._values.get('sql_truncated', False)
+
+    def _get_hash(self):
+        if self['params_truncated']:
+            params = self._dump_params()
+        else:
+            params = self['params']
+        return sha_constructor(settings.SECRET_KEY + smart_str(self.raw_sql) +
+            params).hexdigest()
+
+    def _get_is_select(self):
+        return self.raw_sql.lower().strip().startswith('select')
+
+    def _get_is_slow(self):
+        return self.duration > SQL_WARNING_THRESHOLD
+
+    def _get_start_time(self):
+        return datetime.fromtimestamp(self.start + _wall_clock_offset)
+
+    def _get_stop_time(self):
+        return datetime.fromtimestamp(self.stop + _wall_clock_offset)
+
+    _lazy = {
+        'sql': _get_sql,
+        'params': _get_params,
+        'params_truncated': _get_params_truncated,
+        'batch_params': _get_batch_params,
+        'hash': _get_hash,
+        'is_select': _get_is_select,
+        'is_slow': _get_is_slow,
+        'start_time': _get_start_time,
+        'stop_time': _get_stop_time,
+    }
+
+    def __getitem__(self, key):
+        if key in self.fields or key in self.derived:
+            return getattr(self, key)
+        try:
+            return self._values[key]
+        except KeyError:
+            getter = self._lazy.get(key)
+            if getter is None:
+                raise
+        value = self._values[key] = getter(self)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            setattr(self, key, value)
+        else:
+            self._values[key] = value
+
+    def __contains__(self, key):
+        return key in self.fields or key in self.derived or \
+            key in self._values or key in self._lazy
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, values):
+        for key, value in values.iteritems():
+            self[key] = value
+
+    def keys(self):
+        keys = set(self.fields)
+        keys.update(self.derived)
+        keys.update(self._lazy)
+        keys.update(self._values)
+        return list(keys)
+
+    def to_dict(self):
+        return dict([(key, self[key]) for key in self.keys()])
+
+
 class NormalCursorWrapper(object):
     """
     Wraps a cursor and logs queries.
@@ -60,83 +340,128 @@ class NormalCursorWrapper(object):
         self.cursor = cursor
         # Instance of a BaseDatabaseWrapper subclass
         self.db = db
-        # logger must implement a ``record`` method
+        # logger must implement the ``record`` and ``add_tracking_time``
+        # methods and have a ``stacks`` StackTable
         self.logger = logger
+        # The last query run, which the fetched rows are accounted to
+        self.query = None
 
     def execute(self, sql, params=()):
         __traceback_hide__ = True
-        start = datetime.now()
+        start = timer()
         try:
             return self.cursor.execute(sql, params)
         finally:
-            stop = datetime.now()
-            duration = ms_from_timedelta(stop - start)
-            enable_stacktraces = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}) \
-                                    .get('ENABLE_STACKTRACES', True)
-            if enable_stacktraces:
-                reversed_stack = reversed(get_stack())
-                stacktrace = tidy_stacktrace(reversed_stack)
-            else:
-                stacktrace = []
-                
-            _params = ''
-            try:
-                _params = simplejson.dumps([force_unicode(x, strings_only=True) for x in params])
-            except TypeError:
-                pass # object not JSON serializable
+            self._record(sql, params, start, timer())
 
-            template_info = None
-            cur_frame = sys._getframe().f_back
-            try:
-                while cur_frame is not None:
-                    if cur_frame.f_code.co_name == 'render':
-                        node = cur_frame.f_locals['self']
-                        if isinstance(node, Node):
-                            template_info = get_template_info(node.source)
-                            break
-                    cur_frame = cur_frame.f_back
-            except:
-                pass
-            del cur_frame
-            
-
-            alias = getattr(self.db, 'alias', 'default')
-            conn = connections[alias].connection
-            # HACK: avoid imports
-            if conn:
-                engine = conn.__class__.__module__.split('.', 1)[0]
+    def executemany(self, sql, param_list):
+        __traceback_hide__ = True
+        if not isinstance(param_list, (list, tuple)):
+            # The rows are counted after they've been run
+            param_list = list(param_list)
+        start = timer()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            if param_list:
+                first, last = param_list[0], param_list[-1]
             else:
-                engine = 'unknown'
-
-            params = {
-                'engine': engine,
-                'alias': alias,
-                'sql': self.db.ops.last_executed_query(self.cursor, sql, params),
-                'duration': duration,
-                'raw_sql': sql,
-                'params': _params,
-                'hash': sha_constructor(settings.SECRET_KEY + smart_str(sql) + _params).hexdigest(),
-                'stacktrace': stacktrace,
-                'start_time': start,
-                'stop_time': stop,
-                'is_slow': (duration > SQL_WARNING_THRESHOLD),
-                'is_select': sql.lower().strip().startswith('select'),
-                'template_info': template_info,
-            }
-
-            if engine == 'psycopg2':
-                params.update({
-                    'trans_id': self.logger.get_transaction_id(alias),
-                    'trans_status': conn.get_transaction_status(),
-                    'iso_level': conn.isolation_level,
-                    'encoding': conn.encoding,
-                })
-
-            # We keep `sql` to maintain backwards compatibility
-            self.logger.record(**params)
+                first, last = (), None
+            self._record(sql, first, start, timer(), kind='executemany',
+                batch_size=len(param_list), batch_last=last)
 
-    def executemany(self, sql, param_list):
-        return self.cursor.executemany(sql, param_list)
+    def callproc(self, procname, params=()):
+        __traceback_hide__ = True
+        start = timer()
+        try:
+            return self.cursor.callproc(procname, params)
+        finally:
+            self._record(procname, params, start, timer(), kind='callproc')
+
+    def fetchone(self):
+        start = timer()
+        row = self.cursor.fetchone()
+        if self.query is not None:
+            # A cursor that tells it has a single row (e.g. the COUNT of
+            # ``count()`` on backends that set rowcount) is done with it
+            self.query.add_fetch(start, row is not None and 1 or 0,
+                row is None or 0 <= getattr(self.cursor, 'rowcount', -1) <= 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        start = timer()
+        rows = self.cursor.fetchmany(*args, **kwargs)
+        if self.query is not None:
+            self.query.add_fetch(start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = timer()
+        rows = self.cursor.fetchall()
+        if self.query is not None:
+            self.query.add_fetch(start, len(rows), True)
+        return rows
+
+    def close(self):
+        query = self.query
+        if query is not None and not query.exhausted:
+            query.fetch_end = timer()
+            query.exhausted = True
+        return self.cursor.close()
+
+    def _record(self, sql, params, start, stop, **kwargs):
+        __traceback_hide__ = True
+        tracking_start = time.time()
+        enable_stacktraces = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {}) \
+                                .get('ENABLE_STACKTRACES', True)
+        if enable_stacktraces:
+            # Only the code and line of each frame, the source is looked up
+            # when the query is displayed
+            stacktrace = self.logger.stacks.intern(get_stack_frames())
+        else:
+            stacktrace = []
+
+        template_info = None
+        cur_frame = sys._getframe().f_back
+        try:
+            while cur_frame is not None:
+                if cur_frame.f_code.co_name == 'render':
+                    node = cur_frame.f_locals['self']
+                    if isinstance(node, Node):
+                        template_info = get_template_info(node.source)
+                        break
+                cur_frame = cur_frame.f_back
+        except:
+            pass
+        del cur_frame
+
+        alias = getattr(self.db, 'alias', 'default')
+        conn = connections[alias].connection
+        # HACK: avoid imports
+        if conn:
+            engine = conn.__class__.__module__.split('.', 1)[0]
+        else:
+            engine = 'unknown'
+
+        query = QueryRecord(self.db, self.cursor, alias, engine, sql,
+            params, start, stop, stacktrace, template_info, **kwargs)
+
+        # The rows of the previous statement that weren't fetched can't be
+        # any more
+        if self.query is not None and not self.query.exhausted:
+            self.query.exhausted = True
+
+        if engine == 'psycopg2':
+            query.update({
+                'trans_id': self.logger.get_transaction_id(alias),
+                'trans_status': conn.get_transaction_status(),
+                'iso_level': conn.isolation_level,
+                'encoding': conn.encoding,
+            })
+
+        self.query = query
+        self.logger.record(query)
+        self.logger.add_tracking_time((time.time() - tracking_start) * 1000)
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
@@ -145,4 +470,19 @@ class NormalCursorWrapper(object):
             return getattr(self.cursor, attr)
 
     def __iter__(self):
-        return iter(self.cursor)
+        query = self.query
+        rows = iter(self.cursor)
+        if query is None:
+            return rows
+        return self._iterate(query, rows)
+
+    def _iterate(self, query, rows):
+        while True:
+            start = timer()
+            try:
+                row = rows.next()
+            except StopIteration:
+                query.add_fetch(start, 0, True)
+                return
+            query.add_fetch(start, 1)
+            yield row
@@ -4,16 +4,49 @@ debug toolbar is displayed, and typically can do Bad Things, so hooking up these
 views in any other way is generally not advised.
 """
 
-import os
+import re
+import time
+
 import django.views.static
 from django.conf import settings
-from django.http import HttpResponseBadRequest
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, \
+    HttpResponseNotModified
 from django.shortcuts import render_to_response
+from django.template.loader import render_to_string
 from django.utils import simplejson
 from django.utils.hashcompat import sha_constructor
+from django.utils.http import http_date
+from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext as _
 
+from debug_toolbar.toolbar.history import get_history_store, is_store_id
+from debug_toolbar.toolbar.loader import DebugToolbar
+from debug_toolbar.utils import media
+from debug_toolbar.utils.explain import execute_in_savepoint, \
+    get_cached_plan, get_engine, run_explain
+from debug_toolbar.utils.indexes import advise
+from debug_toolbar.utils.plans import parse_plan
+from debug_toolbar.utils.profiling import profile_query
 from debug_toolbar.utils.compat.db import connections
 
+# Fingerprinted media never changes under its url, cache it for a year
+MEDIA_CACHE_SECONDS = 365 * 24 * 60 * 60
+
+# The rows of a selected query are skipped and rendered this many at a time,
+# in place of the marker in sql_select.html
+SQL_SELECT_CHUNK_ROWS = 100
+SQL_SELECT_ROWS_MARKER = '<!-- djDebugRows -->'
+
+# The engines a page of a selected query is asked for with LIMIT and OFFSET
+SQL_SELECT_PAGED_ENGINES = ('sqlite3', 'psycopg2', 'MySQLdb')
+# Statements that can't be given a LIMIT of their own, and are paged in a
+# subquery instead
+SQL_SELECT_LIMITED_RE = re.compile(r'\b(LIMIT|OFFSET|FETCH|FOR\s+UPDATE)\b',
+    re.IGNORECASE)
+
+# The numbers of runs sql_profile offers to time a statement over
+PROFILE_REPEATS = (1, 5, 20, 50)
+
 class InvalidSQLError(Exception):
     def __init__(self, value):
         self.value = value
@@ -21,21 +54,189 @@ class InvalidSQLError(Exception):
         return repr(self.value)
 
 def debug_media(request, path):
-    root = getattr(settings, 'DEBUG_TOOLBAR_MEDIA_ROOT', None)
-    if root is None:
-        parent = os.path.abspath(os.path.dirname(__file__))
-        root = os.path.join(parent, 'media', 'debug_toolbar')
-    return django.views.static.serve(request, path, root)
+    """
+    Serves the toolbar's media. JavaScript and CSS are served from memory,
+    gzipped when the client accepts it, and with far-future cache headers
+    when requested under their fingerprinted url.
+    """
+    name, digest = media.split_fingerprint(path)
+    media_file = media.get_media(name)
+    if media_file is None:
+        return django.views.static.serve(request, path, media.get_media_root())
+    if digest != media_file.digest:
+        # An outdated fingerprint, e.g. from a toolbar kept in the history,
+        # gets the current file but mustn't be cached under that url
+        digest = None
+
+    if request.META.get('HTTP_IF_NONE_MATCH') == media_file.etag:
+        response = HttpResponseNotModified()
+    else:
+        use_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        content = use_gzip and media_file.gzipped or media_file.content
+        response = HttpResponse(content, mimetype=media_file.mimetype)
+        response['Content-Length'] = str(len(content))
+        if use_gzip:
+            response['Content-Encoding'] = 'gzip'
+    response['ETag'] = media_file.etag
+    response['Vary'] = 'Accept-Encoding'
+    if digest:
+        response['Cache-Control'] = 'public, max-age=%d' % MEDIA_CACHE_SECONDS
+        response['Expires'] = http_date(time.time() + MEDIA_CACHE_SECONDS)
+    else:
+        response['Cache-Control'] = 'no-cache'
+    return response
+
+def render_panel(request):
+    """
+    Returns the content of a panel of a stored toolbar.
+
+    Expected GET variables:
+        store_id: the id the toolbar was stored under
+        panel_id: the DOM id of the panel
+    """
+    store_id = request.GET.get('store_id', '')
+    if not is_store_id(store_id):
+        raise Http404('Invalid toolbar id')
+    toolbar = DebugToolbar.fetch(store_id)
+    if toolbar is None:
+        return HttpResponse(_("Data for this panel isn't available anymore. "
+            "Please reload the page and retry."))
+    panel = toolbar.get_panel_by_id(request.GET.get('panel_id', ''))
+    if panel is None or not panel.has_content:
+        return HttpResponseBadRequest('Invalid panel')
+    return HttpResponse(panel.render_content())
+
+def _get_record(store_id):
+    if not is_store_id(store_id):
+        raise Http404('Invalid toolbar id')
+    record = get_history_store().get(store_id)
+    if record is None:
+        raise Http404('Toolbar %s is not available anymore' % store_id)
+    return record
+
+def history(request):
+    """
+    Lists the requests in the history, most recent first.
+    """
+    return render_to_response('debug_toolbar/history.html', {
+        'records': get_history_store().list(),
+        'live_count': DebugToolbar.live_count(),
+        'BASE_URL': request.META.get('SCRIPT_NAME', ''),
+    })
+
+def index_advice(request):
+    """
+    Lists the indexes missing for the queries of all the requests in the
+    history, see ``advise``.
+    """
+    records = get_history_store().list()
+    queries = []
+    for record in records:
+        queries.extend(record.get_queries())
+    return render_to_response('debug_toolbar/indexes.html', {
+        'index_advice': advise(queries, get_cached_plan),
+        'request_count': len(records),
+        'query_count': len(queries),
+        'BASE_URL': request.META.get('SCRIPT_NAME', ''),
+    })
+
+def stored_toolbar(request, store_id):
+    """
+    Returns the toolbar of a request in the history as an HTML page.
+    """
+    record = _get_record(store_id)
+    return render_to_response('debug_toolbar/stored.html', {
+        'record': record,
+        'toolbar_html': record.render_toolbar(),
+    })
+
+def stored_toolbar_json(request, store_id):
+    """
+    Returns the stats the panels recorded for a request in the history as
+    JSON.
+    """
+    record = _get_record(store_id)
+    content = '{"id": %s, "method": %s, "path": %s, "summary": %s, "stats": %s}' % (
+        simplejson.dumps(record.store_id), simplejson.dumps(record.method),
+        simplejson.dumps(record.path), simplejson.dumps(record.summary),
+        record.stats_json())
+    return HttpResponse(content, mimetype='application/json')
+
+def _count_rows(alias, sql, params):
+    """
+    Returns the number of rows ``sql`` returns, or None when they can't be
+    counted in a subquery, e.g. on MySQL when columns of the result have the
+    same name.
+    """
+    cursor = connections[alias].cursor()
+    try:
+        if not execute_in_savepoint(alias, cursor,
+                'SELECT COUNT(*) FROM (%s) djdt_count' % (sql,), params):
+            return None
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+def _execute_page(alias, cursor, sql, params, offset, limit):
+    """
+    Executes ``sql`` on ``cursor`` for rows ``offset`` to ``offset + limit``,
+    and one more to tell whether there are more, and returns how many rows
+    are left to skip. The database is asked for the page with LIMIT and
+    OFFSET where it can be, else the whole result is skipped through.
+    """
+    if get_engine(alias) in SQL_SELECT_PAGED_ENGINES:
+        if SQL_SELECT_LIMITED_RE.search(sql):
+            paged_sql = 'SELECT * FROM (%s) djdt_page' % (sql,)
+        else:
+            paged_sql = sql
+        paged_sql = '%s LIMIT %d OFFSET %d' % (paged_sql, limit + 1, offset)
+        if execute_in_savepoint(alias, cursor, paged_sql, params):
+            return 0
+    cursor.execute(sql, params)
+    return offset
+
+def _fetch_page(cursor, skip, limit):
+    """
+    Returns the ``limit`` rows of ``cursor`` after ``skip`` rows (see
+    ``_execute_page``), and whether there are rows after them.
+    """
+    skipped = 0
+    while skipped < skip:
+        rows = cursor.fetchmany(min(skip - skipped, SQL_SELECT_CHUNK_ROWS))
+        if not rows:
+            return [], False
+        skipped += len(rows)
+    rows = list(cursor.fetchmany(limit))
+    return rows, len(rows) == limit and cursor.fetchone() is not None
+
+def _stream_select(context, rows):
+    """
+    Yields the HTML of ``sql_select.html`` with ``rows``, which are rendered a
+    chunk at a time.
+    """
+    template = 'debug_toolbar/panels/sql_select.html'
+    head, tail = render_to_string(template, context).split(
+        SQL_SELECT_ROWS_MARKER)
+    yield head
+    for start in xrange(0, len(rows), SQL_SELECT_CHUNK_ROWS):
+        yield render_to_string('debug_toolbar/panels/sql_select_rows.html',
+            {'result': rows[start:start + SQL_SELECT_CHUNK_ROWS]})
+    yield tail
 
 def sql_select(request):
     """
-    Returns the output of the SQL SELECT statement.
+    Returns the output of the SQL SELECT statement, a page at a time. The
+    database is asked for the rows of the page (see ``_execute_page``), up to
+    ``SQL_SELECT_MAX_ROWS`` rows, which are fetched before returning, as the
+    connection may be closed once the request has finished, and streamed as
+    they're rendered; the total number of rows is counted separately.
 
     Expected GET variables:
         sql: urlencoded sql with positional arguments
         params: JSON encoded parameter values
         duration: time for SQL to execute passed in from toolbar just for redisplay
         hash: the hash of (secret + sql + params) for tamper checking
+        page: the page of rows to show, from 1
     """
     from debug_toolbar.panels.sql import reformat_sql
     sql = request.GET.get('sql', '')
@@ -45,23 +246,55 @@ def sql_select(request):
     if hash != request.GET.get('hash', ''):
         return HttpResponseBadRequest('Tamper alert') # SQL Tampering alert
     if sql.lower().strip().startswith('select'):
+        config = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {})
+        page_size = max(config.get('SQL_SELECT_PAGE_SIZE', 100), 1)
+        max_rows = max(config.get('SQL_SELECT_MAX_ROWS', 10000), 1)
+        page_count = (max_rows + page_size - 1) // page_size
+        try:
+            page = min(max(int(request.GET.get('page', 1)), 1), page_count)
+        except ValueError:
+            page = 1
+        offset = (page - 1) * page_size
+
         params = simplejson.loads(params)
+        total = _count_rows(alias, sql, params)
+        limit = min(page_size, max_rows - offset)
         cursor = connections[alias].cursor()
-        cursor.execute(sql, params)
-        headers = [d[0] for d in cursor.description]
-        result = cursor.fetchall()
-        cursor.close()
+        try:
+            skip = _execute_page(alias, cursor, sql, params, offset, limit)
+            headers = [d[0] for d in cursor.description]
+            executed_sql = cursor.db.ops.last_executed_query(cursor, sql,
+                params)
+            rows, has_more = _fetch_page(cursor, skip, limit)
+        finally:
+            cursor.close()
+        if total is not None:
+            has_more = offset + len(rows) < total
+
+        def page_url(number):
+            query = request.GET.copy()
+            query['page'] = str(number)
+            return '%s?%s' % (request.path, query.urlencode())
+
         context = {
-            'result': result,
-            'sql': reformat_sql(
-                cursor.db.ops.last_executed_query(cursor, sql, params),
-                expand=False,
-            ),
+            'sql': reformat_sql(executed_sql, expand=False),
             'duration': request.GET.get('duration', 0.0),
             'headers': headers,
             'alias': alias,
+            'total': total,
+            'counted': total is not None,
+            'max_rows': max_rows,
+            'limited': total is not None and total > max_rows,
+            'page': page,
+            'previous_url': page > 1 and page_url(page - 1) or None,
+            'next_url': (has_more and page < page_count and
+                page_url(page + 1) or None),
+            'first': rows and offset + 1 or 0,
+            'last': offset + len(rows),
+            'row_count': len(rows),
+            'rows_marker': mark_safe(SQL_SELECT_ROWS_MARKER),
         }
-        return render_to_response('debug_toolbar/panels/sql_select.html', context)
+        return HttpResponse(_stream_select(context, rows))
     raise InvalidSQLError("Only 'select' queries are allowed.")
 
 def sql_explain(request):
@@ -84,23 +317,12 @@ def sql_explain(request):
     if sql.lower().strip().startswith('select'):
         params = simplejson.loads(params)
         cursor = connections[alias].cursor()
-
-        conn = connections[alias].connection
-        engine = conn.__class__.__module__.split('.', 1)[0]
-
-        if engine == "sqlite3":
-            # SQLite's EXPLAIN dumps the low-level opcodes generated for a query;
-            # EXPLAIN QUERY PLAN dumps a more human-readable summary
-            # See http://www.sqlite.org/lang_explain.html for details
-            cursor.execute("EXPLAIN QUERY PLAN %s" % (sql,), params)
-        else:
-            cursor.execute("EXPLAIN %s" % (sql,), params)
-
-        headers = [d[0] for d in cursor.description]
-        result = cursor.fetchall()
+        headers, result = run_explain(alias, cursor, sql, params)
         cursor.close()
+        plan = parse_plan(get_engine(alias), headers, result)
         context = {
             'result': result,
+            'plan_nodes': plan and plan.flatten('plan'),
             'sql': reformat_sql(
                 cursor.db.ops.last_executed_query(cursor, sql, params),
                 expand=False,
@@ -114,13 +336,16 @@ def sql_explain(request):
 
 def sql_profile(request):
     """
-    Returns the output of running the SQL and getting the profiling statistics.
+    Returns the output of running the SQL and getting the profiling statistics,
+    see ``profile_query``, and the spread of its duration over a number of
+    runs.
 
     Expected GET variables:
         sql: urlencoded sql with positional arguments
         params: JSON encoded parameter values
         duration: time for SQL to execute passed in from toolbar just for redisplay
         hash: the hash of (secret + sql + params) for tamper checking
+        repeat: how many times to run the SQL, ``SQL_PROFILE_REPEAT`` by default
     """
     from debug_toolbar.panels.sql import reformat_sql
     sql = request.GET.get('sql', '')
@@ -131,27 +356,34 @@ def sql_profile(request):
         return HttpResponseBadRequest('Tamper alert') # SQL Tampering alert
     if sql.lower().strip().startswith('select'):
         params = simplejson.loads(params)
-        cursor = connections[alias].cursor()
-        result = None
-        headers = None
+        config = getattr(settings, 'DEBUG_TOOLBAR_CONFIG', {})
+        try:
+            repeat = int(request.GET.get('repeat',
+                config.get('SQL_PROFILE_REPEAT', 5)))
+        except ValueError:
+            repeat = 1
+        profile = None
         result_error = None
         try:
-            cursor.execute("SET PROFILING=1") # Enable profiling
-            cursor.execute(sql, params) # Execute SELECT
-            cursor.execute("SET PROFILING=0") # Disable profiling
-            # The Query ID should always be 1 here but I'll subselect to get the last one just in case...
-            cursor.execute("SELECT * FROM information_schema.profiling WHERE query_id=(SELECT query_id FROM information_schema.profiling ORDER BY query_id DESC LIMIT 1)")
-            headers = [d[0] for d in cursor.description]
-            result = cursor.fetchall()
-        except:
-            result_error = "Profiling is either not available or not supported by your database."
-        cursor.close()
+            profile = profile_query(alias, sql, params, repeat)
+        except Exception, e:
+            result_error = _("Profiling is either not available or not supported by your database: %s") % e
+
+        def repeat_url(number):
+            query = request.GET.copy()
+            query['repeat'] = str(number)
+            return '%s?%s' % (request.path, query.urlencode())
+
         context = {
-            'result': result,
+            'result': profile and profile['rows'],
             'result_error': result_error,
-            'sql': reformat_sql(cursor.db.ops.last_executed_query(cursor, sql, params)),
+            'plan_nodes': profile and profile['plan'] and
+                profile['plan'].flatten('profile'),
+            'timings': profile and profile['timings'],
+            'repeat_urls': [(n, repeat_url(n)) for n in PROFILE_REPEATS],
+            'sql': reformat_sql(profile and profile['sql'] or sql),
             'duration': request.GET.get('duration', 0.0),
-            'headers': headers,
+            'headers': profile and profile['headers'],
             'alias': alias,
         }
         return render_to_response('debug_toolbar/panels/sql_profile.html', context)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Measures the latency and peak memory the debug toolbar adds to synthetic
+workloads (see ``tests/benchmarks.py``), compared to the same requests with
+the toolbar's middleware removed.
+
+Each workload is run in a fresh process per mode so that the peak memory of
+one doesn't hide the next. The results are written as JSON, and can be
+compared with those of another run with ``--compare``.
+"""
+import os
+import platform
+import resource
+import sys
+from os.path import dirname, abspath
+from optparse import OptionParser
+
+from django.conf import settings, global_settings
+
+if not settings.configured:
+    settings.configure(
+        DATABASES = {
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+        },
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'django.contrib.sessions',
+
+            'debug_toolbar',
+
+            'tests',
+        ],
+        MIDDLEWARE_CLASSES = global_settings.MIDDLEWARE_CLASSES + (
+            'debug_toolbar.middleware.DebugToolbarMiddleware',
+        ),
+        CACHES = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            }
+        },
+        DEBUG_TOOLBAR_PANELS = (
+            'debug_toolbar.panels.timer.TimerDebugPanel',
+            'debug_toolbar.panels.sql.SQLDebugPanel',
+            'debug_toolbar.panels.template.TemplateDebugPanel',
+            'debug_toolbar.panels.cache.CacheDebugPanel',
+            'debug_toolbar.panels.logger.LoggingPanel',
+            'debug_toolbar.panels.overhead.OverheadDebugPanel',
+        ),
+        DEBUG_TOOLBAR_CONFIG = {
+            'SHOW_TOOLBAR_CALLBACK': lambda request: True,
+        },
+        ROOT_URLCONF='tests.benchmarks',
+        DEBUG=False,
+        SITE_ID=1,
+    )
+
+from django.utils import simplejson
+
+MIDDLEWARE = 'debug_toolbar.middleware.DebugToolbarMiddleware'
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(params, toolbar, repeat):
+    """
+    Runs a workload with or without the toolbar and returns its figures.
+    """
+    from tests.benchmarks import run_workload
+
+    if not toolbar:
+        settings.MIDDLEWARE_CLASSES = tuple(
+            [m for m in settings.MIDDLEWARE_CLASSES if m != MIDDLEWARE])
+    timings = run_workload(params, repeat)
+    return {
+        'median_ms': median(timings),
+        'min_ms': min(timings),
+        'max_ms': max(timings),
+        # Kilobytes on Linux
+        'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def measure_in_child(params, toolbar, repeat):
+    """
+    Runs ``measure`` in a forked process, so the peak memory it reports is
+    that of this workload alone.
+    """
+    if not hasattr(os, 'fork'):
+        return measure(params, toolbar, repeat)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            result = simplejson.dumps(measure(params, toolbar, repeat))
+        except Exception, e:
+            result = simplejson.dumps({'error': '%s: %s' % (e.__class__.__name__, e)})
+        os.write(write_fd, result)
+        os.close(write_fd)
+        os._exit(0)
+    os.close(write_fd)
+    chunks = []
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return simplejson.loads(''.join(chunks))
+
+
+def runbenchmarks(names=(), repeat=5):
+    from django.core.management import call_command
+    from django.contrib.auth.models import User
+    from tests.benchmarks import WORKLOADS
+
+    call_command('syncdb', verbosity=0, interactive=False)
+    for i in range(10):
+        User.objects.create(username='user%d' % i)
+
+    results = []
+    for name, params in WORKLOADS:
+        if names and name not in names:
+            continue
+        baseline = measure_in_child(params, False, repeat)
+        toolbar = measure_in_child(params, True, repeat)
+        result = {
+            'name': name,
+            'params': params,
+            'baseline': baseline,
+            'toolbar': toolbar,
+        }
+        if 'error' not in baseline and 'error' not in toolbar:
+            result['latency_ratio'] = toolbar['median_ms'] / max(baseline['median_ms'], 0.001)
+            result['latency_overhead_ms'] = toolbar['median_ms'] - baseline['median_ms']
+            result['maxrss_overhead'] = toolbar['maxrss'] - baseline['maxrss']
+            print >>sys.stderr, '%-16s %9.2fms %9.2fms  x%.2f  +%dKB' % (name,
+                baseline['median_ms'], toolbar['median_ms'],
+                result['latency_ratio'], result['maxrss_overhead'])
+        else:
+            print >>sys.stderr, '%-16s failed: %s' % (name,
+                baseline.get('error') or toolbar.get('error'))
+        results.append(result)
+
+    import django
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(previous, current):
+    """
+    Prints how the latency ratio of each workload changed between two runs.
+    """
+    before = dict([(r['name'], r) for r in previous['results']])
+    for result in current['results']:
+        old = before.get(result['name'])
+        if not old or 'latency_ratio' not in old or 'latency_ratio' not in result:
+            continue
+        print >>sys.stderr, '%-16s x%.2f -> x%.2f (%+.0f%%)' % (result['name'],
+            old['latency_ratio'], result['latency_ratio'],
+            (result['latency_ratio'] / old['latency_ratio'] - 1) * 100)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] [workload ...]')
+    parser.add_option('--repeat', type='int', default=5, dest='repeat',
+        help='number of measured requests per workload and mode')
+    parser.add_option('--output', dest='output',
+        help='file to write the results to instead of stdout')
+    parser.add_option('--compare', dest='compare',
+        help='results of an earlier run to compare with')
+
+    (options, args) = parser.parse_args()
+    sys.path.insert(0, dirname(abspath(__file__)))
+
+    report = runbenchmarks(args, repeat=options.repeat)
+    output = simplejson.dumps(report, indent=2)
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            f.write(output)
+        finally:
+            f.close()
+    else:
+        print output
+    if options.compare:
+        f = open(options.compare)
+        try:
+            compare(simplejson.load(f), report)
+        finally:
+            f.close()
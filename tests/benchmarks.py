@@ -0,0 +1,94 @@
+"""
+Synthetic workloads for measuring the overhead of the toolbar, see
+``runbenchmarks.py``.
+
+The ``workload`` view issues ``queries`` queries, renders ``templates``
+templates (nested up to ``MAX_DEPTH`` deep), makes ``cache`` cache calls and
+emits ``logs`` log records, as given in its query string.
+"""
+import logging
+import time
+
+from django.conf.urls.defaults import patterns, url
+from django.contrib.auth.models import User
+from django.core import cache
+from django.http import HttpResponse
+from django.template import Context, Template
+from django.test.client import Client
+
+logger = logging.getLogger('tests.benchmarks')
+
+# (name, parameters of the workload view)
+WORKLOADS = (
+    ('queries-10', {'queries': 10}),
+    ('queries-100', {'queries': 100}),
+    ('queries-1000', {'queries': 1000}),
+    ('queries-10000', {'queries': 10000}),
+    ('templates-10', {'templates': 10}),
+    ('templates-100', {'templates': 100}),
+    ('cache-100', {'cache': 100}),
+    ('cache-1000', {'cache': 1000}),
+    ('logs-100', {'logs': 100}),
+    ('logs-1000', {'logs': 1000}),
+    ('mixed', {'queries': 100, 'templates': 20, 'cache': 100, 'logs': 100}),
+)
+
+# Each nested template takes a dozen stack frames
+MAX_DEPTH = 10
+
+PAGE = Template('<html><body>{{ content }}</body></html>')
+NESTED = Template('<div>{{ level }}{{ inner }}</div>')
+
+
+def render_nested(depth):
+    """
+    Renders ``depth`` templates, each from within the one around it.
+    """
+    if not depth:
+        return ''
+    return NESTED.render(Context({
+        'level': depth,
+        # Callables are called when the variable is resolved, so the inner
+        # template is rendered while the outer one is
+        'inner': lambda: render_nested(depth - 1),
+    }))
+
+
+def workload(request):
+    params = dict([(k, int(request.GET.get(k, 0)))
+        for k in ('queries', 'templates', 'cache', 'logs')])
+    for i in xrange(params['queries']):
+        list(User.objects.filter(pk=i % 10))
+    content = []
+    for i in xrange(0, params['templates'], MAX_DEPTH):
+        content.append(render_nested(min(MAX_DEPTH, params['templates'] - i)))
+    content = ''.join(content)
+    for i in xrange(params['cache']):
+        key = 'benchmark-%d' % (i % 10)
+        if cache.cache.get(key) is None:
+            cache.cache.set(key, i)
+    for i in xrange(params['logs']):
+        logger.info('Benchmark record %d', i)
+    return HttpResponse(PAGE.render(Context({'content': content})))
+
+
+urlpatterns = patterns('',
+    url(r'^workload/$', workload),
+)
+
+
+def run_workload(params, repeat):
+    """
+    Requests the workload view ``repeat`` times and returns the time each
+    request took in ms. The first request isn't counted, it warms up caches.
+    """
+    client = Client()
+    query = '&'.join(['%s=%d' % item for item in params.items()])
+    client.get('/workload/?' + query)
+    timings = []
+    for i in xrange(repeat):
+        start = time.time()
+        response = client.get('/workload/?' + query)
+        timings.append((time.time() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+    return timings
@@ -1,19 +1,51 @@
-from debug_toolbar.middleware import DebugToolbarMiddleware
-from debug_toolbar.panels.sql import SQLDebugPanel
+from debug_toolbar.middleware import DebugToolbarMiddleware, InsertingIterator, \
+    SamplingStats, find_insensitive, insert_before_insensitive, replace_insensitive
+from debug_toolbar.panels.overhead import OverheadDebugPanel
+from debug_toolbar.panels.sql import QueryAggregate, SQLDebugPanel, SQLFormatCache
 from debug_toolbar.panels.request_vars import RequestVarsDebugPanel
-from debug_toolbar.panels.template import TemplateDebugPanel
-from debug_toolbar.toolbar.loader import DebugToolbar
-from debug_toolbar.utils import get_name_from_obj
+from debug_toolbar.panels.template import TemplateDebugPanel, timed_test_render
+from debug_toolbar.panels.timeline import TimelineDebugPanel
+from debug_toolbar.toolbar.history import QUERY_SIZE, REQUEST_SIZE, \
+    FileHistoryStore, MemoryHistoryStore, SQLiteHistoryStore
+from debug_toolbar.toolbar.loader import DebugToolbar, load_panel_class, \
+    load_panel_classes, panel_load_times
+from debug_toolbar.utils import get_name_from_obj, get_stack_frames, media, \
+    resolve_stack_frames, timer
+from debug_toolbar.utils.compat.db import connections
+from debug_toolbar.utils.explain import ExplainPool, PlanCache, \
+    get_explain_pool, run_explain
+from debug_toolbar.utils.fingerprint import fingerprint_sql, normalize_sql
+from debug_toolbar.utils.indexes import advise, get_candidates, \
+    get_clause_columns
+from debug_toolbar.utils.plans import PlanNode, parse_mysql, parse_plan, \
+    parse_postgresql, parse_sqlite
+from debug_toolbar.utils.nplusone import describe_relation
+from debug_toolbar.utils.stacks import StackTable
 from debug_toolbar.utils.tracking import pre_dispatch, post_dispatch, callbacks
+from debug_toolbar.utils.tracking.db import NormalCursorWrapper, QueryRecord
+from debug_toolbar.utils.profiling import profile_query
+from debug_toolbar.views import _count_rows, _execute_page, render_panel, \
+    sql_profile, sql_select, stored_toolbar_json
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import HttpResponse
+from django.core.signals import request_finished
+from django.db import DatabaseError, connection
+from django.db.backends import BaseDatabaseOperations
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.utils import simplejson
+from django.utils.hashcompat import sha_constructor
 from django.template import Template, Context
 
 from dingus import Dingus
+import os
+import shutil
+import sys
+import tempfile
 import thread
+import time
 
 
 class Settings(object):
@@ -207,6 +239,64 @@ class SQLPanelTestCase(BaseTestCase):
         # ensure the stacktrace is populated
         self.assertTrue(len(query[1]['stacktrace']) > 0)
 
+    def test_executemany(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        cursor = connection.cursor()
+        cursor.executemany('INSERT INTO auth_group (name) VALUES (%s)',
+            (('group%d' % i,) for i in range(5)))
+        self.assertEquals(len(panel._queries), 1)
+        query = panel._queries[0][1]
+        self.assertEquals(query['kind'], 'executemany')
+        self.assertEquals(query['batch_size'], 5)
+        self.assertEquals(query['batch_params'],
+            {'count': 5, 'first': '["group0"]', 'last': '["group4"]'})
+        self.assertEquals(query['sql'], 'INSERT INTO auth_group (name) VALUES (group0)')
+
+    def test_callproc(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        cursor = NormalCursorWrapper(Dingus(), connection, panel)
+        cursor.callproc('refresh_stats', [1, 'a'])
+        self.assertEquals(len(panel._queries), 1)
+        query = panel._queries[0][1]
+        self.assertEquals(query['kind'], 'callproc')
+        self.assertEquals(query['sql'], 'refresh_stats(1, "a")')
+        self.assertEquals(query['batch_params'], None)
+
+    def test_fetch_accounting(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        for i in range(3):
+            User.objects.create(username='fetch%d' % i)
+        list(User.objects.all())
+        query = panel._queries[-1][1]
+        self.assertEquals(query['rows'], 3)
+        self.assertTrue(query['exhausted'])
+        self.assertTrue(query['elapsed'] >= query['duration'])
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT username FROM auth_user')
+        cursor.fetchone()
+        query = panel._queries[-1][1]
+        self.assertEquals(query['rows'], 1)
+        self.assertFalse(query['exhausted'])
+        self.assertEquals(len(list(cursor)), 2)
+        query = panel._queries[-1][1]
+        self.assertEquals((query['rows'], query['exhausted']), (3, True))
+
+        # Running the next statement ends the fetching of the previous one
+        cursor.execute('SELECT username FROM auth_user')
+        cursor.fetchone()
+        cursor.execute('SELECT 1')
+        self.assertEquals([q['exhausted'] for a, q in panel._queries[-2:]],
+            [True, False])
+
+    def test_single_row_fetch(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        cursor = NormalCursorWrapper(Dingus(rowcount=1, fetchone__returns=(1,)),
+            connection, panel)
+        cursor.execute('SELECT COUNT(*) FROM auth_user')
+        self.assertEquals(cursor.fetchone(), (1,))
+        self.assertTrue(panel._queries[-1][1]['exhausted'])
+
     def test_disable_stacktraces(self):
         panel = self.toolbar.get_panel(SQLDebugPanel)
         self.assertEquals(len(panel._queries), 0)
@@ -226,6 +316,634 @@ class SQLPanelTestCase(BaseTestCase):
         self.assertEquals([], query[1]['stacktrace'])
 
 
+    def test_formatting_is_deferred(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        list(User.objects.all())
+        panel.process_response(self.request, self.response)
+        query = panel.get_stats()['queries'][0]
+        self.assertFalse('formatted_sql' in query)
+        self.assertFalse('stacktrace_html' in query)
+
+        panel.format_queries()
+        self.assertNotEquals(query['formatted_sql'], query['sql'])
+        self.assertEquals(query['tables'], frozenset(['auth_user']))
+        self.assertTrue('test_formatting_is_deferred' in query['stacktrace_html'])
+        self.assertEquals(panel.get_stats()['tables'], set(['auth_user']))
+
+
+    def test_dupe_queries(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        for pk in (1, 2, 3):
+            list(User.objects.filter(pk=pk))
+        list(User.objects.all())
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SQL_DUPLICATES': True}):
+            panel.process_response(self.request, self.response)
+        dupes = panel.get_stats()['dupe_queries']
+        self.assertEquals([len(d['queries']) for d in dupes], [3, 1])
+        self.assertEquals(dupes[0]['key'], panel._queries[0][1]['fingerprint'])
+        self.assertEquals(panel._queries[2][1]['group'], dupes[0]['key'])
+
+        panel.format_queries()
+        self.assertTrue('auth_user' in dupes[0]['formatted_sql'])
+
+    def test_n_plus_one(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        for pk in range(6):
+            list(User.objects.filter(pk=pk))
+        for pk in range(6):
+            list(User.objects.filter(pk=pk))
+        list(User.objects.all())
+        panel.process_response(self.request, self.response)
+        patterns = panel.get_stats()['n_plus_one']
+        self.assertEquals([p['count'] for p in patterns], [6, 6])
+        path, lineno, func_name, text = patterns[0]['call_site']
+        self.assertEquals(func_name, 'test_n_plus_one')
+        self.assertEquals(text, 'list(User.objects.filter(pk=pk))')
+        self.assertEquals(patterns[0]['model'], 'auth.User')
+        self.assertEquals(patterns[0]['tables'], ['auth_user'])
+        self.assertTrue('Message.user' in patterns[0]['relation'])
+        # Nothing on the call site tells which foreign key was followed
+        self.assertTrue(patterns[0]['relation_candidates'])
+
+    def test_describe_relation(self):
+        self.assertEquals(describe_relation(
+            'SELECT "auth_permission"."id" FROM "auth_permission" '
+            'WHERE "auth_permission"."content_type_id" = %s', ['auth_permission']),
+            ('auth.Permission', 'Permission.content_type', False))
+        self.assertEquals(describe_relation('SELECT 1', []),
+            (None, None, False))
+        sql = ('SELECT "auth_user"."id" FROM "auth_user" '
+            'WHERE "auth_user"."id" = %s')
+        label, relation, candidates = describe_relation(sql, ['auth_user'])
+        self.assertTrue(candidates)
+        self.assertTrue('Message.user' in relation)
+        self.assertEquals(describe_relation(sql, ['auth_user'],
+            ['print message.user.username']),
+            ('auth.User', 'Message.user', False))
+        self.assertEquals(describe_relation(sql, ['auth_user'],
+            ['{{ message.user }}']), ('auth.User', 'Message.user', False))
+        self.assertEquals(describe_relation(sql, ['auth_user'],
+            ['print entry.user']), ('auth.User', 'LogEntry.user', False))
+        # Both Message.user and LogEntry.user could be followed from obj
+        self.assertEquals(describe_relation(sql, ['auth_user'],
+            ['print obj.user']),
+            ('auth.User', 'LogEntry.user, Message.user', True))
+
+
+    def record(self, panel, duration, sql='SELECT %s', params=(1,)):
+        panel.record(QueryRecord(connection, None, 'default', 'sqlite3', sql,
+            params, 0, duration / 1000.0))
+
+    def test_bounded_recording(self):
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SQL_MAX_QUERIES': 3}):
+            panel = SQLDebugPanel(self.toolbar)
+        for duration in (1, 2, 3, 10, 4, 20, 5, 30, 6):
+            self.record(panel, duration)
+        panel.process_response(self.request, self.response)
+        stats = panel.get_stats()
+        # The first three and the three slowest of the rest, in order
+        self.assertEquals([q['duration'] for q in stats['queries']],
+            [1, 2, 3, 10, 20, 30])
+        self.assertEquals(len(stats['aggregates']), 1)
+        aggregate = stats['aggregates'][0]
+        self.assertEquals((aggregate['count'], aggregate['time'],
+            aggregate['min'], aggregate['max']), (3, 15, 4, 6))
+        self.assertEquals(panel._num_queries, 9)
+
+    def test_explain_slow_queries(self):
+        pool = get_explain_pool()
+        pool.cache.clear()
+        panel = SQLDebugPanel(self.toolbar)
+        self.record(panel, 1000, 'SELECT %s AS slow')
+        self.record(panel, 1)
+        panel.process_response(self.request, self.response)
+        # Nothing is explained until the request has finished
+        self.assertEquals(len(pool.cache), 0)
+        pool.flush()
+        pool.join()
+        panel.format_queries()
+        slow, fast = panel.get_stats()['queries']
+        self.assertEquals(slow['plan']['error'], None)
+        self.assertTrue(slow['plan']['rows'])
+        self.assertEquals(slow['plan_nodes'][0]['label'], 'QUERY PLAN')
+        self.assertFalse('plan' in fast)
+        self.assertTrue('djSqlPlan' in panel.content())
+
+    def test_index_advice(self):
+        panel = SQLDebugPanel(self.toolbar)
+        self.record(panel, 5,
+            'SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."email" = %s')
+        self.record(panel, 1,
+            'SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."username" = %s')
+        panel.process_response(self.request, self.response)
+        panel.format_queries()
+        advice = panel.get_stats()['index_advice']
+        self.assertEquals([(s['table'], s['columns'], s['time']) for s in advice],
+            [('auth_user', ('email',), 5)])
+        self.assertTrue('CREATE INDEX' in panel.content())
+
+    def test_truncated_params(self):
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SQL_MAX_PARAMS_BYTES': 10}):
+            panel = SQLDebugPanel(self.toolbar)
+        self.record(panel, 1, params=('x' * 100,))
+        self.record(panel, 1)
+        first, second = [q for a, q in panel._queries]
+        self.assertEquals(first['params'], '["xxxxxxxx...')
+        self.assertEquals(len(first['sql']), len('SELECT %s') + 13)
+        self.assertTrue(first['params_truncated'])
+        self.assertFalse(second['params_truncated'])
+        # The parameters themselves aren't kept
+        self.assertEquals(first.raw_params, None)
+        self.assertEquals(second.raw_params, (1,))
+        self.assertEquals(first['hash'], sha_constructor(settings.SECRET_KEY +
+            'SELECT %s' + '["' + 'x' * 100 + '"]').hexdigest())
+
+    def test_truncated_params_bytes(self):
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SQL_MAX_PARAMS_BYTES': 10}):
+            panel = SQLDebugPanel(self.toolbar)
+        self.record(panel, 1, params=(u'\xe9' * 20,))
+        query = panel._queries[0][1]
+        # Two bytes each, cut after the last whole character
+        self.assertEquals(query['sql'], u'SELECT ' + u'\xe9' * 6 + u'...')
+        self.assertTrue(query['params_truncated'])
+
+    def test_overflow_patterns(self):
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SQL_MAX_QUERIES': 2,
+                'SQL_DUPLICATES': True, 'SQL_DUPE_PARAMS': True}):
+            panel = SQLDebugPanel(self.toolbar)
+            for i in range(10):
+                self.record(panel, 1, params=(i % 2,))
+            panel.process_response(self.request, self.response)
+        stats = panel.get_stats()
+        self.assertEquals(len(stats['queries']), 4)
+        self.assertEquals([p['count'] for p in stats['n_plus_one']], [10])
+        self.assertEquals([d['count'] for d in stats['dupe_queries']], [5, 5])
+        self.assertEquals(sum([len(d['queries'])
+            for d in stats['dupe_queries']]), 4)
+        self.assertTrue('<td>5</td>' in panel.content())
+
+
+class FingerprintTestCase(TestCase):
+    def test_normalize(self):
+        self.assertEquals(normalize_sql(
+            "SELECT  \"t1\".\"a\" FROM t1\n WHERE b = 'it''s' AND c IN (1, 2, 3)"
+            " AND d > -1.5 LIMIT 10 OFFSET 20"),
+            'SELECT "t1"."a" FROM t1 WHERE b = ? AND c IN (?) AND d > ? LIMIT ? OFFSET ?')
+        self.assertEquals(normalize_sql('SELECT a FROM t WHERE b IN (SELECT c FROM u)'),
+            'SELECT a FROM t WHERE b IN (SELECT c FROM u)')
+
+    def test_fingerprint(self):
+        self.assertEquals(fingerprint_sql('SELECT a FROM t WHERE b = %s'),
+            fingerprint_sql('SELECT a FROM t  WHERE b = 42'))
+        self.assertNotEquals(fingerprint_sql('SELECT a FROM t'),
+            fingerprint_sql('SELECT b FROM t'))
+        self.assertEquals(len(fingerprint_sql('SELECT 1')), 16)
+
+
+class QueryRecordTestCase(TestCase):
+    def test_lazy_values(self):
+        query = QueryRecord(connection, None, 'default', 'sqlite3',
+            'SELECT %s', ('a',), 1.0, 1.5)
+        self.assertEquals(query._values, {})
+        self.assertEquals(query['duration'], 500)
+        self.assertEquals(query['params'], '["a"]')
+        self.assertTrue(query['is_select'])
+        self.assertEquals(query['sql'], 'SELECT a')
+        self.assertEquals(sorted(query._values), ['is_select', 'params', 'sql'])
+        self.assertEquals(query['hash'], sha_constructor(
+            settings.SECRET_KEY + 'SELECT %s' + '["a"]').hexdigest())
+
+    def test_executed_sql(self):
+        class ExecutedQueryOps(BaseDatabaseOperations):
+            # Like psycopg2's
+            def last_executed_query(self, cursor, sql, params):
+                return cursor.query
+        db = Dingus(ops=ExecutedQueryOps())
+        query = QueryRecord(db, Dingus(query='SELECT 1'), 'default',
+            'postgresql', 'SELECT 1', (), 1.0, 1.5)
+        self.assertEquals(query['sql'], 'SELECT 1')
+        # The cursor of a batch only holds its last row
+        query = QueryRecord(db, Dingus(query='INSERT INTO t VALUES (2)'),
+            'default', 'postgresql', 'INSERT INTO t VALUES (%s)', (1,), 1.0,
+            1.5, kind='executemany', batch_size=2, batch_last=(2,))
+        self.assertEquals(query['sql'], 'INSERT INTO t VALUES (1)')
+        self.assertTrue(query['hash'])
+
+    def test_dict_access(self):
+        query = QueryRecord(connection, None, 'default', 'sqlite3',
+            'SELECT 1', (), 1.0, 1.5)
+        query['alias'] = 'other'
+        query['tables'] = set(['t'])
+        self.assertEquals(query.alias, 'other')
+        self.assertTrue('tables' in query and 'hash' in query)
+        self.assertFalse('missing' in query)
+        self.assertEquals(query.get('missing', 1), 1)
+        self.assertRaises(KeyError, lambda: query['missing'])
+        self.assertEquals(query.to_dict()['tables'], set(['t']))
+
+
+class QueryAggregateTestCase(TestCase):
+    def test_percentile(self):
+        aggregate = QueryAggregate('default', 'abc', 'SELECT 1')
+        for duration in range(1000):
+            aggregate.add(duration)
+        self.assertEquals(len(aggregate.sample), aggregate.sample_size)
+        stats = aggregate.get_stats()
+        self.assertEquals((stats['count'], stats['min'], stats['max']), (1000, 0, 999))
+        self.assertTrue(800 < stats['p95'] < 1000)
+
+
+class SQLFormatCacheTestCase(TestCase):
+    def test_hits_and_misses(self):
+        cache = SQLFormatCache()
+        html, tables = cache.format('SELECT "id" FROM "auth_user"')
+        self.assertEquals(tables, frozenset(['auth_user']))
+        self.assertEquals(cache.format('SELECT "id" FROM "auth_user"'),
+            (html, tables))
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
+
+    def test_statement_shared_by_params(self):
+        cache = SQLFormatCache()
+        sql = 'SELECT "id" FROM "auth_user" WHERE "username" = %s AND "id" > %s'
+        html, tables = cache.format_statement(sql, ["it's", 1])
+        self.assertTrue("'it''s'" in html or "&#39;it&#39;&#39;s&#39;" in html)
+        self.assertTrue('djdtparam' not in html)
+        self.assertEquals(tables, frozenset(['auth_user']))
+        html, tables = cache.format_statement(sql, ['bob', None])
+        self.assertTrue('NULL' in html)
+        # One entry for the statement, whatever its parameters
+        self.assertEquals((len(cache), cache.hits), (1, 1))
+        self.assertEquals(cache.format_statement(sql, [1]), None)
+
+    def test_evicts_least_recently_used(self):
+        cache = SQLFormatCache(max_entries=4)
+        for i in range(4):
+            cache.format('SELECT %d' % i)
+        cache.format('SELECT 0')
+        cache.format('SELECT 4')
+        # A quarter of the oldest entries is evicted
+        self.assertEquals(len(cache), 3)
+        self.assertEquals(sorted(cache._entries),
+            ['SELECT 0', 'SELECT 3', 'SELECT 4'])
+
+
+class ExplainTestCase(TestCase):
+    def explain(self, alias, sql, params):
+        return {'headers': ['detail'], 'rows': [(sql,)], 'error': None}
+
+    def test_run_explain(self):
+        headers, rows = run_explain('default', connection.cursor(),
+            'SELECT * FROM auth_user WHERE id = %s', [1])
+        self.assertTrue(headers and rows)
+
+    def test_plain_explain_fallback(self):
+        class OldServerCursor(object):
+            description = [('id',), ('select_type',), ('table',)]
+            def __init__(self):
+                self.executed = []
+            def execute(self, sql, params=()):
+                self.executed.append(sql)
+                if 'FORMAT=JSON' in sql:
+                    raise DatabaseError('You have an error in your SQL syntax')
+            def fetchall(self):
+                return [(1, 'SIMPLE', 'auth_user')]
+        from debug_toolbar.utils import explain
+        get_engine = explain.get_engine
+        # Savepoints aren't needed on MySQL
+        explain.get_engine = lambda alias: 'MySQLdb'
+        try:
+            cursor = OldServerCursor()
+            headers, rows = run_explain('default', cursor,
+                'SELECT * FROM auth_user', ())
+        finally:
+            explain.get_engine = get_engine
+        self.assertEquals((headers, rows),
+            (['id', 'select_type', 'table'], [(1, 'SIMPLE', 'auth_user')]))
+        self.assertEquals(cursor.executed, [
+            'EXPLAIN FORMAT=JSON SELECT * FROM auth_user',
+            'EXPLAIN SELECT * FROM auth_user'])
+
+    def test_explained_once(self):
+        pool = ExplainPool(workers=1)
+        pool.explain = self.explain
+        pool.is_inline = lambda alias: False
+        self.assertTrue(pool.defer('default', 'abc', 'SELECT 1', ()))
+        self.assertFalse(pool.defer('default', 'abc', 'SELECT 2', ()))
+        self.assertEquals(pool._threads, [])
+        pool.flush()
+        pool.join()
+        self.assertEquals(pool.cache.get(('default', 'abc'))['rows'],
+            [('SELECT 1',)])
+        self.assertFalse(pool.defer('default', 'abc', 'SELECT 1', ()))
+        self.assertTrue(pool.defer('other', 'abc', 'SELECT 1', ()))
+
+    def test_transaction_released(self):
+        def explain(alias, sql, params):
+            cursor = connections[alias].cursor()
+            if sql == 'INSERT':
+                cursor.execute('CREATE TEMP TABLE djdt_explain (a)')
+                # Opens a transaction
+                cursor.execute('INSERT INTO djdt_explain VALUES (1)')
+            else:
+                cursor.execute('SELECT COUNT(*) FROM djdt_explain')
+            return {'rows': cursor.fetchall()}
+        pool = ExplainPool(workers=1)
+        pool.explain = explain
+        pool.is_inline = lambda alias: False
+        pool.defer('default', 'insert', 'INSERT', ())
+        pool.flush()
+        pool.join()
+        pool.defer('default', 'count', 'COUNT', ())
+        pool.flush()
+        pool.join()
+        # The insert of the first job was rolled back after it
+        self.assertEquals(pool.cache.get(('default', 'count'))['rows'], [(0,)])
+
+    def test_in_memory_inline(self):
+        # The test database is in memory, a worker wouldn't see its tables
+        pool = ExplainPool(workers=1)
+        self.assertTrue(pool.is_inline('default'))
+        pool.defer('default', 'abc', 'SELECT * FROM auth_user', ())
+        pool.flush()
+        self.assertEquals(pool._threads, [])
+        plan = pool.cache.get(('default', 'abc'))
+        self.assertEquals(plan['error'], None)
+        self.assertTrue(plan['rows'])
+
+    def test_bounded(self):
+        pool = ExplainPool(workers=1, max_pending=1)
+        self.assertTrue(pool.defer('default', 'abc', 'SELECT 1', ()))
+        self.assertFalse(pool.defer('default', 'def', 'SELECT 2', ()))
+        self.assertEquals(pool.dropped, 1)
+
+    def test_error(self):
+        plan = ExplainPool().explain('default', 'SELECT * FROM missing', ())
+        self.assertTrue(plan['error'])
+
+    def test_plan_cache_eviction(self):
+        cache = PlanCache(max_entries=4)
+        for i in range(4):
+            cache.set(i, {})
+        cache.get(0)
+        cache.set(4, {})
+        self.assertEquals(sorted(cache._entries), [0, 3, 4])
+
+
+class PlanParserTestCase(TestCase):
+    def load(self, name):
+        path = os.path.join(os.path.dirname(__file__), 'plans', name)
+        return simplejson.load(open(path))
+
+    def labels(self, plan):
+        return [(depth, node.label) for depth, node in plan.walk()]
+
+    def test_sqlite(self):
+        fixture = self.load('sqlite_join.json')
+        plan = parse_sqlite(fixture['headers'], fixture['rows'])
+        self.assertEquals(self.labels(plan), [
+            (0, 'QUERY PLAN'),
+            (1, 'SEARCH auth_user USING INTEGER PRIMARY KEY (rowid=?)'),
+            (1, 'LIST SUBQUERY 1'),
+            (2, 'SCAN auth_user'),
+            (1, 'SEARCH auth_group USING INTEGER PRIMARY KEY (rowid=?)'),
+            (1, 'USE TEMP B-TREE FOR ORDER BY'),
+        ])
+        self.assertEquals(plan.get_warnings(),
+            ['Full table scan', 'Temporary B-tree for ORDER BY'])
+
+    def test_sqlite_legacy(self):
+        fixture = self.load('sqlite_legacy.json')
+        plan = parse_sqlite(fixture['headers'], fixture['rows'])
+        scan, search, subquery, select, temp = plan.children
+        self.assertEquals((scan.label, scan.rows, scan.warnings),
+            ('SCAN TABLE auth_user', 100000, ['Full table scan']))
+        self.assertEquals(search.rows, 1)
+        self.assertEquals(select.label, 'SELECT #1')
+        # Scanning a covering index isn't flagged
+        self.assertEquals(select.children[0].warnings, [])
+
+    def test_postgresql(self):
+        plan = parse_postgresql(self.load('postgresql_sort.json'))
+        self.assertEquals(self.labels(plan), [
+            (0, 'Sort'),
+            (1, 'Hash Join'),
+            (2, 'Seq Scan on auth_user u'),
+            (2, 'Hash'),
+            (3, 'Index Scan using auth_group_pkey on auth_group g'),
+        ])
+        self.assertEquals((plan.cost, plan.rows), (12295.32, 100000))
+        self.assertEquals(plan.warnings, ['Sort spills to disk'])
+        self.assertTrue(('Sort Key', 'u.username, g.name') in plan.details)
+        self.assertEquals(plan.get_warnings(),
+            ['Sort spills to disk', 'Full table scan'])
+        # The string output of older versions of psycopg2
+        plan = parse_plan('psycopg2', ['QUERY PLAN'],
+            [(simplejson.dumps(self.load('postgresql_sort.json')),)])
+        self.assertEquals(plan.label, 'Sort')
+
+    def test_mysql(self):
+        plan = parse_mysql(self.load('mysql_filesort.json'))
+        self.assertEquals(self.labels(plan), [
+            (0, 'Query block #1'),
+            (1, 'Ordering operation'),
+            (2, 'Nested loop'),
+            (3, 'ALL on auth_user'),
+            (3, 'eq_ref on auth_group using PRIMARY'),
+            (4, 'Query block #2'),
+            (5, 'index on auth_permission using auth_permission_content_type_id'),
+        ])
+        self.assertEquals(plan.cost, 24112.4)
+        self.assertEquals(plan.get_warnings(), ['Using filesort',
+            'Using temporary table', 'Full table scan', 'Full index scan'])
+
+    def test_flatten(self):
+        plan = parse_postgresql(self.load('postgresql_sort.json'))
+        nodes = plan.flatten('plan')
+        self.assertEquals([n['id'] for n in nodes],
+            ['plan', 'plan_0', 'plan_0_0', 'plan_0_1', 'plan_0_1_0'])
+        self.assertEquals(nodes[-1]['parent_ids'],
+            ['plan', 'plan_0', 'plan_0_1'])
+        self.assertFalse(nodes[-1]['has_children'])
+
+    def test_unknown(self):
+        self.assertEquals(parse_plan('psycopg2', ['QUERY PLAN'],
+            [('Seq Scan on auth_user',)]), None)
+        self.assertEquals(parse_plan('other', [], []), None)
+
+
+class IndexAdvisorTestCase(TestCase):
+    sql = ('SELECT U0."id" FROM "auth_user" U0 INNER JOIN "auth_group" T3 '
+        'ON (U0."group_id" = T3."id") WHERE (U0."email" = %s '
+        'AND T3."name" IN (%s, %s) AND is_staff = %s) '
+        'ORDER BY U0."last_name" DESC LIMIT 21')
+
+    def query(self, sql, duration=1, fingerprint=None):
+        return {'alias': 'default', 'raw_sql': sql, 'duration': duration,
+            'fingerprint': fingerprint or fingerprint_sql(sql)}
+
+    def test_clause_columns(self):
+        columns, aliases = get_clause_columns(self.sql)
+        self.assertEquals(columns, [
+            ('join', 'auth_user', 'group_id'),
+            ('join', 'auth_group', 'id'),
+            ('where', 'auth_user', 'email'),
+            ('where', 'auth_group', 'name'),
+            ('where', 'auth_user', 'is_staff'),
+            ('order', 'auth_user', 'last_name'),
+        ])
+        self.assertEquals((aliases['U0'], aliases['T3']),
+            ('auth_user', 'auth_group'))
+        columns, aliases = get_clause_columns(
+            'SELECT a FROM t AS x, u y WHERE x.a = 1 AND UPPER(y.b) = %s')
+        self.assertEquals(columns, [('where', 't', 'a'), ('where', 'u', 'b')])
+
+    def test_candidates(self):
+        candidates, aliases = get_candidates(self.sql, 'abc')
+        self.assertEquals(candidates, [
+            ('auth_group', ('name',)),
+            ('auth_user', ('email', 'is_staff', 'last_name')),
+            ('auth_user', ('group_id',)),
+            ('auth_group', ('id',)),
+        ])
+        # Memoized by fingerprint
+        self.assertEquals(get_candidates('SELECT 1', 'abc')[0], candidates)
+
+    def test_advise(self):
+        sql = 'SELECT * FROM "auth_user" WHERE "auth_user"."last_name" = %s'
+        advice = advise([
+            self.query(self.sql, 3),
+            self.query(self.sql, 2),
+            self.query(sql, 10),
+            self.query('SELECT * FROM "auth_user" WHERE "id" = %s', 20),
+            self.query('UPDATE "auth_user" SET "email" = %s WHERE "email" = %s', 30),
+        ])
+        self.assertEquals([(s['table'], s['columns'], s['count'], s['time'])
+            for s in advice], [
+            ('auth_user', ('last_name',), 1, 10),
+            ('auth_user', ('email', 'is_staff', 'last_name'), 2, 5),
+            ('auth_user', ('group_id',), 2, 5),
+        ])
+        # auth_group.name and the primary keys are indexed
+        self.assertEquals(advice[0]['create_sql'],
+            'CREATE INDEX "auth_user_last_name" ON "auth_user" ("last_name");')
+
+    def test_plan(self):
+        plan = PlanNode('QUERY PLAN')
+        plan.add(PlanNode('SCAN U0', warnings=['Full table scan'], table='U0'))
+        plan.add(PlanNode('SEARCH T3', table='T3'))
+        query = self.query(self.sql)
+        self.assertEquals([(s['columns'], s['full_scan'])
+            for s in advise([query], lambda alias, fp: plan)],
+            [(('email', 'is_staff', 'last_name'), True), (('group_id',), True)])
+        # Tables the plan doesn't scan in full are taken to be indexed
+        plan.children[0].warnings = []
+        self.assertEquals(advise([query], lambda alias, fp: plan), [])
+
+
+class SQLSelectTestCase(TestCase):
+    sql = 'SELECT "username" FROM "auth_user" WHERE "id" > %s ORDER BY "username"'
+
+    def setUp(self):
+        for i in range(25):
+            User.objects.create(username='user%02d' % i)
+
+    def select(self, page=None, iterate=True):
+        params = simplejson.dumps([0])
+        data = {'sql': self.sql, 'params': params, 'hash': sha_constructor(
+            settings.SECRET_KEY + self.sql + params).hexdigest()}
+        if page is not None:
+            data['page'] = page
+        config = {'SQL_SELECT_PAGE_SIZE': 10, 'SQL_SELECT_MAX_ROWS': 22}
+        with Settings(DEBUG_TOOLBAR_CONFIG=config):
+            response = sql_select(RequestFactory().get('/__debug__/sql_select/', data))
+        if not iterate:
+            return response
+        return ''.join(response)
+
+    def test_pages(self):
+        content = self.select()
+        self.assertEquals(content.count('<td>user'), 10)
+        self.assertTrue('<td>user00</td>' in content)
+        self.assertTrue('25 (only the first 22 can be shown)' in content)
+        self.assertTrue('page=2' in content)
+        content = self.select(2)
+        self.assertTrue('<td>user10</td>' in content)
+        self.assertTrue('page=1' in content and 'page=3' in content)
+        # The last page stops at SQL_SELECT_MAX_ROWS
+        content = self.select(5)
+        self.assertEquals(content.count('<td>user'), 2)
+        self.assertTrue('<td>user21</td>' in content)
+        self.assertFalse('page=4' in content)
+
+    def test_count_rows(self):
+        self.assertEquals(_count_rows('default', self.sql, [0]), 25)
+        self.assertEquals(_count_rows('default', 'SELECT * FROM missing', []), None)
+
+    def test_execute_page(self):
+        cursor = connection.cursor()
+        # One more row than the page tells there are more
+        self.assertEquals(_execute_page('default', cursor, self.sql, [0], 10, 10), 0)
+        self.assertEquals([row[0] for row in cursor.fetchall()],
+            ['user%02d' % i for i in range(10, 21)])
+        # A statement with a LIMIT of its own is paged in a subquery
+        self.assertEquals(_execute_page('default', cursor,
+            self.sql + ' LIMIT 12', [0], 10, 10), 0)
+        self.assertEquals(len(cursor.fetchall()), 2)
+
+    def test_request_finished(self):
+        # The connection may be closed before the response is iterated
+        cursors = []
+        conn = connections['default']
+        def cursor():
+            cursors.append(conn.__class__.cursor(conn))
+            return cursors[-1]
+        def close_cursors(**kwargs):
+            for c in cursors:
+                getattr(c, 'cursor', c).close()
+        conn.cursor = cursor
+        request_finished.connect(close_cursors)
+        try:
+            response = self.select(iterate=False)
+            request_finished.send(sender=self.__class__)
+        finally:
+            request_finished.disconnect(close_cursors)
+            del conn.cursor
+        content = ''.join(response)
+        self.assertEquals(content.count('<td>user'), 10)
+        self.assertTrue('page=2' in content)
+
+
+class ProfilingTestCase(TestCase):
+    sql = 'SELECT "username" FROM "auth_user" WHERE "id" > %s'
+
+    def setUp(self):
+        for i in range(5):
+            User.objects.create(username='user%d' % i)
+
+    def test_sqlite(self):
+        profile = profile_query('default', self.sql, [0], repeat=3)
+        steps, rows = profile['rows']
+        self.assertEquals(steps[0], 'VM steps')
+        self.assertTrue(steps[1] > 0)
+        self.assertEquals(rows, ('Rows', 5))
+        timings = profile['timings']
+        self.assertEquals(timings['count'], 3)
+        self.assertTrue(timings['min'] <= timings['median'] <= timings['p95'] <= timings['max'])
+        self.assertEquals(profile['sql'], self.sql.replace('%s', '0'))
+        # Runs are capped at MAX_REPEAT
+        self.assertEquals(profile_query('default', self.sql, [0], repeat=500)['timings']['count'], 100)
+
+    def test_view(self):
+        params = simplejson.dumps([0])
+        data = {'sql': self.sql, 'params': params, 'repeat': 4, 'hash':
+            sha_constructor(settings.SECRET_KEY + self.sql + params).hexdigest()}
+        content = sql_profile(RequestFactory().get('/__debug__/sql_profile/', data)).content
+        self.assertTrue('Time over 4 runs' in content)
+        self.assertTrue('VM steps' in content)
+        self.assertTrue('repeat=20' in content)
+
+
 class TemplatePanelTestCase(BaseTestCase):
     def test_queryset_hook(self):
         template_panel = self.toolbar.get_panel(TemplateDebugPanel)
@@ -374,3 +1092,437 @@ class TrackingTestCase(BaseTestCase):
         self.assertTrue(len(foo['kwargs']), 1)
         self.assertTrue('foo' in foo['kwargs'])
         self.assertEquals(foo['kwargs']['foo'], 'bar')
+
+class LazyRenderingTestCase(BaseTestCase):
+    def test_store_and_fetch(self):
+        self.toolbar.store()
+        self.assertTrue(self.toolbar.store_id)
+        self.assertTrue(DebugToolbar.fetch(self.toolbar.store_id) is self.toolbar)
+        self.assertEquals(DebugToolbar.fetch('unknown'), None)
+
+    def test_get_panel_by_id(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        self.assertTrue(self.toolbar.get_panel_by_id(panel.dom_id()) is panel)
+        self.assertEquals(self.toolbar.get_panel_by_id('djDebugUnknownPanel'), None)
+
+class MediaTestCase(TestCase):
+    def test_get_media_is_cached(self):
+        first = media.get_media('js/toolbar.bundle.js')
+        self.assertTrue(first is media.get_media('js/toolbar.bundle.js'))
+        self.assertTrue('window.djdt' in first.content)
+        self.assertEquals(len(first.digest), 12)
+
+    def test_get_media_outside_root(self):
+        self.assertEquals(media.get_media('../views.py'), None)
+        self.assertEquals(media.get_media('../../setup.js'), None)
+        self.assertEquals(media.get_media('img/close.png'), None)
+
+    def test_fingerprint(self):
+        css = media.get_media('css/toolbar.bundle.css')
+        url = media.media_url('/__debug__/m/', 'css/toolbar.bundle.css')
+        self.assertEquals(url, '/__debug__/m/css/toolbar.bundle.%s.css' % css.digest)
+        self.assertEquals(media.split_fingerprint(url[len('/__debug__/m/'):]),
+            ('css/toolbar.bundle.css', css.digest))
+        self.assertEquals(media.split_fingerprint('css/toolbar.css'),
+            ('css/toolbar.css', None))
+
+    def test_gzipped(self):
+        import gzip
+        from cStringIO import StringIO
+        css = media.get_media('css/toolbar.bundle.css')
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO(css.gzipped)).read(), css.content)
+
+class InsertionTestCase(TestCase):
+    def test_insert_before_insensitive(self):
+        self.assertEquals(
+            insert_before_insensitive('<html><BODY></BODY></html>', '</body>', 'djdt'),
+            '<html><BODY>djdt</BODY></html>')
+        self.assertEquals(
+            insert_before_insensitive('<html></html>', '</body>', 'djdt'), None)
+
+    def test_insert_in_large_content(self):
+        content = '<html><body>' + 'x' * 100000 + '</body>' + 'y' * 20000 + '</html>'
+        result = insert_before_insensitive(content, '</body>', 'djdt')
+        self.assertEquals(result, content.replace('</body>', 'djdt</body>'))
+
+    def test_find_across_windows(self):
+        for padding in range(0, 20):
+            content = 'x' * 8180 + '</body>' + 'y' * padding
+            self.assertEquals(find_insensitive(content, '</BODY>'), 8180)
+
+    def test_replace_insensitive(self):
+        self.assertEquals(
+            replace_insensitive('<p></P><p></P>', '</p>', '</div>'),
+            '<p></P><p></div>')
+
+    def test_inserting_iterator(self):
+        chunks = ['<html><body>', 'x' * 10000, '</bo', u'dy>', 'y' * 100, '</html>']
+        iterator = InsertingIterator(chunks, '</body>', 'djdt', 'utf-8')
+        result = list(iterator)
+        self.assertTrue(len(result) > 1)
+        self.assertEquals(''.join(result),
+            '<html><body>' + 'x' * 10000 + 'djdt</body>' + 'y' * 100 + '</html>')
+
+class PanelRegistryTestCase(BaseTestCase):
+    def test_panels_are_resolved_once(self):
+        classes = list(load_panel_classes())
+        self.assertTrue(SQLDebugPanel in classes)
+        self.assertEquals(len(panel_load_times), len(classes))
+        self.assertEquals(load_panel_classes(), classes)
+        toolbar = DebugToolbar(self.request)
+        self.assertEquals([p.__class__ for p in toolbar.panels], classes)
+        self.assertTrue(toolbar.get_panel(SQLDebugPanel) is not
+            self.toolbar.get_panel(SQLDebugPanel))
+
+    def test_load_panel_class(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.assertTrue(load_panel_class('debug_toolbar.panels.sql.SQLDebugPanel') is SQLDebugPanel)
+        self.assertRaises(ImproperlyConfigured, load_panel_class, 'SQLDebugPanel')
+        self.assertRaises(ImproperlyConfigured, load_panel_class, 'debug_toolbar.panels.sql.Unknown')
+        self.assertRaises(ImproperlyConfigured, load_panel_class, 'debug_toolbar.panels.sql.reformat_sql')
+
+class SamplingTestCase(BaseTestCase):
+    def test_sample_rate(self):
+        request = self.request
+        request.META = {'REMOTE_ADDR': '127.0.0.1'}
+        request.COOKIES = {}
+        request.path_info = '/api/items/'
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SAMPLE_RATE': 0}):
+            middleware = DebugToolbarMiddleware()
+        self.assertFalse(middleware.should_sample(request))
+
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SAMPLE_RATE': 1}):
+            middleware = DebugToolbarMiddleware()
+        self.assertTrue(middleware.should_sample(request))
+
+    def test_sample_rate_prefixes(self):
+        request = self.request
+        request.META = {'REMOTE_ADDR': '127.0.0.1'}
+        request.COOKIES = {}
+        with Settings(DEBUG_TOOLBAR_CONFIG={
+                'SAMPLE_RATE': 0,
+                'SAMPLE_RATE_PREFIXES': {'/api/': 0.5, '/api/items/': 1}}):
+            middleware = DebugToolbarMiddleware()
+        request.path_info = '/api/items/1/'
+        self.assertEquals(middleware.get_sample_rate(request), 1)
+        request.path_info = '/api/users/'
+        self.assertEquals(middleware.get_sample_rate(request), 0.5)
+        request.path_info = '/'
+        self.assertEquals(middleware.get_sample_rate(request), 0)
+
+    def test_forced_sampling(self):
+        request = self.request
+        request.path_info = '/'
+        with Settings(DEBUG_TOOLBAR_CONFIG={'SAMPLE_RATE': 0}):
+            middleware = DebugToolbarMiddleware()
+        request.META = {'HTTP_X_DEBUG_TOOLBAR_SAMPLE': '1'}
+        request.COOKIES = {}
+        self.assertTrue(middleware.should_sample(request))
+        request.META = {}
+        request.COOKIES = {'djdt_sample': '1'}
+        self.assertTrue(middleware.should_sample(request))
+
+    def test_sampling_stats(self):
+        stats = SamplingStats()
+        stats.add_request(True)
+        stats.add_request(False)
+        stats.add_overhead(3.0)
+        self.assertEquals(stats.sampled_fraction(), 0.5)
+        self.assertEquals(stats.mean_overhead(), 3.0)
+
+class HeadlessCaptureTestCase(TestCase):
+    def process(self, response, view=None, **extra):
+        request = RequestFactory().get('/api/items/', **extra)
+        with Settings(DEBUG_TOOLBAR_CONFIG={'CAPTURE_HEADLESS': True,
+                                           'RENDER_PANELS': False}):
+            toolbar = DebugToolbar(request)
+        for panel in toolbar.panels:
+            panel.process_request(request)
+        middleware = DebugToolbarMiddleware()
+        DebugToolbarMiddleware.debug_toolbars[thread.get_ident()] = toolbar
+        if view is not None:
+            view()
+        return toolbar, middleware.process_response(request, response)
+
+    def test_json_response(self):
+        toolbar, response = self.process(
+            HttpResponse('{"items": []}', mimetype='application/json'))
+        self.assertEquals(response.content, '{"items": []}')
+        self.assertEquals(response['X-Debug-Toolbar-Id'], toolbar.store_id)
+        self.assertTrue(DebugToolbar.fetch(toolbar.store_id) is toolbar)
+
+    def test_ajax_response(self):
+        toolbar, response = self.process(HttpResponse('<p>fragment</p></body>'),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEquals(response.content, '<p>fragment</p></body>')
+        self.assertEquals(response['X-Debug-Toolbar-Id'], toolbar.store_id)
+
+    def test_html_response(self):
+        toolbar, response = self.process(HttpResponse('<html><body></body></html>'))
+        self.assertFalse(response.has_header('X-Debug-Toolbar-Id'))
+        self.assertTrue('djDebug' in response.content)
+
+    def test_stats_json(self):
+        toolbar, response = self.process(
+            HttpResponse('{}', mimetype='application/json'))
+        toolbar.stats['custom'] = {'tags': set(['a']), 'obj': object()}
+        request = RequestFactory().get('/')
+        data = simplejson.loads(stored_toolbar_json(request, toolbar.store_id).content)
+        self.assertEquals(data['id'], toolbar.store_id)
+        self.assertEquals(data['path'], '/api/items/')
+        self.assertEquals(data['stats']['custom']['tags'], ['a'])
+
+    def test_invalid_store_id(self):
+        request = RequestFactory().get('/')
+        self.assertRaises(Http404, stored_toolbar_json, request, '..')
+        self.assertRaises(Http404, render_panel,
+            RequestFactory().get('/', {'store_id': '../../etc/passwd'}))
+        self.assertEquals(DebugToolbar.fetch('../' + 'a' * 29), None)
+
+    def test_n_plus_one(self):
+        def view():
+            for pk in range(10):
+                list(User.objects.filter(pk=pk))
+        toolbar, response = self.process(
+            HttpResponse('{}', mimetype='application/json'), view)
+        self.assertEquals(response['X-Debug-Toolbar-N-Plus-One'], '1')
+        request = RequestFactory().get('/')
+        data = simplejson.loads(stored_toolbar_json(request, toolbar.store_id).content)
+        self.assertEquals(data['summary']['n_plus_one'], 1)
+        pattern = data['stats']['sql']['n_plus_one'][0]
+        self.assertEquals(pattern['count'], 10)
+        self.assertEquals(pattern['call_site'][2], 'view')
+
+class FakeToolbar(object):
+    def __init__(self, path, sql_time=0):
+        self.request = RequestFactory().get(path)
+        self.stats = {'sql': {'queries': [{}], 'sql_time': sql_time}}
+
+    def render_toolbar(self, render_panels=None):
+        return '<div id="djDebug">%s</div>' % self.request.path
+
+class HistoryTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_eviction(self, store):
+        first = store.add(FakeToolbar('/first/'))
+        second = store.add(FakeToolbar('/second/'))
+        # Using the first request makes the second the least recently used
+        self.assertEquals(store.get(first).path, '/first/')
+        third = store.add(FakeToolbar('/third/', sql_time=2.5))
+        self.assertEquals(store.get(second), None)
+        records = store.list()
+        self.assertEquals([r.store_id for r in records], [third, first])
+        self.assertEquals(records[0].summary['query_count'], 1)
+        self.assertEquals(records[0].summary['sql_time'], 2.5)
+        store.clear()
+        self.assertEquals(store.list(), [])
+
+    def test_memory_store(self):
+        store = MemoryHistoryStore(max_entries=2)
+        self.check_eviction(store)
+        toolbar = FakeToolbar('/')
+        self.assertTrue(store.get(store.add(toolbar)).toolbar is toolbar)
+
+    def test_memory_store_bytes(self):
+        store = MemoryHistoryStore(max_entries=10, max_bytes=1)
+        first = store.add(FakeToolbar('/first/'))
+        second = store.add(FakeToolbar('/second/'))
+        self.assertEquals(store.get(first), None)
+        self.assertTrue(store.get(second) is not None)
+
+    def test_file_store(self):
+        store = FileHistoryStore(max_entries=2, path=os.path.join(self.tmpdir, 'h'))
+        self.check_eviction(store)
+        self.assertEquals(store.get('../h/' + store.add(FakeToolbar('/'))), None)
+        record = store.get(store.add(FakeToolbar('/')))
+        self.assertEquals(record.render_toolbar(), '<div id="djDebug">/</div>')
+        self.assertEquals(simplejson.loads(record.stats_json())['sql']['sql_time'], 0)
+        self.assertEquals(record.get_queries(), [{}])
+
+    def test_deferred_file_store(self):
+        store = FileHistoryStore(max_entries=2, path=os.path.join(self.tmpdir, 'h'))
+        toolbar = FakeToolbar('/')
+        toolbar.html = '<div id="djDebug">rendered once</div>'
+        store_id = store.defer(toolbar)
+        self.assertEquals(store.get(store_id), None)
+        store.flush()
+        self.assertEquals(store.get(store_id).render_toolbar(), toolbar.html)
+
+    def test_memory_store_estimate(self):
+        store = MemoryHistoryStore(max_entries=10)
+        query = QueryRecord(connection, None, 'default', 'sqlite3',
+            'SELECT %s', (1,), 1.0, 1.5)
+        toolbar = FakeToolbar('/')
+        toolbar.stats['sql']['queries'] = [query]
+        record = store.get(store.defer(toolbar))
+        self.assertEquals(record.size, REQUEST_SIZE + QUERY_SIZE + 9)
+        # None of the values left until the query is displayed are computed
+        self.assertEquals(query._values, {})
+
+    def test_sqlite_store(self):
+        store = SQLiteHistoryStore(max_entries=2,
+            path=os.path.join(self.tmpdir, 'history.db'))
+        self.check_eviction(store)
+        record = store.get(store.add(FakeToolbar('/')))
+        self.assertEquals(record.render_toolbar(), '<div id="djDebug">/</div>')
+
+class ToolbarCleanupTestCase(TestCase):
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        with Settings(DEBUG_TOOLBAR_CONFIG={'INTERCEPT_REDIRECTS': False}):
+            self.toolbar = DebugToolbar(self.request)
+        for panel in self.toolbar.panels:
+            panel.process_request(self.request)
+        DebugToolbarMiddleware.debug_toolbars[thread.get_ident()] = self.toolbar
+
+    def test_redirect(self):
+        DebugToolbarMiddleware().process_response(self.request,
+            HttpResponseRedirect('/'))
+        self.assertEquals(DebugToolbarMiddleware.get_current(), None)
+
+    def test_failing_panel(self):
+        panel = self.toolbar.panels[0]
+        def process_response(request, response):
+            raise ValueError
+        panel.process_response = process_response
+        self.assertRaises(ValueError, DebugToolbarMiddleware().process_response,
+            self.request, HttpResponse('<html><body></body></html>'))
+        self.assertEquals(DebugToolbarMiddleware.get_current(), None)
+
+    def test_propagated_exception(self):
+        middleware = DebugToolbarMiddleware()
+        middleware.process_exception(self.request, ValueError())
+        self.assertTrue(DebugToolbarMiddleware.get_current() is self.toolbar)
+        with Settings(DEBUG_PROPAGATE_EXCEPTIONS=True):
+            middleware.process_exception(self.request, ValueError())
+        self.assertEquals(DebugToolbarMiddleware.get_current(), None)
+
+    def test_request_finished(self):
+        request_finished.send(sender=self.__class__)
+        self.assertEquals(DebugToolbarMiddleware.get_current(), None)
+
+    def test_live_count(self):
+        count = DebugToolbar.live_count()
+        DebugToolbarMiddleware.remove_toolbar()
+        del self.toolbar
+        self.assertEquals(DebugToolbar.live_count(), count - 1)
+
+class OverheadPanelTestCase(BaseTestCase):
+    def test_hook_timings(self):
+        self.toolbar.run_hook('process_request', self.request)
+        for panel in self.toolbar.panels:
+            self.assertTrue('process_request' in self.toolbar.timings[panel.__class__])
+        self.toolbar.record_timing(SQLDebugPanel, 'tracking', 2.0)
+        self.toolbar.record_timing(SQLDebugPanel, 'tracking', 3.0)
+        self.assertEquals(self.toolbar.timings[SQLDebugPanel]['tracking'], 5.0)
+
+    def test_tracking_time(self):
+        panel = self.toolbar.get_panel(SQLDebugPanel)
+        list(User.objects.all())
+        self.assertTrue(self.toolbar.timings[SQLDebugPanel]['tracking'] > 0)
+
+    def test_content(self):
+        panel = OverheadDebugPanel(self.toolbar)
+        sql_panel = self.toolbar.get_panel(SQLDebugPanel)
+        list(User.objects.all())
+        sql_panel.process_response(self.request, self.response)
+        panel.process_response(self.request, self.response)
+        self.assertFalse('memory' in panel.get_stats())
+        memory = dict([(row['name'], row['memory']) for row in panel.get_rows()])
+        self.assertTrue(memory[sql_panel.name] > 0)
+        self.assertTrue(panel.get_total_time() > 0)
+        self.assertTrue(sql_panel.name in panel.content())
+
+class TimelinePanelTestCase(BaseTestCase):
+    def test_spans(self):
+        panel = TimelineDebugPanel(self.toolbar)
+        sql_panel = self.toolbar.get_panel(SQLDebugPanel)
+        panel.process_request(self.request)
+        list(User.objects.filter(pk=1))
+        timed_test_render(Template('{% for u in users %}{% endfor %}'),
+            Context({'users': User.objects.all()}))
+        list(User.objects.filter(pk=2))
+        sql_panel.process_response(self.request, self.response)
+        panel.process_response(self.request, self.response)
+
+        stats = panel.get_stats()
+        self.assertEquals([span['kind'] for span in stats['spans']],
+            ['sql', 'template', 'sql', 'sql'])
+        first, template, inner, last = stats['spans']
+        self.assertEquals(inner['depth'], 1)
+        self.assertEquals(template['gap'], None)
+        self.assertTrue(first['gap'] >= 0 and last['gap'] >= 0)
+        self.assertTrue(first['start'] <= template['start'] <= inner['start'])
+        self.assertTrue(0 < stats['io_time'] <= stats['total_time'])
+        self.assertAlmostEquals(stats['python_time'],
+            stats['total_time'] - stats['io_time'])
+        self.assertTrue(stats['max_gap'] >= last['gap'])
+        self.assertTrue('djDebugWaterfallBar' in panel.content())
+
+    def test_serial_runs(self):
+        panel = TimelineDebugPanel(self.toolbar)
+        panel._start_time = 0
+        panel.get_spans = lambda: [('sql', 'SELECT 1', t, t + 0.001)
+            for t in (0.001, 0.0025, 0.004, 0.010)]
+        panel.process_response(self.request, self.response)
+        stats = panel.get_stats()
+        self.assertEquals(len(stats['runs']), 1)
+        self.assertEquals(stats['runs'][0]['count'], 3)
+        self.assertAlmostEquals(stats['runs'][0]['time'], 4)
+        self.assertAlmostEquals(stats['io_time'], 4)
+        self.assertAlmostEquals(stats['spans'][-1]['gap'], 5)
+
+class StackFramesTestCase(TestCase):
+    def test_get_stack_frames(self):
+        def hidden():
+            __traceback_hide__ = True
+            return get_stack_frames()
+        frames = hidden()
+        code, lineno = frames[-1]
+        self.assertEquals(code.co_name, 'test_get_stack_frames')
+        path, line_no, func_name, text = resolve_stack_frames(frames)[-1]
+        self.assertEquals(func_name, 'test_get_stack_frames')
+        self.assertEquals(text, 'frames = hidden()')
+
+    def test_file_kinds_are_memoized(self):
+        from debug_toolbar import utils
+        filename = self.test_get_stack_frames.im_func.func_code.co_filename
+        utils._file_kinds.pop(filename, None)
+        get_stack_frames()
+        self.assertEquals(utils._file_kinds[filename], 'other')
+
+class StackTableTestCase(TestCase):
+    def test_shared_prefix(self):
+        table = StackTable()
+        frames = get_stack_frames()
+        first = table.intern(frames + [frames[0]])
+        second = table.intern(frames + [frames[-1]])
+        self.assertEquals(list(first), frames + [frames[0]])
+        self.assertEquals(list(second), frames + [frames[-1]])
+        self.assertEquals(len(second), len(frames) + 1)
+        # The common frames are stored once
+        self.assertEquals(len(table.frames), len(frames))
+        self.assertEquals(len(table.nodes), len(frames) + 3)
+        self.assertEquals(table.intern(frames).node_id,
+            table.intern(list(frames)).node_id)
+
+    def test_html(self):
+        table = StackTable()
+        stack = table.intern(get_stack_frames())
+        html = stack.html()
+        self.assertTrue('<span class="func">test_html</span>' in html)
+        self.assertTrue('stack = table.intern(get_stack_frames())' in html)
+        self.assertEquals(len(table._frame_html), len(stack))
+        self.assertEquals(table.intern([]).html(), '')
+
+class TimerTestCase(TestCase):
+    def test_monotonic(self):
+        if sys.platform.startswith('linux'):
+            self.assertNotEquals(timer, time.time)
+        readings = [timer() for i in range(1000)]
+        self.assertEquals(readings, sorted(readings))